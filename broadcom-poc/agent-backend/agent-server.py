@@ -11,6 +11,67 @@ The following env variables are optional.
 * VECTARA_AGENTIC_MAIN_MODEL_NAME=gpt-4o-2024-08-06
 * VECTARA_AGENTIC_TOOL_LLM_PROVIDER=OPENAI
 * VECTARA_AGENTIC_TOOL_MODEL_NAME=gpt-4o-2024-08-06
+* AGENT_POOL_SIZE=10 (number of agents, one per active session)
+* AGENT_POOL_PREWARM=1 (agents built in the background after startup; the rest are built on first use)
+* AGENT_LEASE_TTL_SECONDS=1800 (idle time after which a session's agent can be reclaimed)
+* AGENT_CLAIM_TIMEOUT_SECONDS=0 (how long a new session waits for a free agent before getting 503)
+* AGENT_WORKERS=10 (max agent calls running at once)
+* AGENT_MAX_QUEUE_DEPTH=20 (max agent calls waiting for a worker before returning 503)
+* AGENT_CHAT_TIMEOUT_SECONDS=120 (per-request agent call timeout)
+* RAG_CACHE_MAX_ENTRIES=1024 (cached query_echostor_content results, per worker process; 0 disables the cache)
+* RAG_CACHE_TTL_SECONDS=3600
+* RAG_CACHE_SIMILARITY_THRESHOLD=0 (e.g. 0.9 to also serve near-duplicate queries from the cache; 0 disables)
+* SENDGRID_API_KEY, SENDGRID_FROM_EMAIL (required for OTP emails unless OTP_MAIL_TRANSPORT=stub)
+* OTP_MAIL_TRANSPORT=sendgrid (or 'stub' to record OTP emails locally instead of sending them, for tests and benchmarks)
+* OTP_STUB_LATENCY_SECONDS=0 (simulated send time of the stub transport)
+* OTP_SEND_WORKERS=2 (OTP email batches being sent at once)
+* OTP_SEND_BATCH_SIZE=50 (max OTP emails sent in one mail API call)
+* OTP_SEND_MAX_ATTEMPTS=4
+* OTP_SEND_RETRY_BACKOFF_SECONDS=1 (doubled after every failed attempt)
+* OTP_STORE_URL (redis://localhost:6379/0 or sqlite:///otp.db to share issued OTPs between workers; in-memory if unset,
+  sqlite:///otp.db if AGENT_SERVER_WORKERS > 1)
+* OTP_STORE_MAX_ENTRIES=100000 (in-memory store capacity; the codes closest to expiring are evicted first)
+* OTP_SWEEP_INTERVAL_SECONDS=30 (how often expired codes are swept from the in-memory store)
+* OTP_SEND_EMAIL_BURST=3, OTP_SEND_EMAIL_PER_MINUTE=1 (token-bucket limit on /otp/send per email address)
+* OTP_SEND_IP_BURST=10, OTP_SEND_IP_PER_MINUTE=5 (token-bucket limit on /otp/send per client IP)
+  Both limits are kept per worker process, not in the shared OTP store. The router sends requests with a session
+  header by session, so a client spreading /otp/send over several sessions can get up to AGENT_SERVER_WORKERS times
+  either limit; requests without one always reach the same worker for a client IP.
+* LIVE_AGENT_ROUTING_MIN_CONFIDENCE=0.6 (/live-agent-lookup asks the agent when the topic classifier is less sure; 1.01 always asks)
+* LIVE_AGENT_ROUTING_HISTORY=10 (recent messages per session the topic classifier looks at)
+* LIVE_AGENT_ROUTING_MIN_SCORE=1.0 (keyword hits, older messages decayed, the topic classifier needs before it picks a topic)
+* TRACING_ENABLED=1 (per-request latency spans, see GET /tracing/stats)
+* TRACING_RING_BUFFER_SPANS=10000 (most recent spans kept in memory)
+* TRACING_JSONL_PATH (also write every span to this JSONL file)
+* TRACING_OTLP_TARGET (also export spans as OTLP/JSON, to a file or an OTLP/HTTP endpoint like http://localhost:4318/v1/traces)
+* METRICS_REQUIRE_API_KEY=0 (1 to require the X-API-Key header on GET /metrics, the Prometheus scrape endpoint)
+* LOG_ASYNC=1 (log records are written by background threads; 0 writes them on the calling thread)
+* LOG_QUEUE_MAX_RECORDS=10000 (records waiting to be written per logger; further records are dropped and counted)
+* LOG_MAX_MESSAGE_CHARS=2000 (longer log messages are truncated)
+* LOG_RAW_SAMPLE_RATE=0.01 (share of chat requests whose raw tool output and response object are dumped to the log)
+* LOG_RAW_MAX_CHARS=20000 (raw dumps are truncated to this many characters)
+* JIRA_BASE_URL, JIRA_EMAIL, JIRA_API_KEY (for the Jira tools)
+* JIRA_TIMEOUT_SECONDS=15 (per Jira request)
+* JIRA_MAX_RETRIES=3, JIRA_RETRY_BACKOFF_SECONDS=0.5 (retries of Jira 429/5xx responses, backoff doubled each time)
+* JIRA_CACHE_TTL_SECONDS=30 (how long Jira search results are cached; every write tool clears the cache)
+* JIRA_MAX_CONCURRENCY=8 (Jira requests in flight at once)
+* ACCOUNT_STORE_PATH (SQLite file to persist user accounts in, e.g. accounts.db; in-memory if unset,
+  accounts.db if AGENT_SERVER_WORKERS > 1)
+* ACCOUNT_STORE_FLUSH_INTERVAL_SECONDS=1 (how often account updates are written behind to the SQLite file)
+* ACCOUNT_STORE_CACHE_SIZE=10000 (accounts cached in memory in front of the SQLite file)
+* ACCOUNT_STORE_GENERATE_MISSING=0 (1 to create a random account for emails not in the store, for demos)
+* CONVERSATION_MEMORY_ENABLED=1 (keep each session's conversation outside its agent, so any agent can continue it)
+* CONVERSATION_MEMORY_PATH (SQLite file keeping conversations across restarts, e.g. conversations.db; in-memory if
+  unset, conversations.db if AGENT_SERVER_WORKERS > 1)
+* CONVERSATION_MEMORY_MAX_TURNS=20 (recent turns restored verbatim; older ones are folded into a short summary)
+* CONVERSATION_MEMORY_MAX_MESSAGE_CHARS=4000 (stored questions and answers are truncated to this length)
+* CONVERSATION_MEMORY_SUMMARY_MAX_CHARS=2000 (the summary of older turns drops its oldest lines beyond this)
+* CONVERSATION_MEMORY_TTL_SECONDS=604800 (conversations idle for longer are deleted)
+* AGENT_SERVER_WORKERS=1 (worker processes; above 1, port 8001 routes each session to the worker holding its agent)
+* AGENT_SERVER_WORKER_BASE_PORT=9001 (workers listen on 127.0.0.1, on this port and the ones after it)
+* AGENT_SERVER_WORKER_START_TIMEOUT_SECONDS=300 (how long the router waits for every worker to start listening)
+* AGENT_SERVER_WORKER_READ_TIMEOUT_SECONDS (how long the router waits for more of a worker's response before giving
+  up; AGENT_CLAIM_TIMEOUT_SECONDS + AGENT_CHAT_TIMEOUT_SECONDS + 30 if unset)
 
 Run this with no arguments, e.g.
 python3 agent-server.py
@@ -18,13 +79,21 @@ python3 agent-server.py
 
 import sys
 import os
+import asyncio
+import contextvars
+import threading
+import time
+import contextlib
+import heapq
+import atexit
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 # --- Add OTP related imports ---
 import random
 import string
 from datetime import datetime, timedelta, timezone # Use timezone-aware datetime
-# --- SendGrid imports ---
-# from sendgrid import SendGridAPIClient
-# from sendgrid.helpers.mail import Mail
+# --- SendGrid is imported by SendGridMailTransport, so the stub transport works without it ---
 # --- End OTP imports ---
 
 from vectara_agentic.tools import ToolsFactory, VectaraToolFactory, VectaraTool
@@ -37,38 +106,129 @@ from pydantic import BaseModel, Field
 import nest_asyncio
 
 import logging
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.security.api_key import APIKeyHeader
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 import uvicorn
 
 from vectara_agentic.agent import AgentStatusType
+from llama_index.core.llms import ChatMessage, MessageRole
 
 import json
 import ast
 import re # Import regex for fallback parsing
 import uuid # For potential future use, though using formatted strings now
+import math
+import zlib
 from typing import List, Dict, Any, Optional # For type hinting
 
-import requests
-from requests.auth import HTTPBasicAuth
+from tracing import Tracer, RingBufferSpanExporter, JsonlSpanExporter, OtlpJsonSpanExporter
+from metrics import MetricsRegistry, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from log_pipeline import AsyncLogging, LazyJson, RawDumpSampler
+from session_router import WorkerProcesses, create_router_app, worker_command
+from jira_client import JiraClient, JiraError, ISSUE_SUMMARY_FIELDS, ISSUE_DETAIL_FIELDS, summarize_issue
 
 import dotenv
 dotenv.load_dotenv()
 
+BOOT_STARTED = time.perf_counter()
 
-# --- Global Storage for Last RAG Result (Potential Concurrency Issue) ---
-# WARNING: In a multi-agent/concurrent scenario, this might store results
-# from a different request than the one being processed in /chat.
-last_rag_result = {"fcs_score": None, "citations": []}
+
+# --- Per-request RAG Result Channel ---
+# Each /chat request sets a fresh result dict here before calling the agent. The agent call runs in a copy of the
+# request's context, so agent_progress_callback writes FCS and citations into that request's dict only.
+current_rag_result: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("current_rag_result", default=None)
+
+
+def new_rag_result() -> dict:
+    # 'structured' is set once FCS/Citations were captured as objects from the RAG tool's return value
+    return {"fcs_score": None, "citations": [], "structured": False}
+
+
+# Optional per-request sink for agent progress events, set by /chat/stream. Called as sink(event_type, data).
+current_event_sink: contextvars.ContextVar[Optional[Any]] = contextvars.ContextVar("current_event_sink", default=None)
+# ---
+
+# --- Latency Tracing (configurable via env) ---
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+TRACING_RING_BUFFER_SPANS = int(os.getenv("TRACING_RING_BUFFER_SPANS", 10000))
+TRACING_JSONL_PATH = os.getenv("TRACING_JSONL_PATH")
+TRACING_OTLP_TARGET = os.getenv("TRACING_OTLP_TARGET")
+
+
+def create_tracer() -> Tracer:
+    """Build the tracer: spans always go to the in-memory ring buffer, and to the JSONL/OTLP exporters if configured."""
+    exporters = []
+    if TRACING_JSONL_PATH:
+        exporters.append(JsonlSpanExporter(TRACING_JSONL_PATH))
+    if TRACING_OTLP_TARGET:
+        exporters.append(OtlpJsonSpanExporter(TRACING_OTLP_TARGET, service_name="echostor-agent-server"))
+    tracer = Tracer(RingBufferSpanExporter(max_spans=TRACING_RING_BUFFER_SPANS), exporters, enabled=TRACING_ENABLED)
+    atexit.register(tracer.close)
+    return tracer
+
+
+tracer = create_tracer()
+# ---
+
+# --- Logging (configurable via env) ---
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1") == "1"
+LOG_QUEUE_MAX_RECORDS = int(os.getenv("LOG_QUEUE_MAX_RECORDS", 10000))
+LOG_MAX_MESSAGE_CHARS = int(os.getenv("LOG_MAX_MESSAGE_CHARS", 2000))
+LOG_RAW_SAMPLE_RATE = float(os.getenv("LOG_RAW_SAMPLE_RATE", 0.01))
+LOG_RAW_MAX_CHARS = int(os.getenv("LOG_RAW_MAX_CHARS", 20000))
+RAW_DUMP_LOG_EXTRA = {"max_chars": LOG_RAW_MAX_CHARS}
+
+# Whether this request's raw agent output is dumped to the log, decided once per request by raw_dump_sampler
+current_log_raw: contextvars.ContextVar[bool] = contextvars.ContextVar("current_log_raw", default=False)
+raw_dump_sampler = RawDumpSampler(LOG_RAW_SAMPLE_RATE)
+# ---
+
+# --- Prometheus Metrics (configurable via env) ---
+METRICS_REQUIRE_API_KEY = os.getenv("METRICS_REQUIRE_API_KEY", "0") == "1"
+LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+FCS_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# Recorded on the request path; values kept by other objects are registered as scrape-time callbacks
+metrics = MetricsRegistry()
+http_requests_total = metrics.counter(
+    "agent_http_requests_total", "HTTP requests by route and status code", ["method", "route", "status"])
+http_request_duration = metrics.histogram(
+    "agent_http_request_duration_seconds", "HTTP request latency by route (streams: until the headers are sent)",
+    ["method", "route"], LATENCY_BUCKETS_SECONDS)
+tool_calls_total = metrics.counter(
+    "agent_tool_calls_total", "Agent tool calls by tool and outcome (ok/error)", ["tool", "outcome"])
+tool_call_duration = metrics.histogram(
+    "agent_tool_call_duration_seconds", "Agent tool call latency by tool", ["tool"], LATENCY_BUCKETS_SECONDS)
+chat_responses_total = metrics.counter(
+    "agent_chat_responses_total", "Chat answers, by whether the off-topic redirection was appended", ["off_topic"])
+fcs_score_histogram = metrics.histogram(
+    "agent_fcs_score", "Factual consistency score of chat answers that had one", buckets=FCS_BUCKETS)
 # ---
 
 api_key_header = APIKeyHeader(name="X-API-Key")
+optional_api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
 session_header = APIKeyHeader(name="session")
 email_header = APIKeyHeader(name="email")
 
 
-NUM_AGENTS = 10
+NUM_AGENTS = int(os.getenv("AGENT_POOL_SIZE", 10))
+AGENT_POOL_PREWARM = int(os.getenv("AGENT_POOL_PREWARM", 1))
+AGENT_LEASE_TTL_SECONDS = float(os.getenv("AGENT_LEASE_TTL_SECONDS", 1800))
+AGENT_CLAIM_TIMEOUT_SECONDS = float(os.getenv("AGENT_CLAIM_TIMEOUT_SECONDS", 0))
+
+# --- Agent Call Concurrency (configurable via env) ---
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", NUM_AGENTS))
+AGENT_MAX_QUEUE_DEPTH = int(os.getenv("AGENT_MAX_QUEUE_DEPTH", AGENT_WORKERS * 2))
+AGENT_CHAT_TIMEOUT_SECONDS = float(os.getenv("AGENT_CHAT_TIMEOUT_SECONDS", 120))
+STREAM_TOOL_OUTPUT_PREVIEW_CHARS = 1000
+
+# --- RAG Response Cache (configurable via env) ---
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", 1024))
+RAG_CACHE_TTL_SECONDS = float(os.getenv("RAG_CACHE_TTL_SECONDS", 3600))
+RAG_CACHE_SIMILARITY_THRESHOLD = float(os.getenv("RAG_CACHE_SIMILARITY_THRESHOLD", 0))
+# ---
 
 # A hack to get the channel ID is to get the link for the channel, then copy the long number at the end of the link,
 # which is a JWT token. Then paste that into a JWT decoder (e.g. https://fusionauth.io/dev-tools/jwt-decoder) and
@@ -83,25 +243,110 @@ LIVE_AGENTS = {
     #SUPPORT_QUEUES[4]: {"name": "Tallat", "id": "abcd1234", "channel":  "2c2337ab03604e5c8ea893b44493c9f8@conference.xmpp.zoom.us"}, #general    JWT=eyJzaWQiOiIyYzIzMzdhYjAzNjA0ZTVjOGVhODkzYjQ0NDkzYzlmOEBjb25mZXJlbmNlLnhtcHAuem9vbS51cyJ9
 }
 
+# --- Live Agent Routing (configurable via env) ---
+LIVE_AGENT_ROUTING_MIN_CONFIDENCE = float(os.getenv("LIVE_AGENT_ROUTING_MIN_CONFIDENCE", 0.6))
+LIVE_AGENT_ROUTING_HISTORY = int(os.getenv("LIVE_AGENT_ROUTING_HISTORY", 10))
+LIVE_AGENT_ROUTING_MAX_SESSIONS = 10000
+LIVE_AGENT_ROUTING_DECAY = 0.7  # weight of a message relative to the one after it
+LIVE_AGENT_ROUTING_MIN_SCORE = float(os.getenv("LIVE_AGENT_ROUTING_MIN_SCORE", 1.0))
+LIVE_AGENT_ROUTING_RESPONSE_WEIGHT = 0.5  # agent answers echo the topic but count less than what the user asked
+# Product names and phrases that point to each support queue. Words any product's users say ("vm", "endpoint",
+# "license", "login") are left out: they would tip sessions about another product into the wrong queue.
+SUPPORT_TOPIC_KEYWORDS = {
+    "vmware": ["vmware", "vsphere", "esxi", "vcenter", "vsan", "nsx", "vcf", "vmware cloud foundation", "tanzu",
+               "vmware horizon", "horizon desktop", "vmware workstation", "vmware fusion", "vmotion", "vmware tools",
+               "aria operations", "aria automation", "vrealize"],
+    "mainframe": ["mainframe", "z/os", "zos", "ibm z", "mainframe operational intelligence",
+                  "advanced authentication mainframe", "cobol", "cics", "db2", "jcl", "ims db", "ims tm", "racf",
+                  "acf2", "ca top secret", "endevor", "ca 7", "tso", "ispf", "sysview", "opsmvs"],
+    "carbonblack": ["carbon black", "carbonblack", "cb app control", "carbon black app control", "carbon black edr",
+                    "enterprise edr", "carbon black xdr", "carbon black cloud", "endpoint standard", "bit9",
+                    "cb defense", "cb response", "cb protection", "cb sensor", "cbc sensor"],
+    "account": ["my account", "account details", "account profile", "my profile", "support tier", "my support tier",
+                "company name", "my company", "license key", "license renewal", "billing", "subscription",
+                "entitlement", "password reset", "reset my password", "contract renewal", "renew my contract",
+                "invoice"],
+}
+# ---
+
 
 # configure from environment
 JIRA_BASE_URL = os.getenv("JIRA_BASE_URL")
 JIRA_EMAIL    = os.getenv("JIRA_EMAIL")
 JIRA_API_KEY  = os.getenv("JIRA_API_KEY")
 
-# shared session
-_jira_session = requests.Session()
-_jira_session.auth = HTTPBasicAuth(JIRA_EMAIL, JIRA_API_KEY)
-_jira_session.headers.update({
-    "Accept": "application/json",
-    "Content-Type": "application/json"
-})
-
+JIRA_TIMEOUT_SECONDS = float(os.getenv("JIRA_TIMEOUT_SECONDS", 15))
+JIRA_MAX_RETRIES = int(os.getenv("JIRA_MAX_RETRIES", 3))
+JIRA_RETRY_BACKOFF_SECONDS = float(os.getenv("JIRA_RETRY_BACKOFF_SECONDS", 0.5))
+JIRA_CACHE_TTL_SECONDS = float(os.getenv("JIRA_CACHE_TTL_SECONDS", 30))
+JIRA_MAX_CONCURRENCY = int(os.getenv("JIRA_MAX_CONCURRENCY", 8))
+
+# shared client (pooled connections, retries, paging and a short-TTL read cache)
+jira_client = JiraClient(JIRA_BASE_URL, JIRA_EMAIL, JIRA_API_KEY, timeout=JIRA_TIMEOUT_SECONDS,
+                         max_retries=JIRA_MAX_RETRIES, retry_backoff=JIRA_RETRY_BACKOFF_SECONDS,
+                         cache_ttl=JIRA_CACHE_TTL_SECONDS, max_concurrency=JIRA_MAX_CONCURRENCY)
+# Error rate: rate(agent_jira_errors_total) / rate(agent_jira_requests_total)
+metrics.counter_callback("agent_jira_requests_total", "Jira API requests sent, including retries",
+                         lambda: jira_client.requests)
+metrics.counter_callback("agent_jira_retries_total", "Jira API requests retried after a 429/5xx or transport error",
+                         lambda: jira_client.retries)
+metrics.counter_callback("agent_jira_errors_total", "Jira API requests that failed (error status or transport error)",
+                         lambda: jira_client.errors)
+
+
+# --- Multi-worker Serving (configurable via env) ---
+# Above 1 worker, this process routes requests to worker processes running this script again (see session_router.py),
+# and the OTP and account stores default to SQLite files shared by the workers. AGENT_POOL_SIZE etc. are per worker.
+AGENT_SERVER_WORKERS = int(os.getenv("AGENT_SERVER_WORKERS", 1))
+AGENT_SERVER_WORKER_BASE_PORT = int(os.getenv("AGENT_SERVER_WORKER_BASE_PORT", 9001))
+AGENT_SERVER_WORKER_START_TIMEOUT_SECONDS = float(os.getenv("AGENT_SERVER_WORKER_START_TIMEOUT_SECONDS", 300))
+AGENT_SERVER_WORKER_READ_TIMEOUT_SECONDS = float(os.getenv("AGENT_SERVER_WORKER_READ_TIMEOUT_SECONDS",
+                                                           AGENT_CLAIM_TIMEOUT_SECONDS + AGENT_CHAT_TIMEOUT_SECONDS + 30))
+AGENT_SERVER_WORKER_INDEX = os.getenv("AGENT_SERVER_WORKER_INDEX")  # set by the router in each worker process
+MULTI_WORKER = AGENT_SERVER_WORKERS > 1
+# ---
 
-# --- OTP Storage (In-memory, suitable for POC) ---
-# Structure: { "email@example.com": {"otp": "123456", "expiry": datetime_object} }
-otp_storage = {}
+# --- OTP Storage (configurable via env) ---
+# Entries look like { "email@example.com": {"otp": "123456", "expiry": datetime_object} }, see create_otp_store
 OTP_EXPIRY_MINUTES = 5 # Set OTP expiry time
+OTP_STORE_URL = os.getenv("OTP_STORE_URL", "sqlite:///otp.db" if MULTI_WORKER else None)
+OTP_STORE_MAX_ENTRIES = int(os.getenv("OTP_STORE_MAX_ENTRIES", 100000))
+OTP_SWEEP_INTERVAL_SECONDS = float(os.getenv("OTP_SWEEP_INTERVAL_SECONDS", 30))
+OTP_SEND_EMAIL_BURST = int(os.getenv("OTP_SEND_EMAIL_BURST", 3))
+OTP_SEND_EMAIL_PER_MINUTE = float(os.getenv("OTP_SEND_EMAIL_PER_MINUTE", 1))
+OTP_SEND_IP_BURST = int(os.getenv("OTP_SEND_IP_BURST", 10))
+OTP_SEND_IP_PER_MINUTE = float(os.getenv("OTP_SEND_IP_PER_MINUTE", 5))
+RATE_LIMIT_MAX_KEYS = 100000
+
+# --- OTP Delivery (configurable via env) ---
+OTP_MAIL_TRANSPORT = os.getenv("OTP_MAIL_TRANSPORT", "sendgrid")
+OTP_STUB_LATENCY_SECONDS = float(os.getenv("OTP_STUB_LATENCY_SECONDS", 0))
+OTP_SEND_WORKERS = int(os.getenv("OTP_SEND_WORKERS", 2))
+OTP_SEND_BATCH_SIZE = int(os.getenv("OTP_SEND_BATCH_SIZE", 50))
+OTP_SEND_MAX_ATTEMPTS = int(os.getenv("OTP_SEND_MAX_ATTEMPTS", 4))
+OTP_SEND_RETRY_BACKOFF_SECONDS = float(os.getenv("OTP_SEND_RETRY_BACKOFF_SECONDS", 1))
+OTP_DELIVERY_STATUS_MAX_ENTRIES = 10000
+OTP_EMAIL_SUBJECT = 'Your EchoStor Support Verification Code'
+OTP_SUBSTITUTION_TAG = "-otp_code-"
+OTP_EMAIL_HTML = (f'<strong>Your verification code is: {OTP_SUBSTITUTION_TAG}</strong><br>'
+                  f'This code will expire in {OTP_EXPIRY_MINUTES} minutes.')
+
+# --- Account Store (configurable via env) ---
+ACCOUNT_STORE_PATH = os.getenv("ACCOUNT_STORE_PATH", "accounts.db" if MULTI_WORKER else None)
+ACCOUNT_STORE_FLUSH_INTERVAL_SECONDS = float(os.getenv("ACCOUNT_STORE_FLUSH_INTERVAL_SECONDS", 1))
+ACCOUNT_STORE_CACHE_SIZE = int(os.getenv("ACCOUNT_STORE_CACHE_SIZE", 10000))
+ACCOUNT_STORE_GENERATE_MISSING = os.getenv("ACCOUNT_STORE_GENERATE_MISSING", "0") == "1"
+ACCOUNT_STORE_BATCH_SIZE = 500  # max emails per SQL IN (...) lookup
+# ---
+
+# --- Conversation Memory (configurable via env) ---
+CONVERSATION_MEMORY_ENABLED = os.getenv("CONVERSATION_MEMORY_ENABLED", "1") == "1"
+CONVERSATION_MEMORY_PATH = os.getenv("CONVERSATION_MEMORY_PATH", "conversations.db" if MULTI_WORKER else ":memory:")
+CONVERSATION_MEMORY_MAX_TURNS = int(os.getenv("CONVERSATION_MEMORY_MAX_TURNS", 20))
+CONVERSATION_MEMORY_MAX_MESSAGE_CHARS = int(os.getenv("CONVERSATION_MEMORY_MAX_MESSAGE_CHARS", 4000))
+CONVERSATION_MEMORY_SUMMARY_MAX_CHARS = int(os.getenv("CONVERSATION_MEMORY_SUMMARY_MAX_CHARS", 2000))
+CONVERSATION_MEMORY_TTL_SECONDS = float(os.getenv("CONVERSATION_MEMORY_TTL_SECONDS", 7 * 24 * 3600))
+CONVERSATION_SUMMARY_EXCERPT_CHARS = 200  # per question and per answer in a summary line
 # ---
 
 # --- Pydantic Models for API - Keep Here ---
@@ -128,8 +373,8 @@ class UserRecord(BaseModel):
     products: List[Product] = []
     support_tier: str
 
-# In-memory store (dictionary): {email: UserRecord}
-account_data_store = {
+# Demo accounts loaded into an empty account store, see create_account_store
+SEED_ACCOUNTS = {
     "alice@echostor.com": UserRecord(
         user_id="USR-001", name="Alice Alpine", company="EchoStor Inc.", email="alice@echostor.com",
         products=[Product(name="VMware vSphere", version="8.0"), Product(name="Symantec DLP", license_key="DLP-ABC-123")],
@@ -195,92 +440,1901 @@ def generate_random_user_data(email: str) -> UserRecord:
     return new_record
 # --- END Helper --- 
 
-def agent_progress_callback(status_type: AgentStatusType, msg: str):
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+class MemoryAccountStore:
+    """
+    In-memory account store, indexed on email, user_id, company and product name.
+
+    Account tools run on agent worker threads, so every access takes the lock. Records are copied on the way in and out,
+    so a caller can never change a stored record without going through update_field.
+    """
+
+    def __init__(self, seed_records=()):
+        self._records = {}  # {normalized email: UserRecord}
+        self._by_user_id = {}  # {user_id: normalized email}
+        self._by_company = {}  # {lowercased company: {normalized email}}
+        self._by_product = {}  # {lowercased product name: {normalized email}}
+        self._lock = threading.RLock()
+
+        self.lookups = 0
+        self.updates = 0
+        for record in seed_records:
+            self.put(record)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _index(self, key: str, record: UserRecord):
+        self._by_user_id[record.user_id] = key
+        self._by_company.setdefault(record.company.lower(), set()).add(key)
+        for product in record.products:
+            self._by_product.setdefault(product.name.lower(), set()).add(key)
+
+    def _unindex(self, key: str, record: UserRecord):
+        self._by_user_id.pop(record.user_id, None)
+        self._by_company.get(record.company.lower(), set()).discard(key)
+        for product in record.products:
+            self._by_product.get(product.name.lower(), set()).discard(key)
+
+    def put(self, record: UserRecord):
+        key = normalize_email(record.email)
+        record = record.model_copy(deep=True)
+        with self._lock:
+            old_record = self._records.get(key)
+            if old_record:
+                self._unindex(key, old_record)
+            self._records[key] = record
+            self._index(key, record)
+
+    def get(self, email: str) -> Optional[UserRecord]:
+        with self._lock:
+            self.lookups += 1
+            record = self._records.get(normalize_email(email))
+            return record.model_copy(deep=True) if record else None
+
+    def get_many(self, emails: List[str]) -> Dict[str, UserRecord]:
+        """Look up several accounts at once; returns {email: record} for the emails that were found."""
+        with self._lock:
+            self.lookups += len(emails)
+            found = {}
+            for email in emails:
+                record = self._records.get(normalize_email(email))
+                if record:
+                    found[email] = record.model_copy(deep=True)
+            return found
+
+    def get_by_user_id(self, user_id: str) -> Optional[UserRecord]:
+        with self._lock:
+            key = self._by_user_id.get(user_id)
+            return self.get(key) if key else None
+
+    def find_by_company(self, company: str) -> List[UserRecord]:
+        with self._lock:
+            return list(self.get_many(sorted(self._by_company.get(company.lower(), ()))).values())
+
+    def find_by_product(self, product_name: str) -> List[UserRecord]:
+        with self._lock:
+            return list(self.get_many(sorted(self._by_product.get(product_name.lower(), ()))).values())
+
+    def update_field(self, email: str, field: str, value):
+        """Set one field of an account atomically. Returns the old value; raises KeyError if there is no such account."""
+        return self.update_fields(email, {field: value})[field]
+
+    def update_fields(self, email: str, updates: dict) -> dict:
+        """Set several fields of an account atomically. Returns their old values; raises KeyError if there is no such account."""
+        key = normalize_email(email)
+        with self._lock:
+            record = self._records.get(key)
+            if record is None:
+                raise KeyError(email)
+            old_values = {field: getattr(record, field) for field in updates}
+            updated = record.model_copy(update=updates, deep=True)
+            self._unindex(key, record)
+            self._records[key] = updated
+            self._index(key, updated)
+            self.updates += 1
+            return old_values
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "memory", "size": len(self._records), "lookups": self.lookups, "updates": self.updates}
+
+
+def connect_sqlite(filename: str, **kwargs) -> sqlite3.Connection:
+    """
+    Open a SQLite file in WAL mode. Processes opening a new file at the same time can get 'database is locked' while
+    switching it to WAL, without SQLite waiting for the lock, so that switch is retried.
+
+    Stores used from the event loop run their queries through asyncio.to_thread: they take well under a millisecond,
+    but may wait for another process's write lock.
+    """
+    conn = sqlite3.connect(filename, check_same_thread=False, timeout=30, **kwargs)
+    for attempt in range(50):
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            break
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == 49:
+                raise
+            time.sleep(0.1)
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SqliteAccountStore:
+    """
+    Account store persisted in a SQLite file, so accounts survive restarts and scale past what fits in memory.
+
+    email is the primary key, and user_id, company and product name are indexed. Reads go through an LRU cache of
+    records. Updates are applied to the cache right away and written behind: a background thread writes every
+    pending update in one transaction each flush interval, and on close.
+
+    With shared=True, several processes can use the same file: there is no cache, and puts and updates are written
+    through, with each update read and written in one IMMEDIATE transaction so concurrent updates aren't lost.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS accounts (
+            email TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            company TEXT NOT NULL,
+            record TEXT NOT NULL
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS accounts_user_id ON accounts (user_id);
+        CREATE INDEX IF NOT EXISTS accounts_company ON accounts (company COLLATE NOCASE);
+        CREATE TABLE IF NOT EXISTS account_products (
+            email TEXT NOT NULL,
+            product_name TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS account_products_email ON account_products (email);
+        CREATE INDEX IF NOT EXISTS account_products_name ON account_products (product_name COLLATE NOCASE);
+    """
+
+    def __init__(self, filename: str, seed_records=(), cache_size: int = 10000, flush_interval: float = 1,
+                 shared: bool = False):
+        self.filename = filename
+        self.shared = shared
+        self.cache_size = 0 if shared else cache_size
+        self.flush_interval = flush_interval
+        self._conn = connect_sqlite(filename)
+        self._conn.executescript(self.SCHEMA)
+        self._db_lock = threading.Lock()  # serializes use of the connection
+        self._lock = threading.RLock()  # guards the cache and pending writes
+        self._cache = OrderedDict()  # {normalized email: UserRecord}, least recently used first
+        self._dirty = {}  # {normalized email: UserRecord} not yet written
+        self._closed = threading.Event()
+
+        self.lookups = 0
+        self.cache_hits = 0
+        self.updates = 0
+        self.flushes = 0
+
+        # Checked and seeded in one transaction, so a process starting later can't re-seed over updates
+        if seed_records:
+            with self._immediate_transaction():
+                if not self._conn.execute("SELECT 1 FROM accounts LIMIT 1").fetchone():
+                    self._write_rows({normalize_email(record.email): record for record in seed_records})
+
+        self._flusher = None
+        if not shared:
+            self._flusher = threading.Thread(target=self._flush_loop, name="account-store-flusher", daemon=True)
+            self._flusher.start()
+
+    def __len__(self) -> int:
+        self.flush()
+        with self._db_lock:
+            return self._conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0]
+
+    def _write(self, records: dict):
+        with self._db_lock, self._conn:
+            self._write_rows(records)
+
+    def _write_rows(self, records: dict):
+        """Write records in the current transaction; the caller holds _db_lock."""
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO accounts (email, user_id, company, record) VALUES (?, ?, ?, ?)",
+            [(key, record.user_id, record.company, record.model_dump_json()) for key, record in records.items()])
+        self._conn.executemany("DELETE FROM account_products WHERE email = ?", [(key,) for key in records])
+        self._conn.executemany(
+            "INSERT INTO account_products (email, product_name) VALUES (?, ?)",
+            [(key, product.name) for key, record in records.items() for product in record.products])
+
+    def _cache_put(self, key: str, record: UserRecord):
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, UserRecord]:
+        """Return the records for keys, from pending writes, the cache, or one batched SELECT per chunk of misses."""
+        found = {}
+        misses = []
+        with self._lock:
+            for key in keys:
+                record = self._dirty.get(key) or self._cache.get(key)
+                if record:
+                    self._cache_put(key, record)
+                    found[key] = record
+                    self.cache_hits += 1
+                else:
+                    misses.append(key)
+
+        for start in range(0, len(misses), ACCOUNT_STORE_BATCH_SIZE):
+            chunk = misses[start:start + ACCOUNT_STORE_BATCH_SIZE]
+            with self._db_lock:
+                rows = self._conn.execute(
+                    f"SELECT email, record FROM accounts WHERE email IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            with self._lock:
+                for key, record_json in rows:
+                    # An update may have landed while reading; it wins over the row read
+                    record = self._dirty.get(key) or UserRecord.model_validate_json(record_json)
+                    self._cache_put(key, record)
+                    found[key] = record
+        return found
+
+    def _find_keys(self, sql: str, value: str) -> List[str]:
+        self.flush()
+        with self._db_lock:
+            return [row[0] for row in self._conn.execute(sql, (value,))]
+
+    def put(self, record: UserRecord):
+        key = normalize_email(record.email)
+        record = record.model_copy(deep=True)
+        if self.shared:
+            self._write({key: record})
+            return
+        with self._lock:
+            self._dirty[key] = record
+            self._cache_put(key, record)
+
+    def get(self, email: str) -> Optional[UserRecord]:
+        self.lookups += 1
+        key = normalize_email(email)
+        record = self._load([key]).get(key)
+        return record.model_copy(deep=True) if record else None
+
+    def get_many(self, emails: List[str]) -> Dict[str, UserRecord]:
+        """Look up several accounts at once; returns {email: record} for the emails that were found."""
+        self.lookups += len(emails)
+        records = self._load(list({normalize_email(email) for email in emails}))
+        return {email: records[normalize_email(email)].model_copy(deep=True)
+                for email in emails if normalize_email(email) in records}
+
+    def get_by_user_id(self, user_id: str) -> Optional[UserRecord]:
+        keys = self._find_keys("SELECT email FROM accounts WHERE user_id = ?", user_id)
+        return self.get(keys[0]) if keys else None
+
+    def find_by_company(self, company: str) -> List[UserRecord]:
+        keys = self._find_keys("SELECT email FROM accounts WHERE company = ? COLLATE NOCASE ORDER BY email", company)
+        return list(self.get_many(keys).values())
+
+    def find_by_product(self, product_name: str) -> List[UserRecord]:
+        keys = self._find_keys("SELECT DISTINCT email FROM account_products WHERE product_name = ? COLLATE NOCASE "
+                               "ORDER BY email", product_name)
+        return list(self.get_many(keys).values())
+
+    def update_field(self, email: str, field: str, value):
+        """Set one field of an account atomically. Returns the old value; raises KeyError if there is no such account."""
+        return self.update_fields(email, {field: value})[field]
+
+    def update_fields(self, email: str, updates: dict) -> dict:
+        """Set several fields of an account atomically. Returns their old values; raises KeyError if there is no such account."""
+        key = normalize_email(email)
+        if self.shared:
+            return self._update_shared(key, email, updates)
+        with self._lock:
+            record = self._load([key]).get(key)
+            if record is None:
+                raise KeyError(email)
+            old_values = {field: getattr(record, field) for field in updates}
+            updated = record.model_copy(update=updates, deep=True)
+            self._dirty[key] = updated
+            self._cache_put(key, updated)
+            self.updates += 1
+            return old_values
+
+    @contextlib.contextmanager
+    def _immediate_transaction(self):
+        """BEGIN IMMEDIATE takes the file's write lock before reading, so no other process can write in between."""
+        with self._db_lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def _update_shared(self, key: str, email: str, updates: dict) -> dict:
+        with self._immediate_transaction():
+            row = self._conn.execute("SELECT record FROM accounts WHERE email = ?", (key,)).fetchone()
+            if row is None:
+                raise KeyError(email)
+            record = UserRecord.model_validate_json(row[0])
+            old_values = {field: getattr(record, field) for field in updates}
+            self._write_rows({key: record.model_copy(update=updates, deep=True)})
+        self.updates += 1
+        return old_values
+
+    def flush(self):
+        """Write every pending update to the SQLite file in one transaction."""
+        with self._lock:
+            if not self._dirty:
+                return
+            dirty, self._dirty = self._dirty, {}
+        try:
+            self._write(dirty)
+            self.flushes += 1
+        except Exception:
+            # Keep the updates pending (unless newer ones replaced them) so the next flush retries them
+            with self._lock:
+                for key, record in dirty.items():
+                    self._dirty.setdefault(key, record)
+            raise
+
+    def _flush_loop(self):
+        logger = logging.getLogger("uvicorn.error")
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing account updates to {self.filename}: {e}", exc_info=True)
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        if self._flusher:
+            self._flusher.join()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"backend": "sqlite", "path": self.filename, "shared": self.shared, "cached": len(self._cache),
+                    "pending_writes": len(self._dirty),
+                    "lookups": self.lookups, "cache_hits": self.cache_hits, "updates": self.updates, "flushes": self.flushes}
+
+
+def create_account_store():
+    """
+    Build the account store: persisted in SQLite if ACCOUNT_STORE_PATH is set, otherwise in-memory.
+    In multi-worker mode the SQLite file is shared by the workers.
+    """
+    if ACCOUNT_STORE_PATH:
+        store = SqliteAccountStore(ACCOUNT_STORE_PATH, seed_records=SEED_ACCOUNTS.values(),
+                                   cache_size=ACCOUNT_STORE_CACHE_SIZE, flush_interval=ACCOUNT_STORE_FLUSH_INTERVAL_SECONDS,
+                                   shared=MULTI_WORKER)
+        atexit.register(store.close)
+        return store
+    return MemoryAccountStore(seed_records=SEED_ACCOUNTS.values())
+
+
+def get_account(email: str) -> Optional[UserRecord]:
+    """Look up an account, creating a random one for unknown emails if ACCOUNT_STORE_GENERATE_MISSING is set."""
+    user_record = account_store.get(email)
+    if user_record is None and ACCOUNT_STORE_GENERATE_MISSING:
+        user_record = generate_random_user_data(email)
+        account_store.put(user_record)
+    return user_record
+
+
+account_store = create_account_store()
+
+
+def excerpt(text: str, max_chars: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+class SqliteConversationStore:
+    """
+    Compact conversation memory per session, in a SQLite file (kept across restarts and shared by workers) or, with
+    filename ':memory:', in this process only. Only what the user asked and what the agent finally answered are kept,
+    not tool calls and tool outputs, and each is truncated to max_message_chars.
+
+    Once a session has more than max_turns turns, the oldest ones are folded into a summary of one short excerpt line
+    per turn, which drops its oldest lines beyond max_summary_chars. What is restored into an agent, and so the prompt,
+    stays bounded however long the conversation gets.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversation_turns (
+            session TEXT NOT NULL,
+            turn INTEGER NOT NULL,
+            user_message TEXT NOT NULL,
+            agent_response TEXT NOT NULL,
+            created REAL NOT NULL,
+            PRIMARY KEY (session, turn)
+        );
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            session TEXT PRIMARY KEY,
+            summary TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, filename: str, max_turns: int, max_message_chars: int, max_summary_chars: int):
+        self.filename = filename
+        self.max_turns = max(max_turns, 1)
+        self.max_message_chars = max_message_chars
+        self.max_summary_chars = max_summary_chars
+        self._conn = connect_sqlite(filename, isolation_level=None)
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()  # serializes use of the connection
+
+        self.loads = 0
+        self.appends = 0
+        self.compactions = 0
+        self.expirations = 0
+
+    @contextlib.contextmanager
+    def _immediate_transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+
+    def fold(self, summary: str, turns: list) -> str:
+        """Add one excerpt line per (user message, agent response) turn to summary, keeping it under max_summary_chars."""
+        lines = summary.splitlines() if summary else []
+        lines += [f"User: {excerpt(user_message, CONVERSATION_SUMMARY_EXCERPT_CHARS)} | "
+                  f"Agent: {excerpt(agent_response, CONVERSATION_SUMMARY_EXCERPT_CHARS)}"
+                  for user_message, agent_response in turns]
+        while lines and sum(len(line) + 1 for line in lines) > self.max_summary_chars:
+            lines.pop(0)
+        return "\n".join(lines)
+
+    def _load(self, session: str) -> dict:
+        with self._lock:
+            row = self._conn.execute("SELECT summary FROM conversation_summaries WHERE session = ?", (session,)).fetchone()
+            turns = self._conn.execute("SELECT user_message, agent_response FROM conversation_turns WHERE session = ? "
+                                       "ORDER BY turn", (session,)).fetchall()
+        self.loads += 1
+        return {"summary": row[0] if row else None, "turns": turns}
+
+    def _append(self, session: str, user_message: str, agent_response: str):
+        with self._immediate_transaction():
+            last_turn, count = self._conn.execute(
+                "SELECT COALESCE(MAX(turn), 0), COUNT(*) FROM conversation_turns WHERE session = ?", (session,)).fetchone()
+            self._conn.execute(
+                "INSERT INTO conversation_turns (session, turn, user_message, agent_response, created) "
+                "VALUES (?, ?, ?, ?, ?)", (session, last_turn + 1, user_message[:self.max_message_chars],
+                                           agent_response[:self.max_message_chars], time.time()))
+            overflow = count + 1 - self.max_turns
+            if overflow > 0:
+                oldest = self._conn.execute(
+                    "SELECT turn, user_message, agent_response FROM conversation_turns WHERE session = ? "
+                    "ORDER BY turn LIMIT ?", (session, overflow)).fetchall()
+                row = self._conn.execute(
+                    "SELECT summary FROM conversation_summaries WHERE session = ?", (session,)).fetchone()
+                summary = self.fold(row[0] if row else "", [(user, agent) for _, user, agent in oldest])
+                self._conn.execute("INSERT OR REPLACE INTO conversation_summaries (session, summary) VALUES (?, ?)",
+                                   (session, summary))
+                self._conn.execute("DELETE FROM conversation_turns WHERE session = ? AND turn <= ?",
+                                   (session, oldest[-1][0]))
+                self.compactions += 1
+        self.appends += 1
+
+    def _forget(self, session: str) -> bool:
+        with self._immediate_transaction():
+            deleted = self._conn.execute("DELETE FROM conversation_turns WHERE session = ?", (session,)).rowcount
+            self._conn.execute("DELETE FROM conversation_summaries WHERE session = ?", (session,))
+        return deleted > 0
+
+    def _sweep(self, max_age: float) -> int:
+        with self._immediate_transaction():
+            expired = [row[0] for row in self._conn.execute(
+                "SELECT session FROM conversation_turns GROUP BY session HAVING MAX(created) < ?",
+                (time.time() - max_age,))]
+            self._conn.executemany("DELETE FROM conversation_turns WHERE session = ?", [(s,) for s in expired])
+            self._conn.executemany("DELETE FROM conversation_summaries WHERE session = ?", [(s,) for s in expired])
+        self.expirations += len(expired)
+        return len(expired)
+
+    async def load(self, session: str) -> dict:
+        """{"summary": summary of older turns or None, "turns": [(user message, agent response)], oldest first}"""
+        return await asyncio.to_thread(self._load, session)
+
+    async def append(self, session: str, user_message: str, agent_response: str):
+        await asyncio.to_thread(self._append, session, user_message, agent_response)
+
+    async def forget(self, session: str) -> bool:
+        return await asyncio.to_thread(self._forget, session)
+
+    async def sweep(self, max_age: float) -> int:
+        """Delete the conversations idle for more than max_age seconds. Returns the number deleted."""
+        return await asyncio.to_thread(self._sweep, max_age)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            sessions, turns = self._conn.execute(
+                "SELECT COUNT(DISTINCT session), COUNT(*) FROM conversation_turns").fetchone()
+        return {"path": self.filename, "sessions": sessions, "turns": turns, "loads": self.loads,
+                "appends": self.appends, "compactions": self.compactions, "expirations": self.expirations}
+
+
+def create_conversation_store() -> Optional[SqliteConversationStore]:
+    """
+    Build the conversation store, or return None if CONVERSATION_MEMORY_ENABLED=0, in which case each session's
+    conversation lives only in the agent leased to it.
+    """
+    if not CONVERSATION_MEMORY_ENABLED:
+        return None
+    store = SqliteConversationStore(CONVERSATION_MEMORY_PATH, max_turns=CONVERSATION_MEMORY_MAX_TURNS,
+                                    max_message_chars=CONVERSATION_MEMORY_MAX_MESSAGE_CHARS,
+                                    max_summary_chars=CONVERSATION_MEMORY_SUMMARY_MAX_CHARS)
+    atexit.register(store.close)
+    return store
+
+
+def restore_agent_memory(agent: Agent, history: dict):
+    """
+    Replace the agent's chat memory with a session's stored conversation: the summary of older turns as a system
+    message, then the recent turns as user and assistant messages.
+    """
+    memory = getattr(agent, "memory", None)
+    if memory is None:
+        logging.getLogger("uvicorn.error").warning("Agent has no memory to restore the session's conversation into")
+        return
+    messages = []
+    if history["summary"]:
+        messages.append(ChatMessage(role=MessageRole.SYSTEM,
+                                    content=f"Summary of the earlier conversation with this user:\n{history['summary']}"))
+    for user_message, agent_response in history["turns"]:
+        messages.append(ChatMessage(role=MessageRole.USER, content=user_message))
+        messages.append(ChatMessage(role=MessageRole.ASSISTANT, content=agent_response))
+    memory.set(messages)
+
+
+class AgentCallQueueFull(Exception):
+    """Raised when every agent worker is busy and the wait queue is full."""
+
+
+class BoundedAgentExecutor:
+    """
+    Runs blocking Agent calls on a fixed-size thread pool so they don't stall the uvicorn event loop.
+    At most max_workers calls run at once and at most max_queue_depth wait for a worker; anything
+    beyond that is rejected immediately with AgentCallQueueFull instead of piling up.
+    """
+
+    def __init__(self, max_workers: int, max_queue_depth: int, timeout: float):
+        self.max_workers = max_workers
+        self.max_queue_depth = max_queue_depth
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="agent-call")
+        # One slot per running or waiting call. Released from the worker thread when the call really finishes,
+        # so a call that timed out keeps holding its slot until the agent is done with it.
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue_depth)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of agent calls currently running or waiting for a worker."""
+        return self._pending
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+        self._slots.release()
+
+    def submit(self, fn, *args) -> Future:
+        """
+        Start fn(*args) on the worker pool and return its future, which is only done once the call has really
+        finished. The call holds its slot until then. Raises AgentCallQueueFull if there is no room.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise AgentCallQueueFull(f"{self.max_workers} agent calls running and {self.max_queue_depth} waiting")
+
+        with self._lock:
+            self._pending += 1
+        try:
+            # Run in a copy of the caller's context so request-scoped context vars (e.g. current_rag_result)
+            # are visible to the agent's callbacks on the worker thread
+            future = self._executor.submit(contextvars.copy_context().run, fn, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    async def wait(self, future: Future):
+        """
+        Await the result of a submitted call, raising asyncio.TimeoutError if it takes longer than timeout.
+        A call still waiting for a worker is cancelled on timeout, but a running one can't be stopped: it keeps
+        running, and using whatever it was given, until future is done.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout=self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise
+
+    async def run(self, fn, *args):
+        """
+        Run fn(*args) on the worker pool and await its result; submit() and wait() in one step.
+        Raises AgentCallQueueFull if there is no room, or asyncio.TimeoutError if the call takes longer than timeout.
+        The call may still be running after a timeout, so a caller that lends it something it must get back (an agent)
+        should submit() instead, and hold on to it until the future is done.
+        """
+        return await self.wait(self.submit(fn, *args))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class AgentPool:
+    """
+    Leases agents to sessions.
+    Claiming is constant time: a dict maps session -> lease, a free-list holds unclaimed agents, and the leases
+    are kept in least-recently-used order so an idle lease past lease_ttl can be reclaimed from the head. A lease is
+    in use while a use() block or a held worker call is running on its agent, even past a timeout.
+    Reclaimed and released agents have their memory reset before being handed to another session.
+
+    Agents are built lazily by agent_factory the first time a slot is claimed (or by prewarm), on a worker thread
+    so construction never blocks the event loop. Free slots with an already-built agent are handed out first.
+
+    With reclaim_idle, sessions' conversations are kept outside the agents, so when every agent is leased, the least
+    recently used idle lease (one whose agent calls have all finished) is reclaimed right away instead of after
+    lease_ttl, popped from a least-recently-used dict of the idle leases. The pool can then serve many more sessions
+    than it has agents. A lease only becomes idle once used, so it is not taken between acquire() and use().
+    """
+
+    def __init__(self, agent_factory, size: int, lease_ttl: float, reclaim_idle: bool = False):
+        self.lease_ttl = lease_ttl
+        self.reclaim_idle = reclaim_idle
+        self._agent_factory = agent_factory
+        self._agents = [{"agent": None, "session": None, "building": None} for _ in range(size)]
+        self._free_built = deque()
+        self._free_unbuilt = deque(range(size))
+        self._leases = OrderedDict()  # {session: lease}, least recently used first
+        self._idle = OrderedDict()  # {session: lease} of the idle leases, least recently used first
+        self._waiters = deque()
+
+        self._claims = 0
+        self._reclaims = 0
+        self._releases = 0
+        self._rejections = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    @property
+    def size(self) -> int:
+        return len(self._agents)
+
+    @property
+    def built(self) -> int:
+        return sum(1 for entry in self._agents if entry["agent"] is not None)
+
+    @property
+    def leased(self) -> int:
+        return len(self._leases)
+
+    async def _ensure_built(self, index: int) -> Agent:
+        """Return the agent in this slot, building it on a worker thread if needed."""
+        entry = self._agents[index]
+        if entry["agent"] is not None:
+            return entry["agent"]
+
+        if entry["building"] is None:
+            logging.getLogger("uvicorn.error").info(f"Building agent {index}")
+            entry["building"] = asyncio.get_running_loop().run_in_executor(None, self._agent_factory)
+        try:
+            entry["agent"] = await entry["building"]
+        finally:
+            entry["building"] = None
+        return entry["agent"]
+
+    def _push_free(self, index: int):
+        if self._agents[index]["agent"] is not None:
+            self._free_built.append(index)
+        else:
+            self._free_unbuilt.append(index)
+        self._wake_waiter()
+
+    def _wake_waiter(self):
+        """Wake the oldest waiter that is still waiting."""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def _is_expired(self, lease: dict, now: float) -> bool:
+        return lease["in_flight"] == 0 and now - lease["last_used"] >= self.lease_ttl
+
+    def _reclaimable(self, now: float):
+        """(session, lease) of the least recently used lease that can be reclaimed now, or None."""
+        if self.reclaim_idle and self._idle:
+            return next(iter(self._idle.items()))
+        session, lease = next(iter(self._leases.items()))
+        return (session, lease) if self._is_expired(lease, now) else None
+
+    def _drop_lease(self, session: str) -> dict:
+        self._idle.pop(session, None)
+        return self._leases.pop(session)
+
+    def _reset_agent(self, agent: Optional[Agent]):
+        logger = logging.getLogger("uvicorn.error")
+        clear_memory = getattr(agent, "clear_memory", None)
+        if clear_memory:
+            try:
+                clear_memory()
+            except Exception as e:
+                logger.error(f"Could not reset agent memory: {e}", exc_info=True)
+
+    def _free_lease(self, lease: dict):
+        entry = self._agents[lease["index"]]
+        self._reset_agent(entry["agent"])
+        entry["session"] = None
+        self._push_free(lease["index"])
+
+    def _claim(self, session: str, now: float) -> Optional[dict]:
+        lease = self._leases.get(session)
+        if lease:
+            self._leases.move_to_end(session)
+            self._idle.pop(session, None)
+            lease["last_used"] = now
+            lease["idle"] = False
+            return lease
+
+        if not self._free_built and not self._free_unbuilt and self._leases:
+            reclaimable = self._reclaimable(now)
+            if reclaimable:
+                lru_session, lru_lease = reclaimable
+                logging.getLogger("uvicorn.error").info(
+                    f"Reclaiming agent {lru_lease['index']} from idle session {lru_session}")
+                self._drop_lease(lru_session)
+                self._reclaims += 1
+                self._free_lease(lru_lease)
+
+        if self._free_built:
+            index = self._free_built.popleft()
+        elif self._free_unbuilt:
+            index = self._free_unbuilt.popleft()
+        else:
+            return None
+
+        self._agents[index]["session"] = session
+        lease = {
+            "index": index,
+            "session": session,
+            "agent": self._agents[index]["agent"],
+            "last_used": now,
+            "in_flight": 0,  # use() blocks and held worker calls not yet finished
+            "held": 0,
+            "unlock_pending": False,
+            "idle": False,
+            "lock": asyncio.Lock(),
+        }
+        self._leases[session] = lease
+        self._claims += 1
+        logging.getLogger("uvicorn.error").info(f"Reserving agent {index} for session {session}")
+        return lease
+
+    def _seconds_until_next_expiry(self, now: float) -> float:
+        for lease in self._leases.values():
+            if lease["in_flight"] == 0:
+                return max(lease["last_used"] + self.lease_ttl - now, 0.0)
+        return self.lease_ttl
+
+    async def acquire(self, session: str, timeout: float = 0) -> Optional[dict]:
+        """
+        Return the lease for this session, claiming a free agent if it has none.
+        Waits up to timeout seconds for an agent to be released or to expire; returns None if none became free.
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        lease = self._claim(session, start)
+
+        while lease is None:
+            now = time.monotonic()
+            remaining = deadline - now
+            if remaining <= 0:
+                self._rejections += 1
+                return None
+
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, timeout=min(remaining, self._seconds_until_next_expiry(now)))
+            except asyncio.TimeoutError:
+                pass
+            lease = self._claim(session, time.monotonic())
+
+        if lease["agent"] is None:
+            try:
+                lease["agent"] = await self._ensure_built(lease["index"])
+            except Exception:
+                # Give the slot back unbuilt so a later claim can retry construction
+                if self._leases.get(session) is lease:
+                    del self._leases[session]
+                    self._agents[lease["index"]]["session"] = None
+                    self._push_free(lease["index"])
+                raise
+
+        waited = time.monotonic() - start
+        self._waits += 1
+        self._wait_total += waited
+        self._wait_max = max(self._wait_max, waited)
+        return lease
+
+    @contextlib.asynccontextmanager
+    async def use(self, lease: dict):
+        """
+        Mark the lease as in use for the duration of an agent call, so it is never reclaimed mid-call.
+        Calls from the same session are serialized since an agent's memory is not safe to share.
+        Worker calls passed to hold() inside the block keep the lease in use, and the session's next call waiting,
+        after the block exits until they finish.
+        """
+        lease["in_flight"] += 1
+        lease["idle"] = False
+        if self._idle.get(lease["session"]) is lease:
+            del self._idle[lease["session"]]
+        try:
+            await lease["lock"].acquire()
+        except BaseException:
+            self._done(lease)
+            raise
+        try:
+            yield lease["agent"]
+        finally:
+            if lease["held"]:
+                lease["unlock_pending"] = True
+            else:
+                lease["lock"].release()
+            self._done(lease)
+
+    def hold(self, lease: dict, future):
+        """
+        Keep the lease in use until future, a call given its agent inside use() (a worker call's Future or an
+        asyncio task awaiting it), has finished.
+        """
+        lease["in_flight"] += 1
+        lease["held"] += 1
+        asyncio.wrap_future(future).add_done_callback(lambda _future: self._release_hold(lease))
+
+    def _release_hold(self, lease: dict):
+        lease["held"] -= 1
+        if not lease["held"] and lease["unlock_pending"]:
+            lease["unlock_pending"] = False
+            lease["lock"].release()
+        self._done(lease)
+
+    def _done(self, lease: dict):
+        """A use() block or held call of the lease finished; once none are left, the lease is idle."""
+        lease["in_flight"] -= 1
+        lease["last_used"] = time.monotonic()
+        if lease["in_flight"]:
+            return
+        if self._leases.get(lease["session"]) is not lease:
+            # Released while its calls were running; the agent is only free now
+            self._free_lease(lease)
+            return
+        lease["idle"] = True
+        self._leases.move_to_end(lease["session"])
+        self._idle[lease["session"]] = lease
+        # A waiting session can reclaim the lease now
+        if self.reclaim_idle:
+            self._wake_waiter()
+
+    async def prewarm(self, floor: int):
+        """Build free agents one at a time until at least floor agents exist."""
+        logger = logging.getLogger("uvicorn.error")
+        while self.built < min(floor, self.size) and self._free_unbuilt:
+            index = self._free_unbuilt.popleft()
+            try:
+                await self._ensure_built(index)
+            except Exception as e:
+                logger.error(f"Pre-warming agent {index} failed: {e}", exc_info=True)
+                self._push_free(index)
+                return
+            self._push_free(index)
+        logger.info(f"Agent pool pre-warmed: {self.built}/{self.size} agents built")
+
+    def release(self, session: str) -> bool:
+        """
+        Release the agent held by this session. Returns False if the session held no agent.
+        An agent with calls still running is only freed once they finish.
+        """
+        if session not in self._leases:
+            return False
+        lease = self._drop_lease(session)
+        self._releases += 1
+        if not lease["in_flight"]:
+            self._free_lease(lease)
+        logging.getLogger("uvicorn.error").info(f"Released agent {lease['index']} from session {session}")
+        return True
+
+    def sweep(self) -> int:
+        """Reclaim every idle lease past lease_ttl. Returns the number of agents reclaimed."""
+        now = time.monotonic()
+        reclaimed = 0
+        while self._leases:
+            session, lease = next(iter(self._leases.items()))
+            if not self._is_expired(lease, now):
+                break
+            self._drop_lease(session)
+            self._reclaims += 1
+            self._free_lease(lease)
+            reclaimed += 1
+        return reclaimed
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "leased": self.leased,
+            "idle": len(self._idle),
+            "built": self.built,
+            "free": len(self._free_built) + len(self._free_unbuilt),
+            "waiting": sum(1 for waiter in self._waiters if not waiter.done()),
+            "claims": self._claims,
+            "reclaims": self._reclaims,
+            "releases": self._releases,
+            "rejections": self._rejections,
+            "avg_wait_ms": round(1000 * self._wait_total / self._waits, 3) if self._waits else 0.0,
+            "max_wait_ms": round(1000 * self._wait_max, 3),
+        }
+
+
+class RagResponseCache:
+    """
+    Caches RAG tool outputs (response text, FCS score and citations) keyed on the normalized query,
+    with a TTL and LRU eviction.
+    When similarity_threshold > 0, a query with no exact match is served from the most similar cached query
+    if their cosine similarity (over hashed character trigrams) is at least the threshold.
+
+    Tool calls run on agent worker threads, so every access takes the lock.
+    """
+
+    EMBEDDING_BUCKETS = 4096
+
+    def __init__(self, max_entries: int, ttl: float, similarity_threshold: float = 0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # {normalized query: {"value", "expires", "embedding"}}, least recently used first
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+    @classmethod
+    def embed(cls, normalized_query: str) -> dict:
+        """L2-normalized sparse vector of hashed character trigrams."""
+        counts = {}
+        padded = f" {normalized_query} "
+        for i in range(len(padded) - 2):
+            bucket = zlib.crc32(padded[i:i + 3].encode("utf-8")) % cls.EMBEDDING_BUCKETS
+            counts[bucket] = counts.get(bucket, 0) + 1
+        norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+        return {bucket: count / norm for bucket, count in counts.items()}
+
+    @staticmethod
+    def _similarity(a: dict, b: dict) -> float:
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(weight * b.get(bucket, 0.0) for bucket, weight in a.items())
+
+    def get(self, query: str):
+        key = self.normalize(query)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires"] <= now:
+                del self._entries[key]
+                entry = None
+            if entry:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["value"]
+
+            if self.similarity_threshold > 0 and self._entries:
+                embedding = self.embed(key)
+                best_key, best_score = None, self.similarity_threshold
+                for cached_key, cached in self._entries.items():
+                    if cached["expires"] <= now:
+                        continue
+                    score = self._similarity(embedding, cached["embedding"])
+                    if score >= best_score:
+                        best_key, best_score = cached_key, score
+                if best_key is not None:
+                    self._entries.move_to_end(best_key)
+                    self.similar_hits += 1
+                    return self._entries[best_key]["value"]
+
+            self.misses += 1
+            return None
+
+    def put(self, query: str, value):
+        key = self.normalize(query)
+        embedding = self.embed(key) if self.similarity_threshold > 0 else None
+        with self._lock:
+            self._entries[key] = {"value": value, "expires": time.monotonic() + self.ttl, "embedding": embedding}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self) -> int:
+        """Drop every cached entry, e.g. after the corpus changed. Returns the number of entries dropped."""
+        with self._lock:
+            dropped = len(self._entries)
+            self._entries.clear()
+            self.invalidations += 1
+        logging.getLogger("uvicorn.error").info(f"RAG response cache invalidated; dropped {dropped} entries")
+        return dropped
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.similar_hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "similar_hits": self.similar_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.similar_hits) / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+def install_rag_cache(tool, cache: RagResponseCache):
+    """
+    Serve the tool's call/acall from the cache, keyed on its 'query' argument.
+    Only the RAG tool is wrapped; account and Jira answers are per-user and must never be cached.
+    """
+    call, acall = tool.call, tool.acall
+
+    def query_arg(args, kwargs) -> str:
+        return str(kwargs.get("query", args[0] if args else ""))
+
+    def cacheable(output) -> bool:
+        return output is not None and not getattr(output, "is_error", False)
+
+    def cached_call(*args, **kwargs):
+        query = query_arg(args, kwargs)
+        output = cache.get(query)
+        if output is None:
+            output = call(*args, **kwargs)
+            if cacheable(output):
+                cache.put(query, output)
+        return output
+
+    async def cached_acall(*args, **kwargs):
+        query = query_arg(args, kwargs)
+        output = cache.get(query)
+        if output is None:
+            output = await acall(*args, **kwargs)
+            if cacheable(output):
+                cache.put(query, output)
+        return output
+
+    tool.call = cached_call
+    tool.acall = cached_acall
+
+
+def format_citation(doc_data: dict, index: int) -> dict:
+    return {
+        "title": doc_data.get('title', f'Document {index+1}'), # Use index as fallback title
+        "snippet": doc_data.get('text') or doc_data.get('snippet'),
+        "url": doc_data.get('url')
+    }
+
+
+def extract_rag_result(raw_output) -> Optional[dict]:
+    """
+    Pull the FCS score and cited documents straight out of the RAG tool's structured raw_output.
+    Handles the dict the Vectara RAG tool returns as well as llama-index Response objects with source_nodes.
+    Returns None when nothing usable is found, so the caller can fall back to parsing the output text.
+    """
+    fcs = None
+    documents = []
+
+    if isinstance(raw_output, dict):
+        metadata = raw_output.get("metadata") or {}
+        for source in (raw_output, metadata):
+            for key in ("fcs_score", "fcs"):
+                if fcs is None and source.get(key) is not None:
+                    fcs = source.get(key)
+        docs = raw_output.get("documents") or metadata.get("documents") or raw_output.get("references_metadata")
+        if isinstance(docs, dict):
+            docs = list(docs.values())
+        if isinstance(docs, list):
+            documents = docs
+    else:
+        metadata = getattr(raw_output, "metadata", None) or {}
+        fcs = metadata.get("fcs_score", metadata.get("fcs"))
+        for node in getattr(raw_output, "source_nodes", None) or []:
+            node_metadata = dict(getattr(node, "metadata", None) or {})
+            node_metadata.setdefault("text", getattr(node, "text", None))
+            documents.append(node_metadata)
+
+    citations = []
+    for i, doc in enumerate(documents):
+        if isinstance(doc, dict) and isinstance(doc.get("document"), (dict, str)):
+            doc = {**doc, **doc["document"]} if isinstance(doc["document"], dict) else doc["document"]
+        if isinstance(doc, str):
+            try:
+                doc = json.loads(doc)
+            except ValueError:
+                continue
+        if isinstance(doc, dict):
+            citations.append(format_citation(doc, i))
+
+    try:
+        fcs = float(fcs) if fcs is not None else None
+    except (TypeError, ValueError):
+        fcs = None
+
+    if fcs is None and not citations:
+        return None
+    return {"fcs_score": fcs, "citations": citations}
+
+
+def install_rag_result_capture(tool):
+    """
+    Capture the RAG tool's FCS score and citations as objects when the tool returns, into the calling request's
+    current_rag_result, so agent_progress_callback doesn't have to re-parse the stringified TOOL_OUTPUT.
+    """
+    call, acall = tool.call, tool.acall
+
+    def capture(output):
+        rag_result = current_rag_result.get()
+        if rag_result is None:
+            return
+        captured = extract_rag_result(getattr(output, "raw_output", None))
+        rag_result["structured"] = captured is not None
+        if captured:
+            rag_result.update(captured)
+
+    def capturing_call(*args, **kwargs):
+        output = call(*args, **kwargs)
+        capture(output)
+        return output
+
+    async def capturing_acall(*args, **kwargs):
+        output = await acall(*args, **kwargs)
+        capture(output)
+        return output
+
+    tool.call = capturing_call
+    tool.acall = capturing_acall
+
+
+def install_tool_tracing(tool):
+    """Time each call of the tool as a 'tool.<name>' span of the calling request's trace."""
+    call, acall = tool.call, tool.acall
+    span_name = f"tool.{tool.metadata.name}"
+
+    def traced_call(*args, **kwargs):
+        with tracer.span(span_name):
+            return call(*args, **kwargs)
+
+    async def traced_acall(*args, **kwargs):
+        with tracer.span(span_name):
+            return await acall(*args, **kwargs)
+
+    tool.call = traced_call
+    tool.acall = traced_acall
+    return tool
+
+
+def install_tool_metrics(tool):
+    """Count each call of the tool and its latency in the agent_tool_call_* metrics."""
+    call, acall = tool.call, tool.acall
+    name = tool.metadata.name
+
+    def measured_call(*args, **kwargs):
+        start, outcome = time.perf_counter(), "error"
+        try:
+            result = call(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            tool_call_duration.observe(time.perf_counter() - start, name)
+            tool_calls_total.inc(name, outcome)
+
+    async def measured_acall(*args, **kwargs):
+        start, outcome = time.perf_counter(), "error"
+        try:
+            result = await acall(*args, **kwargs)
+            outcome = "ok"
+            return result
+        finally:
+            tool_call_duration.observe(time.perf_counter() - start, name)
+            tool_calls_total.inc(name, outcome)
+
+    tool.call = measured_call
+    tool.acall = measured_acall
+    return tool
+
+
+def traced_agent_chat(agent: Agent, message: str, submitted: float, history: Optional[dict] = None):
+    """
+    Runs on an agent worker thread: agent.chat, recording the time spent waiting for the worker and the LLM
+    reasoning after the last tool output (the reasoning before each tool call is recorded by agent_progress_callback).
+    The session's stored conversation, if given, is restored into the agent first.
+    """
+    tracer.record("agent.queue_wait", submitted)
+    if history is not None:
+        with tracer.span("memory.restore", turns=len(history["turns"])):
+            restore_agent_memory(agent, history)
+    tracer.mark()
+    response = agent.chat(message)
+    tracer.record("llm.reasoning", tracer.mark(), final=True)
+    return response
+
+
+def parse_rag_output_text(msg: str) -> Optional[dict]:
     """
-    Callback using REGEX to parse FCS & Citations (from document=...) from TOOL_OUTPUT msg.
+    Fallback: REGEX parse FCS & Citations (from document=...) out of a stringified TOOL_OUTPUT msg.
+    Returns None if neither could be found.
     """
-    global last_rag_result
     logger = logging.getLogger("uvicorn.error")
-    # Reduced preview length for general logging
-    logger.info(f"Agent Progress: Type={status_type}, Msg Preview='{msg[:100]}...'") 
+    logger.info(f"Attempting REGEX parsing on TOOL_OUTPUT msg (len={len(msg)})") # Removed redundant preview
 
     fcs = None
     citations_list = []
     parsing_successful = False
 
+    try:
+        # --- REGEX Definitions ---
+        # Pattern to find fcs_score (Updated: removed quotes around key)
+        fcs_pattern = r"fcs_score:\s*([0-9]+\.?[0-9]*)"
+        # Pattern to find all document dictionary strings: document='{...}'
+        doc_pattern = r"document='({.*?})'"
+        # ---
+
+        # Find FCS Score
+        fcs_match = re.search(fcs_pattern, msg)
+        if fcs_match:
+            fcs_str = fcs_match.group(1)
+            try:
+                fcs = float(fcs_str)
+                logger.info(f"REGEX extracted fcs_score: {fcs}")
+                parsing_successful = True
+            except ValueError:
+                logger.error(f"Could not convert extracted FCS string '{fcs_str}' to float.")
+        else:
+            logger.warning("REGEX could not find fcs_score pattern in TOOL_OUTPUT msg.")
+
+        # Find and Parse All Citations
+        document_dict_strings = re.findall(doc_pattern, msg)
+        if document_dict_strings:
+            logger.info(f"REGEX found {len(document_dict_strings)} document dictionary strings.")
+            temp_citations = []
+            for i, dict_str in enumerate(document_dict_strings):
+                try:
+                    # Use ast.literal_eval to safely parse the dictionary string
+                    doc_data = ast.literal_eval(dict_str)
+                    if isinstance(doc_data, dict):
+                        temp_citations.append(format_citation(doc_data, i))
+                    else:
+                        logger.error(f"Parsed document string #{i+1} is not a dict: {type(doc_data)}")
+                except (ValueError, SyntaxError, TypeError) as eval_err:
+                    logger.error(f"Could not parse document string #{i+1} with literal_eval: {eval_err} | String: {dict_str[:200]}...", exc_info=True)
+
+            if temp_citations: # Only assign if we successfully parsed at least one
+                citations_list = temp_citations
+                parsing_successful = True
+                logger.info(f"Successfully parsed {len(citations_list)} citations from document strings.")
+        else:
+            logger.warning("REGEX could not find any document='{...}' patterns in TOOL_OUTPUT msg.")
+
+    except Exception as e:
+        logger.error(f"Unexpected error during REGEX parsing in callback: {e}", exc_info=True)
+
+    if not parsing_successful:
+        return None
+    return {"fcs_score": fcs, "citations": citations_list}
+
+
+def agent_progress_callback(status_type: AgentStatusType, msg: str):
+    """
+    Forwards agent progress to a streaming client and records FCS & Citations for the calling request.
+    FCS & Citations normally arrive as objects via install_rag_result_capture; the TOOL_OUTPUT text is only
+    parsed when that capture found nothing.
+    """
+    logger = logging.getLogger("uvicorn.error")
+    # Reduced preview length for general logging
+    logger.info("Agent Progress: Type=%s, Msg Preview='%.100s...'", status_type, msg)
+
+    # The LLM reasoned from the last tool output (or the start of the call) until it decided on this tool call
+    if status_type == AgentStatusType.TOOL_CALL:
+        tracer.record("llm.reasoning", tracer.mark())
+    elif status_type == AgentStatusType.TOOL_OUTPUT:
+        tracer.mark()
+
+    # Forward progress to a streaming client, if this request has one
+    event_sink = current_event_sink.get()
+    if event_sink:
+        if status_type == AgentStatusType.TOOL_CALL:
+            event_sink("tool_call", {"message": msg})
+        elif status_type == AgentStatusType.TOOL_OUTPUT:
+            event_sink("tool_output", {"message": msg[:STREAM_TOOL_OUTPUT_PREVIEW_CHARS]})
+        else:
+            event_sink("agent_update", {"status": str(status_type), "message": msg})
+
     if status_type == AgentStatusType.TOOL_OUTPUT:
-        # --- ADDED DETAILED LOGGING FOR RAW TOOL OUTPUT ---
-        logger.info(f"<<< RAW TOOL_OUTPUT MSG START >>>\n{msg}\n<<< RAW TOOL_OUTPUT MSG END >>>")
-        # --------------------------------------------------
+        # Raw tool output is tens of KB, so it is only dumped for sampled requests
+        if current_log_raw.get():
+            logger.info("<<< RAW TOOL_OUTPUT MSG START >>>\n%s\n<<< RAW TOOL_OUTPUT MSG END >>>", msg,
+                        extra=RAW_DUMP_LOG_EXTRA)
+
+        rag_result = current_rag_result.get()
+        if rag_result is None:
+            logger.warning("TOOL_OUTPUT received outside of a request context; dropping FCS/Citations.")
+            return
+
+        if rag_result.get("structured"):
+            # Already captured as objects when the RAG tool returned
+            logger.info(f"Using structured RAG result: FCS={rag_result['fcs_score']}, Citations={len(rag_result['citations'])}")
+            return
+
+        with tracer.span("callback.parse", chars=len(msg)):
+            parsed = parse_rag_output_text(msg)
+
+        # Update this request's result based on regex parsing results
+        if parsed:
+            rag_result.update(parsed)
+            logger.info(f"Callback updated request RAG result (via REGEX v2): FCS={parsed['fcs_score']}, Citations={len(parsed['citations'])}")
+        else:
+            # Reset if regex failed completely to avoid stale data
+            rag_result["fcs_score"] = None
+            rag_result["citations"] = []
+            logger.warning("REGEX parsing failed to find FCS or Citations; resetting request RAG result.")
+
+OFF_TOPIC_KEYWORDS = [
+    "i don't have the information",
+    "i don't have enough information",
+    "i cannot answer questions about",
+    "i couldn't find information about",
+    "looking for about", # From pizza example
+]
+OFF_TOPIC_REDIRECTION_SUFFIX = ". If you have a question about EchoStor products or services, please feel free to ask."
+
+
+def add_off_topic_redirection(response_text: str) -> str:
+    """Append a redirection back to EchoStor topics when the agent could not answer."""
+    # Check if the lowercase response contains any of the keywords
+    is_off_topic_or_unknown = any(keyword in response_text.lower() for keyword in OFF_TOPIC_KEYWORDS)
+    chat_responses_total.inc("true" if is_off_topic_or_unknown else "false")
+
+    # Append only if it's not already there
+    if is_off_topic_or_unknown and not response_text.endswith(OFF_TOPIC_REDIRECTION_SUFFIX):
+        logging.getLogger("uvicorn.error").info("Appended redirection suffix to off-topic/unknown response.")
+        return response_text + OFF_TOPIC_REDIRECTION_SUFFIX
+    return response_text
+
+
+class SupportTopicRouter:
+    """
+    Picks the support queue for /live-agent-lookup from a session's recent messages, without an LLM call.
 
-        logger.info(f"Attempting REGEX parsing on TOOL_OUTPUT msg (len={len(msg)})") # Removed redundant preview
+    Each message scores the topics by their keyword hits, and older messages count less (LIVE_AGENT_ROUTING_DECAY per
+    message), so the topic discussed most recently wins. The confidence is the winning topic's share of all the
+    scores; route returns no topic, so the caller falls back to asking the agent, when the total score is below
+    LIVE_AGENT_ROUTING_MIN_SCORE or the confidence is below min_confidence.
+    """
 
-        try:
-            # --- REGEX Definitions ---
-            # Pattern to find fcs_score (Updated: removed quotes around key)
-            fcs_pattern = r"fcs_score:\s*([0-9]+\.?[0-9]*)"
-            # Pattern to find all document dictionary strings: document='{...}'
-            doc_pattern = r"document='({.*?})'"
-            # ---
-
-            # Find FCS Score
-            fcs_match = re.search(fcs_pattern, msg)
-            if fcs_match:
-                fcs_str = fcs_match.group(1)
-                try:
-                    fcs = float(fcs_str)
-                    logger.info(f"REGEX extracted fcs_score: {fcs}")
-                    parsing_successful = True
-                except ValueError:
-                    logger.error(f"Could not convert extracted FCS string '{fcs_str}' to float.")
+    def __init__(self, topic_keywords: dict, history: int, max_sessions: int, min_confidence: float):
+        self.history = history
+        self.max_sessions = max_sessions
+        self.min_confidence = min_confidence
+        self._patterns = {
+            topic: re.compile(r"(?<![\w/])(?:" + "|".join(re.escape(keyword) for keyword in sorted(keywords, key=len, reverse=True))
+                              + r")(?![\w/])")
+            for topic, keywords in topic_keywords.items()
+        }
+        self._sessions = OrderedDict()  # {session: deque of (weight, {topic: hits})}, least recently used first
+
+        self.routed = 0
+        self.fallbacks = 0
+
+    def score_text(self, text: str) -> dict:
+        text = text.lower()
+        return {topic: hits for topic, pattern in self._patterns.items() if (hits := len(pattern.findall(text)))}
+
+    def record(self, session: str, text: str, weight: float = 1.0):
+        """Add a message of the session's conversation (user messages weigh 1, agent answers less)."""
+        if not session or not text:
+            return
+        messages = self._sessions.get(session)
+        if messages is None:
+            messages = self._sessions[session] = deque(maxlen=self.history)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session)
+        messages.append((weight, self.score_text(text)))
+
+    def scores(self, session: str) -> dict:
+        totals = dict.fromkeys(self._patterns, 0.0)
+        messages = self._sessions.get(session) or ()
+        for age, (weight, hits) in enumerate(reversed(messages)):
+            for topic, count in hits.items():
+                totals[topic] += weight * count * LIVE_AGENT_ROUTING_DECAY ** age
+        return totals
+
+    def route(self, session: str):
+        """Return (topic, confidence), with topic None when the classifier is not confident enough."""
+        totals = self.scores(session)
+        total = sum(totals.values())
+        topic = max(totals, key=totals.get)
+        confidence = totals[topic] / total if total else 0.0
+        if total < LIVE_AGENT_ROUTING_MIN_SCORE or confidence < self.min_confidence:
+            self.fallbacks += 1
+            return None, confidence
+        self.routed += 1
+        return topic, confidence
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._sessions), "routed": self.routed, "fallbacks": self.fallbacks}
+
+
+def format_sse(event: str, data: dict) -> str:
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_agent_chat(agent: Agent, message: str, rag_result: dict, event_sink, history: Optional[dict] = None) -> str:
+    """
+    Runs on an agent worker thread: streams the agent's answer token by token into event_sink and returns the full text.
+    Falls back to a single token event for agents without stream_chat. Restores history into the agent first, if given.
+    """
+    current_rag_result.set(rag_result)
+    current_event_sink.set(event_sink)
+    if history is not None:
+        with tracer.span("memory.restore", turns=len(history["turns"])):
+            restore_agent_memory(agent, history)
+    tracer.mark()
+
+    try:
+        stream_chat = getattr(agent, "stream_chat", None)
+        if stream_chat is None:
+            response_text = str(agent.chat(message).response)
+            event_sink("token", {"text": response_text})
+            return response_text
+
+        streaming_response = stream_chat(message)
+        response_gen = getattr(streaming_response, "response_gen", None)
+        if response_gen is None:
+            response_text = str(getattr(streaming_response, "response", streaming_response))
+            event_sink("token", {"text": response_text})
+            return response_text
+
+        tokens = []
+        for token in response_gen:
+            tokens.append(token)
+            event_sink("token", {"text": token})
+        return "".join(tokens)
+    finally:
+        tracer.record("llm.reasoning", tracer.mark(), final=True)
+
+
+class MemoryOtpStore:
+    """
+    In-memory OTP store with a hard capacity. Expiry times are kept in a min-heap, so sweeping expired codes and
+    evicting the code closest to expiry when full are O(log n). Heap entries of overwritten or removed codes are
+    skipped lazily. The methods are async to match RedisOtpStore.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = {}  # {email: {"otp", "expiry"}}
+        self._expiry_heap = []  # [(expiry, email)]
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop_heap_entry(self) -> Optional[str]:
+        """Pop the heap until it yields a live entry; return its email (removed from the store) or None."""
+        while self._expiry_heap:
+            expiry, email = heapq.heappop(self._expiry_heap)
+            entry = self._entries.get(email)
+            if entry and entry["expiry"] == expiry:
+                del self._entries[email]
+                return email
+        return None
+
+    async def put(self, email: str, otp: str, expiry: datetime):
+        self._entries[email] = {"otp": otp, "expiry": expiry}
+        heapq.heappush(self._expiry_heap, (expiry, email))
+        while len(self._entries) > self.max_entries and self._pop_heap_entry():
+            self.evictions += 1
+        # Don't let stale heap entries of overwritten codes outgrow the live ones
+        if len(self._expiry_heap) > 2 * max(len(self._entries), 1024):
+            self._expiry_heap = [(entry["expiry"], email) for email, entry in self._entries.items()]
+            heapq.heapify(self._expiry_heap)
+
+    async def pop(self, email: str) -> Optional[dict]:
+        """Remove and return the code issued to this email (even if expired), or None."""
+        return self._entries.pop(email, None)
+
+    async def sweep(self) -> int:
+        """Drop every expired code. Returns the number dropped."""
+        now = datetime.now(timezone.utc)
+        swept = 0
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            if self._pop_heap_entry():
+                swept += 1
+        self.expirations += swept
+        return swept
+
+    def stats(self) -> dict:
+        return {"backend": "memory", "size": len(self._entries), "max_entries": self.max_entries,
+                "evictions": self.evictions, "expirations": self.expirations}
+
+
+class RedisOtpStore:
+    """
+    OTP store shared between uvicorn workers through Redis, so any worker can verify a code another one issued.
+    Redis expires the keys itself, so sweep is a no-op.
+    """
+
+    KEY_PREFIX = "otp:"
+
+    def __init__(self, url: str):
+        import redis.asyncio
+        self._redis = redis.asyncio.from_url(url)
+
+    async def put(self, email: str, otp: str, expiry: datetime):
+        ttl = max(int((expiry - datetime.now(timezone.utc)).total_seconds()), 1)
+        await self._redis.set(self.KEY_PREFIX + email, json.dumps({"otp": otp, "expiry": expiry.isoformat()}), ex=ttl)
+
+    async def pop(self, email: str) -> Optional[dict]:
+        value = await self._redis.getdel(self.KEY_PREFIX + email)
+        if value is None:
+            return None
+        entry = json.loads(value)
+        return {"otp": entry["otp"], "expiry": datetime.fromisoformat(entry["expiry"])}
+
+    async def sweep(self) -> int:
+        return 0
+
+    def stats(self) -> dict:
+        return {"backend": "redis"}
+
+
+class SqliteOtpStore:
+    """
+    OTP store in a local SQLite file, shared by the worker processes of one host without an outside service.
+    pop deletes and returns the code in one statement, so a code can only be verified once across workers.
+    The size stats() reports is counted by each sweep, so stats() and /metrics scrapes never query from the event loop.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS otps (
+            email TEXT PRIMARY KEY,
+            otp TEXT NOT NULL,
+            expiry REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS otps_expiry ON otps (expiry);
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._conn = connect_sqlite(filename, isolation_level=None)
+        self._conn.executescript(self.SCHEMA)
+        self._lock = threading.Lock()  # serializes use of the connection
+        self.expirations = 0
+        self.size = None  # codes stored as of the last sweep, None before the first one
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    async def put(self, email: str, otp: str, expiry: datetime):
+        await asyncio.to_thread(self._execute, "INSERT OR REPLACE INTO otps (email, otp, expiry) VALUES (?, ?, ?)",
+                                (email, otp, expiry.timestamp()))
+
+    async def pop(self, email: str) -> Optional[dict]:
+        def delete_returning():
+            with self._lock:
+                return self._conn.execute("DELETE FROM otps WHERE email = ? RETURNING otp, expiry", (email,)).fetchone()
+
+        row = await asyncio.to_thread(delete_returning)
+        if row is None:
+            return None
+        return {"otp": row[0], "expiry": datetime.fromtimestamp(row[1], timezone.utc)}
+
+    async def sweep(self) -> int:
+        def delete_expired():
+            with self._lock:
+                swept = self._conn.execute("DELETE FROM otps WHERE expiry <= ?",
+                                           (datetime.now(timezone.utc).timestamp(),)).rowcount
+                return swept, self._conn.execute("SELECT COUNT(*) FROM otps").fetchone()[0]
+
+        swept, self.size = await asyncio.to_thread(delete_expired)
+        self.expirations += swept
+        return swept
+
+    def stats(self) -> dict:
+        return {"backend": "sqlite", "path": self.filename, "size": self.size, "expirations": self.expirations}
+
+
+def create_otp_store():
+    """
+    Build the OTP store: shared between workers through Redis (redis://...) or a SQLite file (sqlite:///path) if
+    OTP_STORE_URL is set, otherwise in-memory.
+    """
+    if OTP_STORE_URL and OTP_STORE_URL.startswith("sqlite:///"):
+        logging.getLogger("uvicorn.error").info("OTP codes are stored in SQLite, shared between workers")
+        return SqliteOtpStore(OTP_STORE_URL[len("sqlite:///"):])
+    if OTP_STORE_URL:
+        logging.getLogger("uvicorn.error").info("OTP codes are stored in Redis, shared between workers")
+        return RedisOtpStore(OTP_STORE_URL)
+    return MemoryOtpStore(max_entries=OTP_STORE_MAX_ENTRIES)
+
+
+class TokenBucketRateLimiter:
+    """
+    Per-key token buckets: each key may make up to burst calls at once, refilled at per_minute tokens a minute.
+    Buckets are kept in least-recently-used order and capped at max_keys, so a flood of new keys can't grow memory.
+    """
+
+    def __init__(self, burst: int, per_minute: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # {key: [tokens, last refill time]}, least recently used first
+
+        self.rejections = 0
+
+    def acquire(self, key: str) -> float:
+        """Take a token for key. Returns 0 if allowed, otherwise the seconds until a token is available."""
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [float(self.burst), now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return 0.0
+        self.rejections += 1
+        return (1 - bucket[0]) / self.rate if self.rate > 0 else float("inf")
+
+
+class OtpSendError(Exception):
+    """Raised by a mail transport when a batch could not be sent. retryable=False means retrying won't help."""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class SendGridMailTransport:
+    """
+    Sends a batch of OTP emails with a single SendGrid API call: one personalization per recipient, each
+    substituting its own code into the shared body.
+    """
+
+    def __init__(self, api_key: str, from_email: str):
+        from sendgrid import SendGridAPIClient
+        self.from_email = from_email
+        self._client = SendGridAPIClient(api_key)
+
+    def send(self, messages: List[dict]):
+        from sendgrid.helpers.mail import Mail, To
+        mail = Mail(
+            from_email=self.from_email,
+            to_emails=[To(message["email"], substitutions={OTP_SUBSTITUTION_TAG: message["otp"]}) for message in messages],
+            subject=OTP_EMAIL_SUBJECT,
+            html_content=OTP_EMAIL_HTML,
+            is_multiple=True
+        )
+        response = self._client.send(mail)
+        if not 200 <= response.status_code < 300:
+            raise OtpSendError(f"SendGrid error: {response.status_code} - {response.body}",
+                               retryable=response.status_code == 429 or response.status_code >= 500)
+
+
+class StubMailTransport:
+    """
+    Records OTP emails instead of sending them, after a simulated latency. For local testing and benchmarks.
+    failure_rate is the fraction of batches that fail with a retryable error.
+    """
+
+    def __init__(self, latency: float = 0.0, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = deque(maxlen=1000)
+        self.batches = 0
+
+    def send(self, messages: List[dict]):
+        if self.latency:
+            time.sleep(self.latency)
+        if self.failure_rate and random.random() < self.failure_rate:
+            raise OtpSendError("Simulated stub transport failure")
+        self.sent.extend(messages)
+        self.batches += 1
+
+
+def create_mail_transport():
+    """Build the OTP mail transport named by OTP_MAIL_TRANSPORT, or None if it isn't configured."""
+    logger = logging.getLogger("uvicorn.error")
+    if OTP_MAIL_TRANSPORT == "stub":
+        logger.info(f"OTP emails go to the stub mail transport (latency {OTP_STUB_LATENCY_SECONDS}s)")
+        return StubMailTransport(latency=OTP_STUB_LATENCY_SECONDS)
+
+    sendgrid_api_key = os.getenv("SENDGRID_API_KEY")
+    sendgrid_from_email = os.getenv("SENDGRID_FROM_EMAIL")
+    if not sendgrid_api_key or not sendgrid_from_email:
+        logger.warning("SENDGRID_API_KEY or SENDGRID_FROM_EMAIL environment variables not set. OTP sending will fail.")
+        return None
+    return SendGridMailTransport(sendgrid_api_key, sendgrid_from_email)
+
+
+class OtpSendQueue:
+    """
+    Delivers OTP emails in the background so /otp/send can return as soon as the code is stored.
+    Worker tasks take up to batch_size queued emails at a time and hand them to the (blocking) mail transport on a
+    small thread pool. A failed batch is retried with exponential backoff up to max_attempts; the status of every
+    recent delivery can be looked up by its delivery id.
+    """
+
+    def __init__(self, transport, workers: int, batch_size: int, max_attempts: int, retry_backoff: float):
+        self.transport = transport
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self._queue = None
+        self._tasks = []
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="otp-send")
+        self._deliveries = OrderedDict()  # {delivery_id: status}, oldest first
+
+        self._sent = 0
+        self._failed = 0
+        self._retries = 0
+        self._batches = 0
+        self._batched_messages = 0
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def enqueue(self, email: str, otp_code: str) -> str:
+        """Queue an OTP email and return its delivery id."""
+        delivery_id = uuid.uuid4().hex
+        self._deliveries[delivery_id] = {"delivery_id": delivery_id, "status": "queued", "attempts": 0,
+                                         "error": None, "updated": time.time()}
+        while len(self._deliveries) > OTP_DELIVERY_STATUS_MAX_ENTRIES:
+            self._deliveries.popitem(last=False)
+        self._queue.put_nowait({"delivery_id": delivery_id, "email": email, "otp": otp_code})
+        return delivery_id
+
+    def status(self, delivery_id: str) -> Optional[dict]:
+        return self._deliveries.get(delivery_id)
+
+    def _update(self, message: dict, status: str, error: Optional[str] = None):
+        delivery = self._deliveries.get(message["delivery_id"])
+        if delivery:
+            delivery.update(status=status, error=error, updated=time.time())
+            if status == "sending":
+                delivery["attempts"] += 1
+
+    async def _worker(self):
+        logger = logging.getLogger("uvicorn.error")
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            for message in batch:
+                self._update(message, "sending")
+            self._batches += 1
+            self._batched_messages += len(batch)
+            try:
+                await loop.run_in_executor(self._executor, self.transport.send, batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._retry_or_fail(batch, e)
             else:
-                logger.warning("REGEX could not find fcs_score pattern in TOOL_OUTPUT msg.")
-
-            # Find and Parse All Citations
-            document_dict_strings = re.findall(doc_pattern, msg)
-            if document_dict_strings:
-                logger.info(f"REGEX found {len(document_dict_strings)} document dictionary strings.")
-                temp_citations = []
-                for i, dict_str in enumerate(document_dict_strings):
-                    try:
-                        # Use ast.literal_eval to safely parse the dictionary string
-                        doc_data = ast.literal_eval(dict_str)
-                        if isinstance(doc_data, dict):
-                            # Format the citation
-                            temp_citations.append({
-                                "title": doc_data.get('title', f'Document {i+1}'), # Use index as fallback title
-                                "snippet": doc_data.get('text') or doc_data.get('snippet'),
-                                "url": doc_data.get('url')
-                            })
-                        else:
-                            logger.error(f"Parsed document string #{i+1} is not a dict: {type(doc_data)}")
-                    except (ValueError, SyntaxError, TypeError) as eval_err:
-                        logger.error(f"Could not parse document string #{i+1} with literal_eval: {eval_err} | String: {dict_str[:200]}...", exc_info=True)
-                
-                if temp_citations: # Only assign if we successfully parsed at least one
-                    citations_list = temp_citations
-                    parsing_successful = True
-                    logger.info(f"Successfully parsed {len(citations_list)} citations from document strings.")
+                self._sent += len(batch)
+                for message in batch:
+                    self._update(message, "sent")
+                logger.info(f"Sent a batch of {len(batch)} OTP emails")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _retry_or_fail(self, batch: List[dict], error: Exception):
+        logger = logging.getLogger("uvicorn.error")
+        retryable = getattr(error, "retryable", None)
+        if retryable is None:
+            # e.g. python_http_client errors raised by SendGrid carry the HTTP status
+            status_code = getattr(error, "status_code", None)
+            retryable = status_code is None or status_code == 429 or status_code >= 500
+
+        loop = asyncio.get_running_loop()
+        for message in batch:
+            attempts = self._deliveries.get(message["delivery_id"], {}).get("attempts", self.max_attempts)
+            if retryable and attempts < self.max_attempts:
+                delay = self.retry_backoff * (2 ** (attempts - 1)) * (1 + random.random() / 2)
+                self._update(message, "retrying", str(error))
+                self._retries += 1
+                loop.call_later(delay, self._queue.put_nowait, message)
             else:
-                logger.warning("REGEX could not find any document='{...}' patterns in TOOL_OUTPUT msg.")
+                self._update(message, "failed", str(error))
+                self._failed += 1
+        logger.error(f"Sending a batch of {len(batch)} OTP emails failed (retryable={retryable}): {error}")
 
-        except Exception as e:
-            logger.error(f"Unexpected error during REGEX parsing in callback: {e}", exc_info=True)
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "sent": self._sent,
+            "failed": self._failed,
+            "retries": self._retries,
+            "batches": self._batches,
+            "avg_batch_size": round(self._batched_messages / self._batches, 2) if self._batches else 0.0,
+        }
 
-        # Update global store based on regex parsing results
-        if parsing_successful:
-            last_rag_result["fcs_score"] = fcs
-            last_rag_result["citations"] = citations_list
-            logger.info(f"Callback updated last_rag_result (via REGEX v2): FCS={fcs}, Citations={len(citations_list)}")
-        else:
-            # Reset if regex failed completely to avoid stale data
-            last_rag_result["fcs_score"] = None
-            last_rag_result["citations"] = []
-            logger.warning("REGEX parsing failed to find FCS or Citations; resetting global store.")
 
-def create_app(agents: list, config: AgentConfig) -> FastAPI:
+def current_rss_mb() -> float:
+    """Resident set size of this process in MB (peak RSS where /proc is not available)."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and KB on Linux
+        return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+def create_app(agent_factory, config: AgentConfig) -> FastAPI:
     """
     Create a FastAPI application with a chat endpoint.
+    Agents are created on demand by agent_factory (a no-argument callable returning an Agent).
+
+    The agent pool, OTP store, send queue and topic router built here are only used from the event loop thread, so
+    they take no locks. Anything agent worker threads touch (account store, metrics, tracer) is thread-safe.
     """
     app = FastAPI()
     origins = [
@@ -303,18 +2357,115 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
     logging.basicConfig(level=logging.INFO)
     endpoint_api_key = config.endpoint_api_key
 
-    # Load SendGrid details from environment
-    SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
-    SENDGRID_FROM_EMAIL = os.getenv("SENDGRID_FROM_EMAIL")
-
-    if not SENDGRID_API_KEY or not SENDGRID_FROM_EMAIL:
-        logger.warning("SENDGRID_API_KEY or SENDGRID_FROM_EMAIL environment variables not set. OTP sending will fail.")
-        # Optionally raise an error here if OTP is critical
-        # raise ValueError("SendGrid API Key and From Email must be set in environment variables.")
-
-    @app.post("/otp/send", summary="Generate and send an OTP via email")
-    async def send_otp(request: SendOtpRequest):
-        if not SENDGRID_API_KEY or not SENDGRID_FROM_EMAIL:
+    # Installed at startup, once uvicorn has set up its own log handlers
+    async_logging = AsyncLogging(max_queue=LOG_QUEUE_MAX_RECORDS, max_message_chars=LOG_MAX_MESSAGE_CHARS,
+                                 enabled=LOG_ASYNC)
+
+    @app.on_event("startup")
+    async def start_async_logging():
+        async_logging.start()
+        logger.info(f"Logging pipeline: {async_logging.stats()}, raw dump sample rate {LOG_RAW_SAMPLE_RATE}")
+
+    @app.on_event("shutdown")
+    async def stop_async_logging():
+        async_logging.stop()
+
+    metrics.counter_callback("agent_log_records_dropped_total", "Log records dropped because the log queue was full",
+                             lambda: async_logging.dropped)
+    metrics.counter_callback("agent_log_raw_dumps_total", "Chat requests whose raw agent output was dumped to the log",
+                             lambda: raw_dump_sampler.sampled)
+
+    @app.middleware("http")
+    async def trace_requests(request: Request, call_next):
+        """Trace every request, correlated by its session header, and count it in the HTTP metrics."""
+        start, status_code = time.perf_counter(), 500
+        with tracer.trace(f"{request.method} {request.url.path}",
+                          correlation_id=request.headers.get("session")) as root:
+            try:
+                response = await call_next(request)
+                status_code = response.status_code
+            finally:
+                # Label by route template, not raw path, so unknown paths can't blow up the label set
+                route = request.scope.get("route")
+                route_path = route.path if route is not None else "unmatched"
+                http_request_duration.observe(time.perf_counter() - start, request.method, route_path)
+                http_requests_total.inc(request.method, route_path, str(status_code))
+            if root is not None:
+                if route is not None:
+                    root["name"] = f"{request.method} {route_path}"
+                root["attributes"]["status_code"] = status_code
+            return response
+
+    agent_executor = BoundedAgentExecutor(max_workers=AGENT_WORKERS, max_queue_depth=AGENT_MAX_QUEUE_DEPTH,
+                                          timeout=AGENT_CHAT_TIMEOUT_SECONDS)
+    logger.info(f"Agent calls run on {AGENT_WORKERS} workers (queue depth {AGENT_MAX_QUEUE_DEPTH}, "
+                f"timeout {AGENT_CHAT_TIMEOUT_SECONDS}s)")
+
+    @app.on_event("shutdown")
+    async def shutdown_agent_executor():
+        agent_executor.shutdown()
+
+    async def run_agent_chat(lease: dict, message: str, history: Optional[dict] = None):
+        """
+        Run the lease's agent.chat off the event loop, translating a full queue into 503 and a timeout into 504.
+        The session's stored conversation, if given, is restored into the agent first. Call inside agent_pool.use:
+        a call that times out keeps the lease until it finishes.
+        """
+        try:
+            with tracer.span("agent.chat"):
+                future = agent_executor.submit(traced_agent_chat, lease["agent"], message, time.perf_counter(), history)
+                agent_pool.hold(lease, future)
+                return await agent_executor.wait(future)
+        except AgentCallQueueFull as e:
+            logger.warning(f"Rejecting agent call, executor is full: {e}")
+            raise HTTPException(status_code=503, detail="All agents are busy. Please try again shortly.")
+        except asyncio.TimeoutError:
+            logger.error(f"Agent call timed out after {AGENT_CHAT_TIMEOUT_SECONDS}s")
+            raise HTTPException(status_code=504, detail="The agent took too long to respond.")
+
+    # OTP emails are delivered in the background by worker tasks, through a pluggable mail transport
+    mail_transport = create_mail_transport()
+    otp_send_queue = None
+    if mail_transport:
+        otp_send_queue = OtpSendQueue(mail_transport, workers=OTP_SEND_WORKERS, batch_size=OTP_SEND_BATCH_SIZE,
+                                      max_attempts=OTP_SEND_MAX_ATTEMPTS, retry_backoff=OTP_SEND_RETRY_BACKOFF_SECONDS)
+
+    @app.on_event("startup")
+    async def start_otp_send_queue():
+        if otp_send_queue:
+            otp_send_queue.start()
+
+    @app.on_event("shutdown")
+    async def stop_otp_send_queue():
+        if otp_send_queue:
+            await otp_send_queue.stop()
+
+    otp_store = create_otp_store()
+    otp_email_limiter = TokenBucketRateLimiter(burst=OTP_SEND_EMAIL_BURST, per_minute=OTP_SEND_EMAIL_PER_MINUTE)
+    otp_ip_limiter = TokenBucketRateLimiter(burst=OTP_SEND_IP_BURST, per_minute=OTP_SEND_IP_PER_MINUTE)
+
+    async def sweep_otp_store():
+        # Sweeps once at startup too, so a SQLite store's size is known from the first scrape
+        while True:
+            swept = await otp_store.sweep()
+            if swept:
+                logger.info(f"Swept {swept} expired OTP codes; store stats: {otp_store.stats()}")
+            await asyncio.sleep(OTP_SWEEP_INTERVAL_SECONDS)
+
+    @app.on_event("startup")
+    async def start_otp_store_sweeper():
+        app.state.otp_store_sweeper = asyncio.create_task(sweep_otp_store())
+
+    def check_otp_rate_limit(limiter: TokenBucketRateLimiter, key: str, what: str):
+        retry_after = limiter.acquire(key)
+        if retry_after:
+            logger.warning(f"Rate limiting /otp/send for {what} {key}")
+            raise HTTPException(status_code=429, detail="Too many OTP requests. Please try again later.",
+                                headers={"Retry-After": str(math.ceil(retry_after))})
+
+    @app.post("/otp/send", summary="Generate an OTP and queue it for delivery via email")
+    async def send_otp(request: SendOtpRequest, http_request: Request):
+        if not otp_send_queue:
              raise HTTPException(status_code=500, detail="Server configuration error: SendGrid not configured.")
 
         email = request.email
@@ -322,42 +2473,48 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
         if "@" not in email or "." not in email.split("@")[-1]:
              raise HTTPException(status_code=400, detail="Invalid email format provided.")
 
+        check_otp_rate_limit(otp_ip_limiter, http_request.client.host if http_request.client else "unknown", "IP")
+        check_otp_rate_limit(otp_email_limiter, email.lower(), "email")
+
         try:
             # Generate OTP
             otp_code = "".join(random.choices(string.digits, k=6))
             expiry_time = datetime.now(timezone.utc) + timedelta(minutes=OTP_EXPIRY_MINUTES)
 
             # Store OTP (overwrite if exists for the same email)
-            otp_storage[email] = {"otp": otp_code, "expiry": expiry_time}
+            await otp_store.put(email, otp_code, expiry_time)
             logger.info(f"Generated OTP {otp_code} for {email}, expires at {expiry_time.isoformat()}")
 
-            # Prepare email
-            message = Mail(
-                from_email=SENDGRID_FROM_EMAIL,
-                to_emails=email,
-                subject='Your EchoStor Support Verification Code',
-                html_content=f'<strong>Your verification code is: {otp_code}</strong><br>This code will expire in {OTP_EXPIRY_MINUTES} minutes.'
-            )
-
-            # Send email
-            sg = SendGridAPIClient(SENDGRID_API_KEY)
-            response = sg.send(message) 
-            # Note: sendgrid library might not be inherently async, consider thread executor if blocking
-            # Example using thread executor (requires `anyio` or similar):
-            # from anyio import to_thread
-            # response = await to_thread.run_sync(sg.client.mail.send.post, request_body=message.get())
-
-            logger.info(f"SendGrid response status code: {response.status_code} for sending OTP to {email}")
-            if 200 <= response.status_code < 300:
-                 return {"message": "OTP sent successfully."}
-            else:
-                 logger.error(f"SendGrid error: {response.status_code} - {response.body}")
-                 raise HTTPException(status_code=500, detail="Failed to send OTP email.")
+            # Hand the email to the background send queue; delivery can be followed via /otp/status
+            delivery_id = otp_send_queue.enqueue(email, otp_code)
+            return {"message": "OTP sent successfully.", "delivery_id": delivery_id}
 
         except Exception as e:
-            logger.error(f"Error sending OTP to {email}: {e}", exc_info=True)
+            logger.error(f"Error queuing OTP for {email}: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail="Internal server error during OTP sending.")
 
+    @app.get("/otp/status/{delivery_id}", summary="Delivery status of a queued OTP email")
+    async def otp_status(delivery_id: str, api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        status = otp_send_queue.status(delivery_id) if otp_send_queue else None
+        if not status:
+            raise HTTPException(status_code=404, detail="Unknown OTP delivery id.")
+        return status
+
+    @app.get("/otp/stats", summary="OTP send queue counters")
+    async def otp_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        stats = otp_send_queue.stats() if otp_send_queue else {"enabled": False}
+        stats["store"] = otp_store.stats()
+        stats["rate_limited"] = {"email": otp_email_limiter.rejections, "ip": otp_ip_limiter.rejections}
+        return stats
+
     @app.post("/otp/verify", summary="Verify an OTP code")
     async def verify_otp(request: VerifyOtpRequest):
         email = request.email
@@ -366,7 +2523,8 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
         if not email or not submitted_otp:
              raise HTTPException(status_code=400, detail="Email and OTP code are required.")
 
-        stored_data = otp_storage.get(email)
+        # Always remove OTP after first verification attempt
+        stored_data = await otp_store.pop(email)
 
         if not stored_data:
             logger.warning(f"OTP verification attempt for unknown email: {email}")
@@ -376,9 +2534,6 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
         expiry_time = stored_data["expiry"]
         is_valid = False
         error_detail = "Invalid OTP."
-
-        # Always remove OTP after first verification attempt
-        del otp_storage[email]
         logger.info(f"Removed OTP for {email} after verification attempt.")
 
         if datetime.now(timezone.utc) > expiry_time:
@@ -397,32 +2552,109 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
             raise HTTPException(status_code=400, detail=error_detail)
 
 
-    def get_free_agent(session: str):
-        free_agent = None
+    # With conversations stored outside the agents, any free agent can continue any session
+    conversation_store = create_conversation_store()
+    if conversation_store:
+        logger.info(f"Conversation memory in {CONVERSATION_MEMORY_PATH} (last {CONVERSATION_MEMORY_MAX_TURNS} turns "
+                    f"verbatim, older ones summarized)")
+
+    agent_pool = AgentPool(agent_factory, size=NUM_AGENTS, lease_ttl=AGENT_LEASE_TTL_SECONDS,
+                           reclaim_idle=conversation_store is not None)
+    logger.info(f"Agent pool holds up to {agent_pool.size} agents (lease TTL {AGENT_LEASE_TTL_SECONDS}s, "
+                f"pre-warming {AGENT_POOL_PREWARM})")
+
+    async def sweep_agent_leases():
+        while True:
+            await asyncio.sleep(max(min(AGENT_LEASE_TTL_SECONDS / 2, 60), 1))
+            reclaimed = agent_pool.sweep()
+            if reclaimed:
+                logger.info(f"Reclaimed {reclaimed} idle agents; pool stats: {agent_pool.stats()}")
+
+    async def sweep_conversations():
+        while True:
+            await asyncio.sleep(max(min(CONVERSATION_MEMORY_TTL_SECONDS / 2, 3600), 1))
+            try:
+                expired = await conversation_store.sweep(CONVERSATION_MEMORY_TTL_SECONDS)
+            except sqlite3.Error as e:
+                logger.error(f"Could not sweep the conversation store: {e}")
+                continue
+            if expired:
+                logger.info(f"Deleted {expired} conversations idle for over {CONVERSATION_MEMORY_TTL_SECONDS}s")
+
+    @app.on_event("startup")
+    async def start_agent_pool_tasks():
+        app.state.agent_lease_sweeper = asyncio.create_task(sweep_agent_leases())
+        if conversation_store:
+            app.state.conversation_sweeper = asyncio.create_task(sweep_conversations())
+        if AGENT_POOL_PREWARM > 0:
+            app.state.agent_prewarm = asyncio.create_task(agent_pool.prewarm(AGENT_POOL_PREWARM))
+        logger.info(f"Server ready in {time.perf_counter() - BOOT_STARTED:.2f}s, RSS {current_rss_mb():.1f} MB")
+
+    async def get_free_agent(session: str) -> dict:
+        """Return the agent lease for this session, raising 503 if no agent can be claimed."""
+        with tracer.span("agent.claim"):
+            lease = await agent_pool.acquire(session, timeout=AGENT_CLAIM_TIMEOUT_SECONDS)
+        if not lease:
+            logger.error(f"No free agents to handle this session; pool stats: {agent_pool.stats()}")
+            raise HTTPException(status_code=503, detail="No free agents to handle this session")
+        return lease
+
+    async def chat_in_session(lease: dict, message: str):
+        """
+        Run message through the session's agent, continuing the session's stored conversation, and store the new turn.
+        """
+        async with agent_pool.use(lease):
+            history = None
+            if conversation_store:
+                with tracer.span("memory.load"):
+                    history = await conversation_store.load(lease["session"])
+            response_object = await run_agent_chat(lease, message, history)
+            # Stored before the agent is released, so the session's next call and any reclaim see this turn
+            if conversation_store:
+                with tracer.span("memory.append"):
+                    await conversation_store.append(lease["session"], message, str(response_object.response))
+        return response_object
+
+    @app.post("/session/release", summary="Release the agent held by a session, and forget its conversation")
+    async def release_session(api_key: str = Depends(api_key_header), session: str = Depends(session_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
 
-        # See if an existing agent has already been used for this session
-        for i in range(5):
-            agent_entry = agents[i]
-            if agent_entry.get("session") == session:
-                free_agent = agent_entry["agent"]
-                logger.info(f"Using agent {i} which was already claimed for session {agent_entry['session']}")
-                break
+        released = agent_pool.release(session)
+        if conversation_store:
+            await conversation_store.forget(session)
+        return {"released": released}
+
+    @app.get("/conversations/stats", summary="Stored conversation memory")
+    async def conversation_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
 
-        # If we don't have an agent yet for this session see if there is a free one
-        if not free_agent:
-            for i in range(5):
-                agent_entry = agents[i]
-                if not agent_entry.get("session"):
-                    agent_entry["session"] = session
-                    free_agent = agent_entry["agent"]
-                    logger.info(f"Reserving agent {i} for session {agent_entry['session']}")
-                    break
+        if not conversation_store:
+            return {"enabled": False}
+        return {"enabled": True, **await asyncio.to_thread(conversation_store.stats)}
 
-        if not free_agent:
-            logger.error("No free agents to handle this session")
-            raise HTTPException(status_code=400, detail="No free agents to handle this session")
+    @app.get("/pool/stats", summary="Agent pool occupancy and wait-time metrics")
+    async def pool_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return agent_pool.stats()
 
-        return free_agent
+    support_topic_router = SupportTopicRouter(SUPPORT_TOPIC_KEYWORDS, history=LIVE_AGENT_ROUTING_HISTORY,
+                                              max_sessions=LIVE_AGENT_ROUTING_MAX_SESSIONS,
+                                              min_confidence=LIVE_AGENT_ROUTING_MIN_CONFIDENCE)
+
+    @app.get("/routing/stats", summary="How often /live-agent-lookup was routed without asking the agent")
+    async def routing_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return support_topic_router.stats()
 
 
     @app.get("/live-agent-lookup", summary="Return the name and ID of a live agent to chat with")
@@ -435,8 +2667,6 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
             logger.warning("Unauthorized access attempt")
             raise HTTPException(status_code=403, detail="Unauthorized")
 
-        free_agent = get_free_agent(session)
-
         if not email:
             return {
                 "code": 404,
@@ -446,10 +2676,30 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
                 "message": "You mush authenticate before chatting with a live agent."
             }
 
-        response_object = free_agent.chat(f"live agent chat lookup {email}")
+        # Fast path: pick the queue from the conversation so far, without an agent call
+        with tracer.span("routing.classify"):
+            topic, confidence = support_topic_router.route(session)
+        if topic:
+            live_agent = LIVE_AGENTS[topic]
+            logger.info(f"Routed session {session} to the {topic} queue (confidence {confidence:.2f})")
+            return {
+                "code": 200,
+                "name": live_agent["name"],
+                "id": live_agent["id"],
+                "channel": live_agent["channel"].split("@")[0],
+                "topic": topic,
+                "confidence": round(confidence, 3),
+                "message": f"{live_agent['name']} ({live_agent['id']}) from the {topic} support queue can help you "
+                           f"in channel {live_agent['channel']}."
+            }
+        logger.info(f"Topic classifier not confident for session {session} ({confidence:.2f}); asking the agent")
+
+        lease = await get_free_agent(session)
+
+        response_object = await chat_in_session(lease, f"live agent chat lookup {email}")
         response_text = str(response_object.response)
 
-        print("response text is: " + response_text)
+        logger.info("Live agent lookup response text: %s", response_text)
 
         live_agent_name = "Tony" if "tony" in response_text.lower() else (
             "Amr" if "amr" in response_text.lower() else (
@@ -475,7 +2725,7 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
                 "message": f"Could not determine the support queue and live agent details: {response_text}"
             }
 
-        print(f"live_agent_id is {live_agent_id}")
+        logger.info(f"live_agent_id is {live_agent_id}")
 
         # TODO this would need to change to match the zoom channel ID format
         #channel_pattern = r"[^a-zA-Z][a-zA-Z]+-channel-\d+"
@@ -484,7 +2734,7 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
         #print(f"channel_match is: {channel_match}")
         live_agent_channel = channel_match.group().strip() if channel_match else ""
 
-        print(f"live_agent_channel is {live_agent_channel}")
+        logger.info(f"live_agent_channel is {live_agent_channel}")
 
         return {
             "code": 200,
@@ -495,11 +2745,75 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
         }
 
 
+    # Occupancy gauges are read from the pool, executor and OTP store when /metrics is scraped
+    metrics.gauge_callback("agent_pool_size", "Agents the pool can hold", lambda: agent_pool.size)
+    metrics.gauge_callback("agent_pool_built", "Agents built so far", lambda: agent_pool.built)
+    metrics.gauge_callback("agent_pool_leased", "Agents leased to a session", lambda: agent_pool.leased)
+    metrics.gauge_callback("agent_pool_claim_waiters", "Sessions waiting for a free agent",
+                           lambda: agent_pool.stats()["waiting"])
+    metrics.counter_callback("agent_pool_rejections_total", "Sessions turned away because no agent was free",
+                             lambda: agent_pool.stats()["rejections"])
+    if conversation_store:
+        metrics.counter_callback("conversation_memory_appends_total", "Turns stored in conversation memory",
+                                 lambda: conversation_store.appends)
+        metrics.counter_callback("conversation_memory_compactions_total",
+                                 "Times a session's oldest turns were folded into its summary",
+                                 lambda: conversation_store.compactions)
+    metrics.gauge_callback("agent_calls_in_flight", "Agent calls running or waiting for an agent worker",
+                           lambda: agent_executor.pending)
+    metrics.gauge_callback("agent_call_capacity", "Agent calls that can run or wait at once before returning 503",
+                           lambda: agent_executor.max_workers + agent_executor.max_queue_depth)
+    metrics.gauge_callback("agent_otp_store_size",
+                           "OTP codes held by the OTP store, as of the last sweep for SQLite (not reported for Redis)",
+                           lambda: otp_store.stats().get("size"))
+
+    @app.get("/metrics", summary="Prometheus metrics in the text exposition format")
+    async def prometheus_metrics(api_key: Optional[str] = Depends(optional_api_key_header)):
+        if METRICS_REQUIRE_API_KEY and api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return Response(content=metrics.render(), media_type=METRICS_CONTENT_TYPE)
+
+    @app.get("/tracing/stats", summary="p50/p95/p99 latency of each traced span, over its most recent occurrences")
+    async def tracing_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return {"tracer": tracer.stats(), "spans": tracer.ring_buffer.latency_stats()}
+
+    @app.get("/tracing/recent", summary="Most recent spans, optionally only those of one session")
+    async def tracing_recent(limit: int = 100, correlation_id: Optional[str] = None,
+                             api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return tracer.ring_buffer.recent(limit=limit, correlation_id=correlation_id)
+
+    @app.get("/cache/stats", summary="RAG response cache hit/miss counters")
+    async def cache_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return rag_response_cache.stats() if rag_response_cache else {"enabled": False}
+
+    @app.post("/cache/invalidate", summary="Drop all cached RAG responses, e.g. after the corpus changed")
+    async def cache_invalidate(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        dropped = rag_response_cache.invalidate() if rag_response_cache else 0
+        return {"dropped": dropped}
+
     @app.post("/chat", summary="Chat with the agent")
     async def chat(request: ChatRequest, api_key: str = Depends(api_key_header), email: str = Depends(email_header),
                    session: str = Depends(session_header)):
         message = request.query  # Extract message from the JSON body
-        logger.info(f"Received message: {message}")
+        logger.info("Received message: %s", message)
         logger.info(f"Message from session: {session}")
         logger.info(f"Message from email: {email}") # Note: This is the email from the OTP step, not necessarily the one in the message
 
@@ -511,73 +2825,181 @@ def create_app(agents: list, config: AgentConfig) -> FastAPI:
             logger.error("No message provided in the request")
             raise HTTPException(status_code=400, detail="No message provided")
 
+        support_topic_router.record(session, message)
+
         # Proceed with finding/assigning an agent
-        free_agent = get_free_agent(session)
+        lease = await get_free_agent(session)
 
         # --- Default Agent Processing (if not handled above) ---
         try:
-            # Reset global result store BEFORE each call
-            global last_rag_result
-            last_rag_result = {"fcs_score": None, "citations": []}
-            logger.info("Reset last_rag_result before agent call.")
-
-            # Call agent.chat
-            response_object = free_agent.chat(message)
-
-            logger.info(f"Agent chat completed. Raw response text: {response_object.response}")
-            logger.info(f"Raw full response object: {response_object}")
-
-            # Retrieve results from the global variable (updated by callback during THIS call)
-            retrieved_fcs = last_rag_result.get("fcs_score")
-            retrieved_citations = last_rag_result.get("citations", [])
-            logger.info(f"Retrieved from global store: FCS={retrieved_fcs}, Citations={len(retrieved_citations)}")
-
-            response_text = str(response_object.response) # Get the initial text
-
-            # Add Redirection Logic for Off-Topic/Unknown Answers
-            off_topic_keywords = [
-                "i don't have the information",
-                "i don't have enough information",
-                "i cannot answer questions about",
-                "i couldn't find information about",
-                "looking for about", # From pizza example
-            ]
-            # Check if the lowercase response contains any of the keywords
-            is_off_topic_or_unknown = any(keyword in response_text.lower() for keyword in off_topic_keywords)
-
-            if is_off_topic_or_unknown:
-                redirection_suffix = ". If you have a question about EchoStor products or services, please feel free to ask."
-                # Append only if it's not already there
-                if not response_text.endswith(redirection_suffix):
-                    response_text += redirection_suffix
-                    logger.info("Appended redirection suffix to off-topic/unknown response.")
-            # End Redirection Logic
-
-            # Construct the final JSON response using potentially modified response_text
-            final_response = {
-                "response_text": response_text,
-                "fcs_score": retrieved_fcs,
-                "citations": retrieved_citations
-            }
-            logger.info(f"Returning final structured response: {final_response}")
+            # Fresh result channel for THIS request; the agent call runs in a copy of this context
+            rag_result = new_rag_result()
+            current_rag_result.set(rag_result)
+            current_log_raw.set(raw_dump_sampler.sample())
+
+            # Call agent.chat on the bounded worker pool so other requests keep being served
+            response_object = await chat_in_session(lease, message)
+
+            with tracer.span("response.assembly"):
+                logger.info("Agent chat completed. Raw response text: %s", response_object.response)
+                if current_log_raw.get():
+                    logger.info("Raw full response object: %s", response_object, extra=RAW_DUMP_LOG_EXTRA)
+
+                # Retrieve results written by the callback during THIS call
+                retrieved_fcs = rag_result.get("fcs_score")
+                retrieved_citations = rag_result.get("citations", [])
+                logger.info(f"Retrieved from request RAG result: FCS={retrieved_fcs}, Citations={len(retrieved_citations)}")
+                if retrieved_fcs is not None:
+                    fcs_score_histogram.observe(retrieved_fcs)
+
+                # Add Redirection Logic for Off-Topic/Unknown Answers
+                response_text = add_off_topic_redirection(str(response_object.response))
+                support_topic_router.record(session, response_text, weight=LIVE_AGENT_ROUTING_RESPONSE_WEIGHT)
+
+                # Construct the final JSON response using potentially modified response_text
+                final_response = {
+                    "response_text": response_text,
+                    "fcs_score": retrieved_fcs,
+                    "citations": retrieved_citations
+                }
+                logger.info("Returning final structured response: %s", LazyJson(final_response))
             return final_response
 
+        except HTTPException:
+            raise
         except Exception as e:
             logger.error(f"Error during agent processing: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail="Internal server error") from e
 
+    @app.post("/chat/stream", summary="Chat with the agent, streaming the answer as Server-Sent Events")
+    async def chat_stream(request: ChatRequest, api_key: str = Depends(api_key_header), email: str = Depends(email_header),
+                          session: str = Depends(session_header)):
+        """
+        Streams 'token' events while the agent generates, 'tool_call'/'tool_output'/'agent_update' events as the agent
+        works, then one 'final' event carrying response_text, fcs_score and citations (or an 'error' event).
+        """
+        message = request.query
+        logger.info("Received streaming message: %s", message)
+        logger.info(f"Message from session: {session}")
+
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        if not message:
+            logger.error("No message provided in the request")
+            raise HTTPException(status_code=400, detail="No message provided")
+
+        support_topic_router.record(session, message)
+        lease = await get_free_agent(session)
+
+        def log_abandoned_call_failure(agent_call: asyncio.Future):
+            # Reading the exception also keeps asyncio from reporting it as never retrieved
+            error = None if agent_call.cancelled() else agent_call.exception()
+            if error and not isinstance(error, asyncio.TimeoutError):
+                logger.error(f"Agent call of a disconnected stream failed: {error}")
+
+        async def event_stream():
+            loop = asyncio.get_running_loop()
+            events = asyncio.Queue()
+            rag_result = new_rag_result()
+            current_log_raw.set(raw_dump_sampler.sample())
+
+            def event_sink(event: str, data: dict):
+                loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+            async with agent_pool.use(lease) as free_agent:
+                history = None
+                if conversation_store:
+                    with tracer.span("memory.load"):
+                        history = await conversation_store.load(session)
+                try:
+                    future = agent_executor.submit(stream_agent_chat, free_agent, message, rag_result, event_sink,
+                                                   history)
+                except AgentCallQueueFull:
+                    yield format_sse("error", {"code": 503, "detail": "All agents are busy. Please try again shortly."})
+                    return
+                agent_pool.hold(lease, future)
+
+                async def finish_turn():
+                    response_text = await agent_executor.wait(future)
+                    if conversation_store:
+                        with tracer.span("memory.append"):
+                            await conversation_store.append(session, message, response_text)
+                    return response_text
+
+                # A task holding the lease, so the call is awaited and its turn stored even if the client disconnects
+                agent_call = asyncio.ensure_future(finish_turn())
+                agent_pool.hold(lease, agent_call)
+
+                # Relay events until the agent call finishes, then drain whatever is left
+                try:
+                    while not agent_call.done():
+                        next_event = asyncio.ensure_future(events.get())
+                        await asyncio.wait({next_event, agent_call}, return_when=asyncio.FIRST_COMPLETED)
+                        if next_event.done():
+                            yield format_sse(*next_event.result())
+                        else:
+                            next_event.cancel()
+                except BaseException:
+                    # The client went away: nobody reads agent_call's result
+                    agent_call.add_done_callback(log_abandoned_call_failure)
+                    raise
+                while not events.empty():
+                    yield format_sse(*events.get_nowait())
+
+                try:
+                    response_text = agent_call.result()
+                except asyncio.TimeoutError:
+                    yield format_sse("error", {"code": 504, "detail": "The agent took too long to respond."})
+                    return
+                except Exception as e:
+                    logger.error(f"Error during streaming agent processing: {e}", exc_info=True)
+                    yield format_sse("error", {"code": 500, "detail": "Internal server error"})
+                    return
+
+            support_topic_router.record(session, response_text, weight=LIVE_AGENT_ROUTING_RESPONSE_WEIGHT)
+            if rag_result.get("fcs_score") is not None:
+                fcs_score_histogram.observe(rag_result["fcs_score"])
+            yield format_sse("final", {
+                "response_text": add_off_topic_redirection(response_text),
+                "fcs_score": rag_result.get("fcs_score"),
+                "citations": rag_result.get("citations", [])
+            })
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
     return app
 
 
-def start_app(agents: list, host='0.0.0.0', port=8001):
+def start_app(agent_factory, host='0.0.0.0', port=8001):
     """
     Start the FastAPI server.
 
     Args:
+        agent_factory (callable): Creates a new Agent each time the pool needs one.
         host (str, optional): The host address for the API. Defaults to '127.0.0.1'.
         port (int, optional): The port for the API. Defaults to 8001.
     """
-    app = create_app(agents, config=AgentConfig())
+    if AGENT_SERVER_WORKER_INDEX is not None:
+        # A worker spawned by start_router: only the router talks to it
+        host, port = "127.0.0.1", int(os.environ["AGENT_SERVER_WORKER_PORT"])
+        logging.getLogger("uvicorn.error").info(f"Starting worker {AGENT_SERVER_WORKER_INDEX} on port {port}")
+    app = create_app(agent_factory, config=AgentConfig())
+    uvicorn.run(app, host=host, port=port)
+
+
+def start_router(host='0.0.0.0', port=8001):
+    """
+    Start AGENT_SERVER_WORKERS worker processes, each running this script, and route requests to them by session.
+    """
+    workers = WorkerProcesses(worker_command(), workers=AGENT_SERVER_WORKERS, base_port=AGENT_SERVER_WORKER_BASE_PORT,
+                              env={"OTP_STORE_URL": OTP_STORE_URL, "ACCOUNT_STORE_PATH": ACCOUNT_STORE_PATH,
+                                   "CONVERSATION_MEMORY_PATH": CONVERSATION_MEMORY_PATH})
+    app = create_router_app(workers, endpoint_api_key=AgentConfig().endpoint_api_key,
+                            start_timeout=AGENT_SERVER_WORKER_START_TIMEOUT_SECONDS,
+                            read_timeout=AGENT_SERVER_WORKER_READ_TIMEOUT_SECONDS)
     uvicorn.run(app, host=host, port=port)
 
 
@@ -615,101 +3037,101 @@ query_echostor_content = vec_factory.create_rag_tool(
     #fixed_filter=f"{doc_permitted_filter(get_guid_for_user())}"
 )
 
+# Repeated support questions are served from the cache instead of re-running retrieval + summarization
+rag_response_cache = None
+if RAG_CACHE_MAX_ENTRIES > 0:
+    rag_response_cache = RagResponseCache(max_entries=RAG_CACHE_MAX_ENTRIES, ttl=RAG_CACHE_TTL_SECONDS,
+                                          similarity_threshold=RAG_CACHE_SIMILARITY_THRESHOLD)
+    install_rag_cache(query_echostor_content, rag_response_cache)
+
+# Capture FCS/Citations as objects at the point the tool returns (installed last so cache hits are captured too)
+install_rag_result_capture(query_echostor_content)
+
 
 ######## Tools to do account management
-# --- NEW: Tool to Update Account Field --- 
-def update_account_field_tool_impl(
+UPDATABLE_ACCOUNT_FIELDS = ['name', 'company', 'support_tier']
+LOOKUP_ACCOUNT_FIELDS = ['user_id', 'name', 'company', 'email', 'support_tier', 'products']
+
+
+# --- Tool to Update Account Fields ---
+def update_account_fields_tool_impl(
         email: str,
-        field: str,
-        value: str
-) -> str:
+        updates: Dict[str, str]
+) -> dict:
     """
-    Updates a specific field (name, company, or support_tier) for a user account identified by their email.
-    This tool should ONLY be called AFTER the user's intent to update a specific field is clear and they have provided the NEW value.
+    Updates one or more fields (name, company, support_tier) of a user account identified by their email, in one call.
+    This tool should ONLY be called AFTER the user's intent to update specific fields is clear and they have provided the NEW values.
     Args:
         email (str): The email address of the user whose account needs updating.
-        field (str): The specific field to update (e.g., 'name', 'company', 'support_tier'). Case sensitive.
-        value (str): The new value for the specified field.
+        updates (dict): Mapping of each field to update ('name', 'company', 'support_tier'; case sensitive) to its new value.
     Returns:
-        A message indicating the result of the account field update.
+        A dictionary with 'status' ('success' or 'error'), and on success the 'updated' fields, each with its 'old' and 'new' value.
     """
-
-    """Dummy implementation to update a field in the in-memory account store."""
     logger = logging.getLogger("uvicorn.error")
 
-    logger.info(f"Attempting to update field '{field}' for user '{email}' to '{value}'")
+    logger.info(f"Attempting to update fields {updates} for user '{email}'")
 
-    # Validate field
-    valid_fields = ['name', 'company', 'support_tier'] # Only allow updating these for now
-    if field not in valid_fields:
-        logger.error(f"Update failed: Invalid field '{field}' requested for update.")
-        return f"Error: Cannot update the field '{field}'. Only {', '.join(valid_fields)} can be updated."
+    # Validate fields
+    invalid_fields = [field for field in updates if field not in UPDATABLE_ACCOUNT_FIELDS]
+    if not updates or invalid_fields:
+        logger.error(f"Update failed: Invalid fields {invalid_fields} requested for update.")
+        return {"status": "error",
+                "message": f"Cannot update the fields {invalid_fields}. Only {', '.join(UPDATABLE_ACCOUNT_FIELDS)} can be updated."}
 
     # Find user
-    user_record = account_data_store.get(email)
-    if not user_record:
+    if not get_account(email):
         logger.error(f"Update failed: User '{email}' not found in data store.")
-        return f"Error: Could not find account for email {email}."
+        return {"status": "error", "message": f"Could not find account for email {email}."}
 
-    # Update the field
+    # Update the fields together (persisted by the account store)
     try:
-        old_value = getattr(user_record, field)
-        setattr(user_record, field, value)
-        logger.info(f"Successfully updated field '{field}' for user '{email}' from '{old_value}' to '{value}'.")
-        # Persist change (already done by modifying the object in the dict)
-        return f"Successfully updated field '{field}' for user '{email}' from '{old_value}' to '{value}'."
-    except AttributeError:
-        # Should not happen due to valid_fields check, but as a safeguard
-        logger.error(f"Update failed: Attribute '{field}' does not exist on UserRecord.")
-        return f"Error: Internal error trying to update field '{field}'."
+        old_values = account_store.update_fields(email, updates)
+        logger.info(f"Successfully updated fields {list(updates)} for user '{email}'.")
+        return {"status": "success", "email": email,
+                "updated": {field: {"old": old_values[field], "new": value} for field, value in updates.items()}}
+    except KeyError:
+        logger.error(f"Update failed: User '{email}' was removed from the data store.")
+        return {"status": "error", "message": f"Could not find account for email {email}."}
     except Exception as e:
-        logger.error(f"Update failed: Unexpected error updating field '{field}' for '{email}': {e}", exc_info=True)
-        return f"Error: An unexpected error occurred while trying to update the {field}."
+        logger.error(f"Update failed: Unexpected error updating fields {list(updates)} for '{email}': {e}", exc_info=True)
+        return {"status": "error", "message": "An unexpected error occurred while trying to update the account."}
 # --- END Update Tool ---
 
-# --- NEW: Tool to Lookup Account Info ---
-def lookup_account_field_tool_impl(
+# --- Tool to Lookup Account Info ---
+def lookup_account_fields_tool_impl(
         email: str,
-        field: str
-) -> str:
+        fields: Optional[List[str]] = None
+) -> dict:
     """
-    Looks up the specified field from a user account for a user account identified by their email.
-    The specified field must be one of the following fields (name, company, or support_tier).
+    Looks up one or more fields of a user account identified by their email, in one call.
+    Ask for every field needed to answer the user's question at once. Leave fields empty to get the whole account.
     Args:
-        email (str): The email address of the user whose account needs updating.
-        field (str): The specific field to look up (e.g., 'name', 'company', 'support_tier'). Case sensitive.
+        email (str): The email address of the user whose account should be looked up.
+        fields (list, optional): The fields to look up, any of 'user_id', 'name', 'company', 'email', 'support_tier', 'products' (case sensitive). Defaults to all of them.
     Returns:
-        A message indicating the result of the account field lookup request.
+        A dictionary with 'status' ('success' or 'error'), and on success an 'account' dictionary of the requested fields.
+        'products' is a list of dictionaries with 'name', 'version' and 'license_key'.
     """
-
     logger = logging.getLogger("uvicorn.error")
 
-    logger.info(f"Attempting to look up field '{field}' for user '{email}'")
+    fields = fields or LOOKUP_ACCOUNT_FIELDS
+    logger.info(f"Attempting to look up fields {fields} for user '{email}'")
 
-    # Validate field
-    valid_fields = ['name', 'company', 'support_tier'] # Only allow looking up these for now
-    if field not in valid_fields:
-        logger.error(f"Lookup failed: Invalid field '{field}' requested.")
-        return f"Error: Cannot look up the field '{field}'. Only {', '.join(valid_fields)} can be looked up."
+    # Validate fields
+    invalid_fields = [field for field in fields if field not in LOOKUP_ACCOUNT_FIELDS]
+    if invalid_fields:
+        logger.error(f"Lookup failed: Invalid fields {invalid_fields} requested.")
+        return {"status": "error",
+                "message": f"Cannot look up the fields {invalid_fields}. Only {', '.join(LOOKUP_ACCOUNT_FIELDS)} can be looked up."}
 
     # Find user
-    user_record = account_data_store.get(email)
+    user_record = get_account(email)
     if not user_record:
         logger.error(f"Lookup failed: User '{email}' not found in data store.")
-        return f"Error: Could not find account for email {email}."
+        return {"status": "error", "message": f"Could not find account for email {email}."}
 
-    # Look up the field
-    try:
-        old_value = getattr(user_record, field)
-        logger.info(f"Successfully looked up field '{field}' for user '{email}'; it is '{old_value}'.")
-        return f"The value of the '{field}' field for user '{email}' is '{old_value}'."
-    except AttributeError:
-        # Should not happen due to valid_fields check, but as a safeguard
-        logger.error(f"Lookup failed: Attribute '{field}' does not exist on UserRecord.")
-        return f"Error: Internal error trying to look up field '{field}'."
-    except Exception as e:
-        logger.error(f"Update failed: Unexpected error looking up field '{field}' for '{email}': {e}", exc_info=True)
-        return f"Error: An unexpected error occurred while trying to look up the {field}."
+    logger.info(f"Successfully looked up fields {fields} for user '{email}'.")
+    return {"status": "success", "account": user_record.model_dump(include=set(fields))}
 # --- END Account Info Lookup Tool ---
 
 
@@ -724,7 +3146,7 @@ def find_support_agent(email: str, support_topic: str) -> dict[str]:
         A dictionary where the 'name' item is the name of the chosen live agent,
         the 'id' is the id of the chosen live agent, and the 'channel' is the channel ID to use.
     """
-    print(f"Choosing support agent for user {email} for topic {support_topic}")
+    logging.getLogger("uvicorn.error").info(f"Choosing support agent for user {email} for topic {support_topic}")
 
     if support_topic.lower() in SUPPORT_QUEUES:
         return LIVE_AGENTS.get(support_topic.lower())
@@ -735,31 +3157,70 @@ def find_support_agent(email: str, support_topic: str) -> dict[str]:
 
 
 ######## Tools for Jira integration
+def text_to_adf(text: str) -> dict:
+    """Convert plain text to a single-paragraph Atlassian Document Format document."""
+    return {
+        "type": "doc",
+        "version": 1,
+        "content": [
+            {
+                "type": "paragraph",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": text
+                    }
+                ]
+            }
+        ]
+    }
+
+
+def new_issue_fields(project_key: str, summary: str, description: str, priority: str = "Medium") -> dict:
+    return {
+        "project": {"key": project_key},
+        "summary": summary,
+        "description": text_to_adf(description),
+        "priority": {"name": priority},
+        "issuetype": {"name": "Task"},
+    }
+
+
+def update_issue_fields(fields: dict) -> dict:
+    """Copy of an update's fields with a plain text description converted to ADF."""
+    fields = dict(fields)
+    if "description" in fields and isinstance(fields["description"], str):
+        fields["description"] = text_to_adf(fields["description"])
+    return fields
+
+
 def list_issues(
         project_key: str,
-        max_results: int = 50
+        max_results: int = 50,
+        detail: bool = False
 ) -> dict:
     """
-    List issues in a given project.
+    List issues in a given project as compact summaries: key, summary, status, priority, assignee and updated time.
 
     Args:
         project_key (str): Key of the project in Jira.
         max_results (int, optional): Maximum number of issues to return. Defaults to 50.
+        detail (bool, optional): Also return each issue's type, reporter, created time, labels and description.
+                                 Only set this when the user asks about those. Defaults to False.
 
     Returns:
-        dict: Parsed JSON response containing the matching issues.
+        dict: 'total' is the number of issues in the project, and 'issues' the returned issue summaries.
 
     Raises:
-        requests.HTTPError: If the HTTP request fails.
+        JiraError: If the Jira request fails.
     """
-    url = f"{JIRA_BASE_URL}/rest/api/3/search"
-    params = {
-        "jql": f"project={project_key}",
-        "maxResults": max_results
+    # Only request the fields that end up in the summaries; full Jira issues are mostly fields the agent never uses
+    result = jira_client.run(jira_client.search(f"project={project_key}", max_results=max_results,
+                                                fields=ISSUE_DETAIL_FIELDS if detail else ISSUE_SUMMARY_FIELDS))
+    return {
+        "total": result["total"],
+        "issues": [summarize_issue(issue, detail).model_dump(exclude_none=True) for issue in result["issues"]],
     }
-    resp = _jira_session.get(url, params=params)
-    resp.raise_for_status()
-    return resp.json()
 
 
 def create_issue(
@@ -781,40 +3242,35 @@ def create_issue(
         dict: Parsed JSON response containing details of the newly created issue.
 
     Raises:
-        ValueError: If issue_type is not in valid_issue_types.
-        requests.HTTPError: If the HTTP request fails.
+        JiraError: If the Jira request fails.
     """
-    url = f"{JIRA_BASE_URL}/rest/api/3/issue"
+    return jira_client.run(jira_client.create_issue(new_issue_fields(project_key, summary, description, priority)))
 
-    # Convert plain text description to Atlassian Document Format
-    description_adf = {
-        "type": "doc",
-        "version": 1,
-        "content": [
-            {
-                "type": "paragraph",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": description
-                    }
-                ]
-            }
-        ]
-    }
 
-    payload = {
-        "fields": {
-            "project": {"key": project_key},
-            "summary": summary,
-            "description": description_adf,
-            "priority": {"name": priority},
-            "issuetype": {"name": "Task"},
-        }
-    }
-    resp = _jira_session.post(url, json=payload)
-    resp.raise_for_status()
-    return resp.json()
+def create_issues(
+        project_key: str,
+        issues: List[Dict[str, str]]
+) -> dict:
+    """
+    Create several new issues in a Jira project at once.
+
+    Args:
+        project_key (str): Key of the target project.
+        issues (list): The issues to create, each a dictionary with 'summary', 'description' and optionally 'priority'
+                       (e.g., 'Highest', 'High', 'Medium', 'Low', 'Lowest'; defaults to 'Medium').
+
+    Returns:
+        dict: 'issues' lists the created issues (id and key), and 'errors' lists the issues that could not be created,
+              by their position in the issues argument ('failedElementNumber').
+
+    Raises:
+        JiraError: If the Jira request fails.
+    """
+    return jira_client.run(jira_client.bulk_create([
+        new_issue_fields(project_key, issue.get("summary", ""), issue.get("description", ""),
+                         issue.get("priority") or "Medium")
+        for issue in issues
+    ]))
 
 
 def update_issue(
@@ -834,45 +3290,19 @@ def update_issue(
         dict: A dictionary indicating success or containing error details if JSON is returned unexpectedly.
 
     Raises:
-        requests.HTTPError: If the HTTP request fails with a 4xx or 5xx error.
+        JiraError: If the Jira request fails with a 4xx or 5xx error.
     """
-    url = f"{JIRA_BASE_URL}/rest/api/3/issue/{issue_id}"
-
-    # Convert description to ADF format if present in the fields
-    if "description" in fields and isinstance(fields["description"], str):
-        fields["description"] = {
-            "type": "doc",
-            "version": 1,
-            "content": [
-                {
-                    "type": "paragraph",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": fields["description"]
-                        }
-                    ]
-                }
-            ]
-        }
-
-    payload = {"fields": fields}
-    resp = _jira_session.put(url, json=payload)
-
-    # Raise exception ONLY for actual client/server errors (4xx, 5xx)
-    resp.raise_for_status()
+    resp = jira_client.run(jira_client.update_issue(issue_id, update_issue_fields(fields)))
 
     # Check for the successful 'No Content' response BEFORE trying .json()
     if resp.status_code == 204:
         # Return a simple dictionary indicating success, as no body was returned
         return {"status": "success", "message": f"Issue {issue_id} updated successfully."}
     else:
-        # If the status code is something else successful (like 200 OK, though unlikely for PUT update)
-        # or potentially an error response that didn't raise_for_status (unusual), try parsing JSON.
+        # If the status code is something else successful (like 200 OK, though unlikely for PUT update), try parsing JSON.
         try:
-            # Attempt to parse JSON only if status code wasn't 204
             return resp.json()
-        except requests.exceptions.JSONDecodeError:
+        except ValueError:
             # Handle the edge case where the response wasn't 204 but still had no valid JSON
             return {
                 "status": "warning",
@@ -881,6 +3311,23 @@ def update_issue(
             }
 
 
+def update_issues(
+        updates: Dict[str, dict]
+) -> dict:
+    """
+    Update fields of several existing Jira issues at once.
+
+    Args:
+        updates (dict): Mapping of each issue ID or key to the fields to update on it, in the same form as the
+                        update_issue tool's fields. Example: {"BROAD-1": {"priority": {"name": "High"}}, "BROAD-2": {"summary": "New Summary"}}
+
+    Returns:
+        dict: 'updated' lists the issues that were updated, and 'errors' maps each issue that could not be updated to its error.
+    """
+    return jira_client.run(jira_client.bulk_update(
+        {issue_id: update_issue_fields(fields) for issue_id, fields in updates.items()}))
+
+
 def delete_issue(issue_id: str) -> bool:
     """
     Delete a Jira issue by its ID or key.
@@ -892,34 +3339,40 @@ def delete_issue(issue_id: str) -> bool:
         bool: True if deletion succeeded (HTTP 204), False otherwise.
 
     Raises:
-        requests.HTTPError: If the HTTP request fails.
+        JiraError: If the Jira request fails.
     """
-    url = f"{JIRA_BASE_URL}/rest/api/3/issue/{issue_id}"
-    resp = _jira_session.delete(url)
-    resp.raise_for_status()
-    return resp.status_code == 204
+    return jira_client.run(jira_client.delete_issue(issue_id))
 
 
 # The list of all tools available to the agent
 def create_assistant_tools():
     tools_factory = ToolsFactory()
-    return (
+    tools = (
         [tools_factory.create_tool(tool) for tool in
          [
              find_support_agent,
-             update_account_field_tool_impl,
-             lookup_account_field_tool_impl,
+             update_account_fields_tool_impl,
+             lookup_account_fields_tool_impl,
              create_issue,
+             create_issues,
              update_issue,
+             update_issues,
              delete_issue,
              list_issues
          ]
          ] + [query_echostor_content]
     )
+    # Every tool call is timed as a span of the request's trace, and counted in the tool metrics
+    return [install_tool_metrics(install_tool_tracing(tool)) for tool in tools]
 
 
 # Function to execute a single query. This gives the agent instructions for how to call the different tools.
 def main():
+    if MULTI_WORKER and AGENT_SERVER_WORKER_INDEX is None:
+        # This process only routes; the workers it starts build the tools and agents
+        start_router(port=8001)
+        return
+
     topic_of_expertise = "Information about EchoStor products, services, and support, including basic account management."
 
     live_agent_chat_lookup_instructions = f"""
@@ -933,8 +3386,8 @@ def main():
         You are a knowledgeable, professional AI assistant trained to answer questions related to EchoStor products, such as Mainframe Operational Intelligence, Advanced Authentication Mainframe, VMware vSphere, and Carbon Black App Control Agent. 
         You are also able to answer questions related to EchoStor Services and Support.
         You have access to a ticketing system, and can answer questions about issue with the Jira project key named 'BROAD'.
-        You can also assist verified users via the 'update_account_field_tool' tool with updating some of their account details (name, company, support tier).
-        You can also assist verified users via the 'lookup_account_field_tool' tool with looking up  of their account details (name, company, support tier).
+        You can also assist verified users via the 'update_account_fields_tool_impl' tool with updating some of their account details (name, company, support tier). Update all of the fields the user asked to change in a single call.
+        You can also assist verified users via the 'lookup_account_fields_tool_impl' tool with looking up their account details (user id, name, company, support tier, products). Look up all of the fields needed to answer in a single call.
         You use trusted content retrieved through the 'query_echostor_content' tool, which includes citations, URLs, factual consistency scores (fcs_score), and article metadata.
         If asked a question that is not related to EchoStor products, services, support docs, or licensing, then tell the user that you are not able to answer that question but you can help them with EchoStor products, support, documentation, and basic account management.
         If the question is in Japanese, then translate the question to English before answering it. Always answer the question in English, in a polite and professional manner. 
@@ -946,11 +3399,12 @@ def main():
 
     # --- END Instruction Update --- 
 
-    # --- Agent Creation Loop --- 
+    # --- Agent Factory ---
+    # Agents are built lazily by the pool; they all share one tools list
     tools = create_assistant_tools() # Call the updated function
-    agents = []
-    print(f"Creating {NUM_AGENTS} agents...")
-    for i in range(NUM_AGENTS): # Use index for potential future per-agent storage
+    reported = threading.Event()
+
+    def make_agent() -> Agent:
         agent = Agent(
             tools=tools, # Pass the updated tools list
             topic=topic_of_expertise,
@@ -958,20 +3412,18 @@ def main():
             verbose=True,
             agent_progress_callback=agent_progress_callback
         )
-        agents.append({
-            "agent": agent,
-            "session": None
-            })
-
-    agents[0]["agent"].report()
+        if not reported.is_set():
+            reported.set()
+            agent.report()
+        return agent
 
-    print("Agents created.")
+    print(f"Tools created in {time.perf_counter() - BOOT_STARTED:.2f}s; up to {NUM_AGENTS} agents will be built on demand.")
     
     # Apply nest_asyncio for running FastAPI within environments like Jupyter/Colab
     nest_asyncio.apply()
     
     # Start the FastAPI application
-    start_app(agents, port=8001) # Change to port 8001
+    start_app(make_agent, port=8001) # Change to port 8001
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,330 @@
+"""
+Async Jira Cloud REST client used by the agent's Jira tools in agent-server.py.
+
+All requests share one pooled HTTP client with a timeout and a cap on concurrent requests, and are retried with
+exponential backoff on HTTP 429 and 5xx (honoring Retry-After, up to MAX_RETRY_DELAY_SECONDS) and on connection
+errors. Searches are paged with startAt and exposed as an async stream of issues; once the first page gives the
+total, the remaining pages are fetched concurrently. Read requests are cached for a short TTL; every write drops the cache, so a tool never reads
+back stale data after changing an issue.
+
+Search results can be projected to the few fields the agent needs (fields=) and reduced to compact IssueSummary /
+IssueDetail records, so tool output fed to the LLM stays small.
+
+The agent calls tools on its worker threads, so the client runs its own event loop on a background thread and sync
+code calls its coroutines via run().
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import List, Optional
+
+import httpx
+from pydantic import BaseModel
+
+SEARCH_PATH = "/rest/api/3/search"
+ISSUE_PATH = "/rest/api/3/issue"
+BULK_CREATE_MAX_ISSUES = 50  # Jira's limit per bulk create call
+MAX_PAGE_SIZE = 100  # Jira's limit per search page
+CACHE_MAX_ENTRIES = 256
+ERROR_TEXT_MAX_CHARS = 500
+MAX_RETRY_DELAY_SECONDS = 30  # cap on a server's Retry-After, so Jira can't stall the client's loop
+DESCRIPTION_MAX_CHARS = 1000
+
+# Fields requested from Jira for compact issue summaries, and additionally for detailed ones
+ISSUE_SUMMARY_FIELDS = ["summary", "status", "priority", "assignee", "updated"]
+ISSUE_DETAIL_FIELDS = ISSUE_SUMMARY_FIELDS + ["issuetype", "reporter", "created", "labels", "description"]
+
+
+class IssueSummary(BaseModel):
+    key: str
+    summary: Optional[str] = None
+    status: Optional[str] = None
+    priority: Optional[str] = None
+    assignee: Optional[str] = None
+    updated: Optional[str] = None
+
+
+class IssueDetail(IssueSummary):
+    issuetype: Optional[str] = None
+    reporter: Optional[str] = None
+    created: Optional[str] = None
+    labels: List[str] = []
+    description: Optional[str] = None
+
+
+def adf_to_text(node) -> str:
+    """Flatten an Atlassian Document Format node to plain text, one line per block."""
+    if not isinstance(node, dict):
+        return ""
+    if node.get("type") == "text":
+        return node.get("text", "")
+    text = "".join(adf_to_text(child) for child in node.get("content") or [])
+    return text + "\n" if node.get("type") in ("paragraph", "heading", "listItem", "codeBlock") else text
+
+
+def summarize_issue(issue: dict, detail: bool = False) -> IssueSummary:
+    """Reduce a raw Jira issue to its IssueSummary, or its IssueDetail (description truncated) if detail is set."""
+    fields = issue.get("fields") or {}
+
+    def name_of(field: str, attribute: str = "name"):
+        value = fields.get(field)
+        return value.get(attribute) if isinstance(value, dict) else value
+
+    summary = {
+        "key": issue.get("key") or issue.get("id"),
+        "summary": fields.get("summary"),
+        "status": name_of("status"),
+        "priority": name_of("priority"),
+        "assignee": name_of("assignee", "displayName"),
+        "updated": fields.get("updated"),
+    }
+    if not detail:
+        return IssueSummary(**summary)
+
+    description = fields.get("description")
+    description = adf_to_text(description).strip() if isinstance(description, dict) else description
+    if description and len(description) > DESCRIPTION_MAX_CHARS:
+        description = description[:DESCRIPTION_MAX_CHARS] + "..."
+    return IssueDetail(**summary, issuetype=name_of("issuetype"), reporter=name_of("reporter", "displayName"),
+                       created=fields.get("created"), labels=fields.get("labels") or [], description=description)
+
+
+class JiraError(Exception):
+    """A Jira request failed; status_code is None if no response was received."""
+
+    def __init__(self, status_code, message: str):
+        super().__init__(f"Jira request failed ({status_code}): {message}" if status_code else f"Jira request failed: {message}")
+        self.status_code = status_code
+
+
+class JiraClient:
+
+    def __init__(self, base_url: str, email: str, api_key: str, timeout: float = 15, max_retries: int = 3,
+                 retry_backoff: float = 0.5, cache_ttl: float = 30, max_concurrency: int = 8, page_size: int = 50):
+        if max_retries < 0:
+            raise ValueError(f"max_retries must be >= 0, got {max_retries}")
+        self.base_url = base_url
+        self.auth = httpx.BasicAuth(email or "", api_key or "")
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.cache_ttl = cache_ttl
+        self.max_concurrency = max_concurrency
+        self.page_size = min(page_size, MAX_PAGE_SIZE)
+
+        # Only touched on the client's event loop thread, so none of these need locking
+        self._http = None
+        self._semaphore = None
+        self._cache = OrderedDict()  # {(path, params): (expires, value)}, oldest first
+        self._cache_generation = 0  # bumped by every write, so reads that raced a write aren't cached
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="jira-client", daemon=True)
+        self._thread.start()
+
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def run(self, coro):
+        """Run one of the client's coroutines on its event loop and wait for the result (for sync callers)."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                base_url=self.base_url, auth=self.auth, timeout=self.timeout,
+                headers={"Accept": "application/json", "Content-Type": "application/json"},
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency))
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._http
+
+    async def request(self, method: str, path: str, params: dict = None, json: dict = None) -> httpx.Response:
+        """Send a request, retrying 429s, 5xx responses and connection errors. Raises JiraError if it fails."""
+        http = self._client()
+        params = {name: value for name, value in (params or {}).items() if value is not None}
+        for attempt in range(self.max_retries + 1):
+            retries_left = attempt < self.max_retries
+            try:
+                async with self._semaphore:
+                    self.requests += 1
+                    resp = await http.request(method, path, params=params, json=json)
+            except httpx.TransportError as e:
+                if not retries_left:
+                    self.errors += 1
+                    raise JiraError(None, f"{type(e).__name__}: {e}") from e
+                delay = self.retry_backoff * 2 ** attempt
+            else:
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    if not retries_left:
+                        self.errors += 1
+                        raise JiraError(resp.status_code, resp.text[:ERROR_TEXT_MAX_CHARS])
+                    retry_after = resp.headers.get("Retry-After")
+                    delay = min(float(retry_after), MAX_RETRY_DELAY_SECONDS) \
+                        if retry_after and retry_after.replace(".", "", 1).isdigit() \
+                        else self.retry_backoff * 2 ** attempt
+                elif resp.is_error:
+                    self.errors += 1
+                    raise JiraError(resp.status_code, resp.text[:ERROR_TEXT_MAX_CHARS])
+                else:
+                    return resp
+
+            self.retries += 1
+            logging.getLogger("uvicorn.error").warning(f"Retrying Jira {method} {path} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+    async def get_json(self, path: str, params: dict = None):
+        """GET a JSON document, served from the read cache for cache_ttl seconds. Treat the result as read-only."""
+        key = (path, tuple(sorted((params or {}).items())))
+        now = time.monotonic()
+        entry = self._cache.get(key)
+        if entry and entry[0] > now:
+            self.cache_hits += 1
+            return entry[1]
+
+        self.cache_misses += 1
+        generation = self._cache_generation
+        value = (await self.request("GET", path, params=params)).json()
+        if self.cache_ttl > 0 and generation == self._cache_generation:
+            self._cache[key] = (now + self.cache_ttl, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > CACHE_MAX_ENTRIES:
+                self._cache.popitem(last=False)
+        return value
+
+    def invalidate(self):
+        """Drop every cached read, e.g. after an issue was changed."""
+        self._cache.clear()
+        self._cache_generation += 1
+
+    async def iter_search_pages(self, jql: str, fields: list = None, expand: list = None, max_results: int = None):
+        """
+        Stream the pages of a JQL search, in order. The first page gives the total, then the remaining startAt pages
+        are all requested at once (bounded by max_concurrency) and yielded as they complete in order. An empty page
+        ends the search, e.g. when issues were deleted since the total was counted.
+        """
+
+        def fetch(start_at: int):
+            page_size = self.page_size if max_results is None else min(self.page_size, max_results - start_at)
+            return asyncio.ensure_future(self.get_json(SEARCH_PATH, {
+                "jql": jql, "startAt": start_at, "maxResults": page_size,
+                "fields": ",".join(fields) if fields else None,
+                "expand": ",".join(expand) if expand else None,
+            }))
+
+        pending = deque([fetch(0)])
+        fetched_all = False
+        try:
+            while pending:
+                page = await pending.popleft()
+                issues = page.get("issues") or []
+                yield page
+                if not issues:
+                    break
+                if not fetched_all:
+                    fetched_all = True
+                    end = page.get("total", 0) if max_results is None else min(page.get("total", 0), max_results)
+                    pending.extend(fetch(start_at) for start_at in range(len(issues), end, len(issues)))
+        finally:
+            # The consumer stopped early; don't leave the remaining pages running
+            for future in pending:
+                future.cancel()
+
+    async def iter_search(self, jql: str, fields: list = None, expand: list = None, max_results: int = None):
+        """Stream the issues matching a JQL search, across as many pages as needed."""
+        async for page in self.iter_search_pages(jql, fields=fields, expand=expand, max_results=max_results):
+            for issue in page["issues"]:
+                yield issue
+
+    async def search(self, jql: str, fields: list = None, expand: list = None, max_results: int = None) -> dict:
+        """Collect a paged JQL search into one search result, shaped like a single Jira search response."""
+        issues = []
+        total = 0
+        async for page in self.iter_search_pages(jql, fields=fields, expand=expand, max_results=max_results):
+            issues.extend(page["issues"])
+            total = page.get("total", total)
+        return {"startAt": 0, "maxResults": len(issues), "total": total, "issues": issues}
+
+    async def create_issue(self, fields: dict) -> dict:
+        try:
+            return (await self.request("POST", ISSUE_PATH, json={"fields": fields})).json()
+        finally:
+            self.invalidate()
+
+    async def bulk_create(self, issues_fields: list) -> dict:
+        """Create many issues, BULK_CREATE_MAX_ISSUES per request, with the requests sent concurrently."""
+
+        async def create_chunk(chunk):
+            resp = await self.request("POST", f"{ISSUE_PATH}/bulk",
+                                      json={"issueUpdates": [{"fields": fields} for fields in chunk]})
+            return resp.json()
+
+        chunks = [issues_fields[i:i + BULK_CREATE_MAX_ISSUES] for i in range(0, len(issues_fields), BULK_CREATE_MAX_ISSUES)]
+        try:
+            results = await asyncio.gather(*(create_chunk(chunk) for chunk in chunks), return_exceptions=True)
+        finally:
+            self.invalidate()
+
+        created = {"issues": [], "errors": []}
+        for chunk_index, result in enumerate(results):
+            offset = chunk_index * BULK_CREATE_MAX_ISSUES
+            if isinstance(result, Exception):
+                created["errors"].extend({"failedElementNumber": offset + i, "message": str(result)}
+                                         for i in range(len(chunks[chunk_index])))
+                continue
+            created["issues"].extend(result.get("issues") or [])
+            created["errors"].extend({**error, "failedElementNumber": offset + error.get("failedElementNumber", 0)}
+                                     for error in result.get("errors") or [])
+        return created
+
+    async def update_issue(self, issue_id: str, fields: dict) -> httpx.Response:
+        try:
+            return await self.request("PUT", f"{ISSUE_PATH}/{issue_id}", json={"fields": fields})
+        finally:
+            self.invalidate()
+
+    async def bulk_update(self, updates: dict) -> dict:
+        """Apply {issue id: fields} updates concurrently; returns the updated issue ids and {issue id: error}."""
+        issue_ids = list(updates)
+        try:
+            results = await asyncio.gather(*(self.request("PUT", f"{ISSUE_PATH}/{issue_id}", json={"fields": fields})
+                                             for issue_id, fields in updates.items()), return_exceptions=True)
+        finally:
+            self.invalidate()
+        return {
+            "updated": [issue_id for issue_id, result in zip(issue_ids, results) if not isinstance(result, Exception)],
+            "errors": {issue_id: str(result) for issue_id, result in zip(issue_ids, results) if isinstance(result, Exception)},
+        }
+
+    async def delete_issue(self, issue_id: str) -> bool:
+        try:
+            return (await self.request("DELETE", f"{ISSUE_PATH}/{issue_id}")).status_code == 204
+        finally:
+            self.invalidate()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "errors": self.errors,
+            "cache_size": len(self._cache),
+            "cache_hits": self.cache_hits,
+            "cache_misses": self.cache_misses,
+        }
+
+    async def _aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        self.run(self._aclose())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -0,0 +1,321 @@
+"""
+Benchmarks jira_client.py against a local stub of the Jira Cloud REST API.
+
+The stub server keeps issues in memory and answers search (paged with startAt/maxResults, honoring fields=), issue
+create, bulk create, update and delete after a fixed simulated latency. It rejects a fraction of requests with
+HTTP 429 so the retry/backoff path is exercised too. The benchmark compares the previous one-request-at-a-time
+access pattern (a blocking requests.Session) with the async client for paged listing, repeated (cached) listing,
+bulk create and bulk update, and checks both see the same issues. It then compares the size and fetch time of the
+list_issues tool output as full Jira issues (as list_issues used to return them) and as compact summaries.
+
+The stub can also be run on its own, to point agent-server.py's Jira tools at it via JIRA_BASE_URL:
+    python3 jira_client_benchmark.py --serve 8089
+
+Run via one of the following (all arguments are optional):
+    python3 jira_client_benchmark.py
+    python3 jira_client_benchmark.py --num-issues 500 --latency-ms 50 --rate-limit-ratio 0.02
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from jira_client import JiraClient, MAX_PAGE_SIZE, ISSUE_SUMMARY_FIELDS, ISSUE_DETAIL_FIELDS, summarize_issue
+
+PROJECT_KEY = "BROAD"
+NUM_CUSTOM_FIELDS = 30  # real Jira Cloud issues carry dozens of (mostly empty) custom fields
+
+
+def stub_user(name: str, base_url: str) -> dict:
+    account_id = f"5b10ac8d82e05b22cc7d4e{abs(hash(name)) % 10 ** 6:06d}"
+    return {
+        "self": f"{base_url}/rest/api/3/user?accountId={account_id}",
+        "accountId": account_id,
+        "emailAddress": f"{name.lower().replace(' ', '.')}@example.com",
+        "avatarUrls": {size: f"https://avatar-management.example.com/{account_id}/{size}" for size in
+                       ("48x48", "24x24", "16x16", "32x32")},
+        "displayName": name,
+        "active": True,
+        "timeZone": "America/New_York",
+        "accountType": "atlassian",
+    }
+
+
+class StubJiraHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like Jira Cloud
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def handle_request(self, method: str):
+        body = self.read_json()
+        time.sleep(self.server.latency_seconds)
+
+        if random.random() < self.server.rate_limit_ratio:
+            self.send_json(429, {"errorMessages": ["Rate limit exceeded"]}, {"Retry-After": "0.05"})
+            return
+
+        url = urlparse(self.path)
+        path = url.path.rstrip("/")
+        if method == "GET" and path == "/rest/api/3/search":
+            self.search(parse_qs(url.query))
+        elif method == "POST" and path == "/rest/api/3/issue":
+            self.send_json(201, self.server.create_issue(body["fields"]))
+        elif method == "POST" and path == "/rest/api/3/issue/bulk":
+            self.send_json(201, {"issues": [self.server.create_issue(update["fields"]) for update in body["issueUpdates"]],
+                                 "errors": []})
+        elif path.startswith("/rest/api/3/issue/") and method in ("PUT", "DELETE"):
+            issue_key = path.rsplit("/", 1)[-1]
+            with self.server.lock:
+                issue = self.server.issues.get(issue_key)
+                if issue and method == "PUT":
+                    issue["fields"].update(body["fields"])
+                elif issue:
+                    del self.server.issues[issue_key]
+            if issue:
+                self.send_json(204, None)
+            else:
+                self.send_json(404, {"errorMessages": ["Issue does not exist or you do not have permission to see it."]})
+        else:
+            self.send_json(404, {"errorMessages": ["Not found"]})
+
+    def search(self, params: dict):
+        project_key = params.get("jql", [""])[0].partition("=")[2].strip()
+        start_at = int(params.get("startAt", ["0"])[0])
+        max_results = min(int(params.get("maxResults", ["50"])[0]), MAX_PAGE_SIZE)
+        fields = params.get("fields", [""])[0]
+        fields = fields.split(",") if fields else None
+
+        with self.server.lock:
+            issues = [issue for issue in self.server.issues.values() if issue["fields"]["project"]["key"] == project_key]
+            page = [json.loads(json.dumps(issue)) for issue in issues[start_at:start_at + max_results]]
+        if fields:
+            for issue in page:
+                issue["fields"] = {name: value for name, value in issue["fields"].items() if name in fields}
+        self.send_json(200, {"startAt": start_at, "maxResults": max_results, "total": len(issues), "issues": page})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def do_DELETE(self):
+        self.handle_request("DELETE")
+
+    def send_json(self, status: int, body, extra_headers: dict = None):
+        data = json.dumps(body).encode("utf-8") if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubJiraServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int, latency_ms: float, rate_limit_ratio: float):
+        super().__init__(("127.0.0.1", port), StubJiraHandler)
+        self.latency_seconds = latency_ms / 1000
+        self.rate_limit_ratio = rate_limit_ratio
+        self.issues = {}  # {issue key: issue}, in creation order
+        self.next_id = 10000
+        self.lock = threading.Lock()
+
+    def create_issue(self, fields: dict) -> dict:
+        with self.lock:
+            self.next_id += 1
+            issue_id = str(self.next_id)
+            issue_key = f"{fields['project']['key']}-{self.next_id - 10000}"
+            base_url = f"http://127.0.0.1:{self.server_address[1]}"
+            now = time.strftime("%Y-%m-%dT%H:%M:%S.000+0000", time.gmtime())
+            self.issues[issue_key] = {
+                "expand": "renderedFields,names,schema,operations,editmeta,changelog,versionedRepresentations",
+                "id": issue_id,
+                "key": issue_key,
+                "self": f"{base_url}/rest/api/3/issue/{issue_id}",
+                "fields": {
+                    "status": {"self": f"{base_url}/rest/api/3/status/10000", "description": "", "name": "To Do",
+                               "iconUrl": f"{base_url}/images/icons/statuses/open.png", "id": "10000",
+                               "statusCategory": {"self": f"{base_url}/rest/api/3/statuscategory/2", "id": 2,
+                                                  "key": "new", "colorName": "blue-gray", "name": "To Do"}},
+                    "assignee": stub_user(random.choice(["Joe", "Amr", "Eva", "Tony"]), base_url),
+                    "reporter": stub_user("Support Bot", base_url),
+                    "creator": stub_user("Support Bot", base_url),
+                    "created": now,
+                    "updated": now,
+                    "labels": ["support"],
+                    "watches": {"self": f"{base_url}/rest/api/3/issue/{issue_key}/watchers", "watchCount": 1,
+                                "isWatching": False},
+                    "votes": {"self": f"{base_url}/rest/api/3/issue/{issue_key}/votes", "votes": 0, "hasVoted": False},
+                    "timetracking": {}, "worklog": {"startAt": 0, "maxResults": 20, "total": 0, "worklogs": []},
+                    "comment": {"comments": [], "self": f"{base_url}/rest/api/3/issue/{issue_id}/comment",
+                                "maxResults": 0, "total": 0, "startAt": 0},
+                    "fixVersions": [], "components": [], "issuelinks": [], "subtasks": [], "attachment": [],
+                    **{f"customfield_{10000 + i}": None for i in range(NUM_CUSTOM_FIELDS)},
+                    **fields,
+                    "project": {"self": f"{base_url}/rest/api/3/project/10001", "id": "10001",
+                                "key": fields["project"]["key"], "name": "EchoStor Support",
+                                "projectTypeKey": "software", "simplified": False,
+                                "avatarUrls": {size: f"{base_url}/rest/api/3/universal_avatar/view/type/project/"
+                                                     f"avatar/10400?size={size}" for size in
+                                               ("48x48", "24x24", "16x16", "32x32")}},
+                    "issuetype": {"self": f"{base_url}/rest/api/3/issuetype/10002", "id": "10002",
+                                  "description": "A small, distinct piece of work.",
+                                  "iconUrl": f"{base_url}/rest/api/2/universal_avatar/view/type/issuetype/avatar/10318",
+                                  "name": fields.get("issuetype", {}).get("name", "Task"), "subtask": False,
+                                  "avatarId": 10318, "hierarchyLevel": 0},
+                },
+            }
+            return {"id": issue_id, "key": issue_key, "self": self.issues[issue_key]["self"]}
+
+
+def start_stub_server(port: int, latency_ms: float, rate_limit_ratio: float) -> StubJiraServer:
+    server = StubJiraServer(port, latency_ms, rate_limit_ratio)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def new_issue_fields(index: int) -> dict:
+    return {
+        "project": {"key": PROJECT_KEY},
+        "summary": f"Benchmark issue {index}",
+        "description": {"type": "doc", "version": 1,
+                        "content": [{"type": "paragraph", "content": [{"type": "text", "text": f"Description {index}"}]}]},
+        "priority": {"name": "Medium"},
+        "issuetype": {"name": "Task"},
+    }
+
+
+def sync_request(session: requests.Session, method: str, url: str, **kwargs) -> requests.Response:
+    """The previous access pattern, plus the same 429 retry, so both sides see the same stub behavior."""
+    while True:
+        resp = session.request(method, url, **kwargs)
+        if resp.status_code != 429:
+            resp.raise_for_status()
+            return resp
+        time.sleep(float(resp.headers.get("Retry-After", 0.05)))
+
+
+def timed(label: str, baseline_fn, client_fn):
+    start = time.perf_counter()
+    baseline_result = baseline_fn()
+    baseline_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    client_result = client_fn()
+    client_seconds = time.perf_counter() - start
+    print(f"{label:<28} sync {baseline_seconds:6.2f}s   async client {client_seconds:6.2f}s   "
+          f"({baseline_seconds / client_seconds:.1f}x)")
+    return baseline_result, client_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Jira client benchmark against a local stub Jira server")
+
+    parser.add_argument("--num-issues",
+                        type=int,
+                        help="Number of issues to create, list and update",
+                        default=300)
+    parser.add_argument("--latency-ms",
+                        type=float,
+                        help="Simulated per-request API latency in milliseconds",
+                        default=50)
+    parser.add_argument("--rate-limit-ratio",
+                        type=float,
+                        help="Fraction of requests the stub rejects with HTTP 429",
+                        default=0.01)
+    parser.add_argument("--serve",
+                        type=int,
+                        metavar="PORT",
+                        help="Only run the stub Jira server on this port, until interrupted")
+
+    args = parser.parse_args()
+
+    if args.serve:
+        server = StubJiraServer(args.serve, args.latency_ms, args.rate_limit_ratio)
+        print(f"Stub Jira server listening on http://127.0.0.1:{args.serve}")
+        server.serve_forever()
+        return
+
+    server = start_stub_server(0, args.latency_ms, args.rate_limit_ratio)
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    session = requests.Session()
+    client = JiraClient(base_url, "stub@example.com", "stub-api-key", retry_backoff=0.05, max_retries=10)
+
+    # Create: one request per issue vs. bulk create (50 issues per request, sent concurrently)
+    half = args.num_issues // 2
+    timed(f"create {half} issues",
+          lambda: [sync_request(session, "POST", f"{base_url}/rest/api/3/issue", json={"fields": new_issue_fields(i)})
+                   for i in range(half)],
+          lambda: client.run(client.bulk_create([new_issue_fields(i) for i in range(half, 2 * half)])))
+
+    # List: follow startAt one page at a time vs. fetching the remaining pages concurrently
+    def sync_list():
+        issues = []
+        while True:
+            page = sync_request(session, "GET", f"{base_url}/rest/api/3/search",
+                                params={"jql": f"project={PROJECT_KEY}", "startAt": len(issues), "maxResults": 50}).json()
+            issues.extend(page["issues"])
+            if not page["issues"] or len(issues) >= page["total"]:
+                return issues
+
+    baseline_issues, client_result = timed(f"list {2 * half} issues", sync_list,
+                                           lambda: client.run(client.search(f"project={PROJECT_KEY}")))
+    if [issue["key"] for issue in baseline_issues] != [issue["key"] for issue in client_result["issues"]]:
+        raise RuntimeError("The async client listed different issues than the sync baseline")
+
+    timed(f"list {2 * half} issues again", sync_list, lambda: client.run(client.search(f"project={PROJECT_KEY}")))
+
+    # Update: one request per issue vs. bulk update (concurrent requests)
+    keys = [issue["key"] for issue in baseline_issues]
+    timed(f"update {half} issues",
+          lambda: [sync_request(session, "PUT", f"{base_url}/rest/api/3/issue/{key}",
+                                json={"fields": {"priority": {"name": "High"}}}) for key in keys[:half]],
+          lambda: client.run(client.bulk_update({key: {"priority": {"name": "High"}} for key in keys[half:]})))
+
+    # The updates must have dropped the cached listing
+    issues = client.run(client.search(f"project={PROJECT_KEY}"))["issues"]
+    if any(issue["fields"]["priority"]["name"] != "High" for issue in issues):
+        raise RuntimeError("The async client served a stale cached listing after an update")
+
+    print(f"client stats: {client.stats()}")
+    client.close()
+
+    # list_issues tool output: full issues vs. projected, compact summaries (uncached, so each fetch is timed)
+    uncached = JiraClient(base_url, "stub@example.com", "stub-api-key", retry_backoff=0.05, max_retries=10, cache_ttl=0)
+    tool_outputs = {
+        "full issues (before)": lambda: uncached.run(uncached.search(f"project={PROJECT_KEY}", max_results=50)),
+        "compact summaries": lambda: {"issues": [
+            summarize_issue(issue).model_dump(exclude_none=True) for issue in
+            uncached.run(uncached.search(f"project={PROJECT_KEY}", max_results=50, fields=ISSUE_SUMMARY_FIELDS))["issues"]]},
+        "detail mode": lambda: {"issues": [
+            summarize_issue(issue, detail=True).model_dump(exclude_none=True) for issue in
+            uncached.run(uncached.search(f"project={PROJECT_KEY}", max_results=50, fields=ISSUE_DETAIL_FIELDS))["issues"]]},
+    }
+    for label, list_issues in tool_outputs.items():
+        start = time.perf_counter()
+        output = str(list_issues())  # the agent framework passes tool output to the LLM as text
+        elapsed = time.perf_counter() - start
+        print(f"list_issues, {label:<20} {len(output):>8} chars (~{len(output) // 4} tokens) in {elapsed * 1000:.0f}ms")
+    uncached.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
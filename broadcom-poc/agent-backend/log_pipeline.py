@@ -0,0 +1,150 @@
+"""
+Asynchronous, size-bounded logging for agent-server.py.
+
+AsyncLogging moves the handlers of every configured logger (the root logger and uvicorn's) behind a bounded queue:
+the logging call on the request path only builds the LogRecord and enqueues it, and a QueueListener thread per logger
+formats the message and writes it out. Records are enqueued unformatted, so %-style arguments (including LazyJson)
+are only rendered on the listener thread. When the queue is full, records are dropped and counted rather than
+blocking the event loop.
+
+Every message is capped at max_message_chars by TruncateFilter on the output handlers; a record can raise its own cap
+with extra={"max_chars": ...}, which the sampled raw dumps of agent output use.
+"""
+
+import json
+import logging
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f"{text[:max_chars]}... [{len(text) - max_chars} more chars]"
+
+
+class LazyJson:
+    """Log argument that serializes fields as JSON only when (and if) the record is formatted, at most once."""
+
+    __slots__ = ("fields", "_text")
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._text = None
+
+    def __str__(self) -> str:
+        if self._text is None:
+            self._text = json.dumps(self.fields, default=str)
+        return self._text
+
+
+class TruncateFilter(logging.Filter):
+    """Caps the formatted message of each record at max_chars (or the record's own max_chars)."""
+
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        max_chars = getattr(record, "max_chars", self.max_chars)
+        message = record.getMessage()
+        if len(message) > max_chars:
+            record.msg, record.args = truncate(message, max_chars), None
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Enqueues records as they are, leaving all formatting to the listener thread, and drops records instead of
+    blocking or raising when the queue is full.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RawDumpSampler:
+    """Decides, once per request, whether its raw agent output is dumped to the log."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.sampled = 0
+        self.skipped = 0
+
+    def sample(self) -> bool:
+        if self.rate >= 1 or (self.rate > 0 and random.random() < self.rate):
+            self.sampled += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def stats(self) -> dict:
+        return {"rate": self.rate, "sampled": self.sampled, "skipped": self.skipped}
+
+
+class AsyncLogging:
+    """
+    Installs TruncateFilter on the handlers of every logger that has handlers and, if enabled, moves those handlers
+    behind a DroppingQueueHandler. Call start() after the server configured its logging (uvicorn does so in run()).
+    """
+
+    def __init__(self, max_queue: int, max_message_chars: int, enabled: bool = True):
+        self.max_queue = max_queue
+        self.max_message_chars = max_message_chars
+        self.enabled = enabled
+        self._installed = []  # [(logger, original handlers, queue handler, listener)]
+
+    @staticmethod
+    def loggers_with_handlers() -> list:
+        loggers = [logging.getLogger()] + [logger for logger in list(logging.Logger.manager.loggerDict.values())
+                                           if isinstance(logger, logging.Logger)]
+        return [logger for logger in loggers if logger.handlers]
+
+    def start(self):
+        truncate_filter = TruncateFilter(self.max_message_chars)
+        for logger in self.loggers_with_handlers():
+            handlers = [handler for handler in logger.handlers if not isinstance(handler, QueueHandler)]
+            if not handlers:
+                continue
+            for handler in handlers:
+                handler.addFilter(truncate_filter)
+            if not self.enabled:
+                self._installed.append((logger, handlers, None, None))
+                continue
+            log_queue = queue.Queue(maxsize=self.max_queue)
+            queue_handler = DroppingQueueHandler(log_queue)
+            listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+            logger.handlers = [queue_handler]
+            listener.start()
+            self._installed.append((logger, handlers, queue_handler, listener))
+
+    def stop(self):
+        """Write out the queued records and put the original handlers back."""
+        for logger, handlers, queue_handler, listener in self._installed:
+            if listener:
+                listener.stop()
+                logger.handlers = handlers
+        self._installed = []
+
+    @property
+    def dropped(self) -> int:
+        return sum(queue_handler.dropped for _, _, queue_handler, _ in self._installed if queue_handler)
+
+    def stats(self) -> dict:
+        return {
+            "async": self.enabled,
+            "loggers": [logger.name for logger, _, _, _ in self._installed],
+            "queued": sum(queue_handler.queue.qsize() for _, _, queue_handler, _ in self._installed if queue_handler),
+            "dropped": self.dropped,
+        }
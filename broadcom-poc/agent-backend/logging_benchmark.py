@@ -0,0 +1,179 @@
+"""
+Benchmarks the logging overhead of /chat: agent-server.py's previous logging (every request logs the raw tool output,
+the full response object and the final response, formatted and written synchronously) against log_pipeline.py
+(records handed to a queue and written by a background thread, raw dumps sampled, messages truncated, the final
+response logged as lazy JSON).
+
+A stub FastAPI app serves /chat by doing exactly the log calls of one real /chat request against a synthetic
+Vectara tool output and agent response, and nothing else; httpx drives it in-process through ASGITransport. The
+logs go to a file in a temporary directory, as uvicorn's would go to a redirected stdout. A run without any logging
+gives the baseline, so the reported overhead is the latency each logging setup adds per request. The time to write
+out what is still queued when the run ends is reported separately; it is spent on the background thread.
+
+Run via one of the following (all arguments are optional):
+    python3 logging_benchmark.py
+    python3 logging_benchmark.py --requests 2000 --concurrency 20 --tool-output-kb 40 --raw-sample-rate 0.01
+"""
+
+import os
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+
+import httpx
+from fastapi import FastAPI
+
+from log_pipeline import AsyncLogging, LazyJson, RawDumpSampler
+
+RAW_DUMP_LOG_EXTRA = {"max_chars": 20000}
+
+
+def fake_tool_output(kb: int) -> str:
+    """Text shaped like the query_echostor_content output the agent callback receives as TOOL_OUTPUT."""
+    documents, index = [], 0
+    while sum(len(document) for document in documents) < kb * 1024:
+        documents.append(f"document='{{'id': 'doc-{index}', 'title': 'VMware vSphere upgrade guide, part {index}', "
+                         f"'url': 'https://docs.example.com/vsphere/{index}', 'text': '{'Upgrade the ESXi hosts. ' * 40}'}}'")
+        index += 1
+    return f"response: The upgrade path is documented in several guides.\nfcs_score: 0.87\n" + "\n".join(documents)
+
+
+class FakeAgentResponse:
+    """Stands in for the agent's response object, whose repr includes every source node."""
+
+    def __init__(self, tool_output: str):
+        self.response = "To upgrade vSphere, first upgrade vCenter, then the ESXi hosts. " * 5
+        self.sources = [tool_output]
+
+    def __repr__(self):
+        return f"AgentResponse(response={self.response!r}, sources={self.sources!r})"
+
+
+def log_chat_before(logger, message: str, tool_output: str, response_object, final_response: dict):
+    """The log calls of one /chat request before log_pipeline.py."""
+    logger.info(f"Received message: {message}")
+    logger.info(f"Agent Progress: Type=TOOL_OUTPUT, Msg Preview='{tool_output[:100]}...'")
+    logger.info(f"<<< RAW TOOL_OUTPUT MSG START >>>\n{tool_output}\n<<< RAW TOOL_OUTPUT MSG END >>>")
+    logger.info(f"Agent chat completed. Raw response text: {response_object.response}")
+    logger.info(f"Raw full response object: {response_object}")
+    logger.info(f"Returning final structured response: {final_response}")
+
+
+def log_chat_after(logger, message: str, tool_output: str, response_object, final_response: dict, log_raw: bool):
+    """The log calls of one /chat request with log_pipeline.py."""
+    logger.info("Received message: %s", message)
+    logger.info("Agent Progress: Type=%s, Msg Preview='%.100s...'", "TOOL_OUTPUT", tool_output)
+    if log_raw:
+        logger.info("<<< RAW TOOL_OUTPUT MSG START >>>\n%s\n<<< RAW TOOL_OUTPUT MSG END >>>", tool_output,
+                    extra=RAW_DUMP_LOG_EXTRA)
+    logger.info("Agent chat completed. Raw response text: %s", response_object.response)
+    if log_raw:
+        logger.info("Raw full response object: %s", response_object, extra=RAW_DUMP_LOG_EXTRA)
+    logger.info("Returning final structured response: %s", LazyJson(final_response))
+
+
+def create_stub_app(mode: str, logger: logging.Logger, tool_output: str, sampler: RawDumpSampler) -> FastAPI:
+    app = FastAPI()
+    response_object = FakeAgentResponse(tool_output)
+
+    @app.post("/chat")
+    async def chat(body: dict):
+        message = body["query"]
+        final_response = {
+            "response_text": response_object.response,
+            "fcs_score": 0.87,
+            "citations": [{"id": f"[{i + 1}]", "title": f"VMware vSphere upgrade guide, part {i}",
+                           "url": f"https://docs.example.com/vsphere/{i}"} for i in range(5)],
+        }
+        if mode == "before":
+            log_chat_before(logger, message, tool_output, response_object, final_response)
+        elif mode == "after":
+            log_chat_after(logger, message, tool_output, response_object, final_response, sampler.sample())
+        return final_response
+
+    return app
+
+
+async def drive(app: FastAPI, requests: int, concurrency: int) -> list:
+    """Send requests to /chat, concurrency at a time; returns each request's latency in seconds."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+
+        async def one(i: int):
+            async with semaphore:
+                start = time.perf_counter()
+                resp = await client.post("/chat", json={"query": f"How do I upgrade vSphere? ({i})"})
+                resp.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(one(i) for i in range(requests)))
+    return latencies
+
+
+def run(mode: str, args, tool_output: str, log_dir: str) -> dict:
+    path = os.path.join(log_dir, f"{mode}.log")
+    logger = logging.getLogger(f"logging-benchmark.{mode}")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter("%(levelname)s:     %(message)s"))
+    logger.addHandler(handler)
+
+    async_logging = AsyncLogging(max_queue=args.queue_size, max_message_chars=2000, enabled=True)
+    if mode == "after":
+        async_logging.start()
+
+    app = create_stub_app(mode, logger, tool_output, RawDumpSampler(args.raw_sample_rate))
+    asyncio.run(drive(app, args.requests // 10, args.concurrency))  # warm up
+    start = time.perf_counter()
+    latencies = sorted(asyncio.run(drive(app, args.requests, args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    drain_start = time.perf_counter()
+    dropped = async_logging.dropped
+    async_logging.stop()
+    drain = time.perf_counter() - drain_start
+    logger.removeHandler(handler)
+    handler.close()
+
+    return {
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+        "throughput": args.requests / elapsed,
+        "drain_ms": 1000 * drain,
+        "dropped": dropped,
+        "log_mb": os.path.getsize(path) / (1024 * 1024),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/chat logging overhead: synchronous full dumps vs. log_pipeline.py")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per run (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=10, help="Requests in flight at once (default: %(default)s)")
+    parser.add_argument("--tool-output-kb", type=int, default=30,
+                        help="Size of the synthetic RAG tool output (default: %(default)s)")
+    parser.add_argument("--raw-sample-rate", type=float, default=0.01,
+                        help="LOG_RAW_SAMPLE_RATE of the new pipeline (default: %(default)s)")
+    parser.add_argument("--queue-size", type=int, default=10000,
+                        help="LOG_QUEUE_MAX_RECORDS of the new pipeline (default: %(default)s)")
+    args = parser.parse_args()
+
+    tool_output = fake_tool_output(args.tool_output_kb)
+    print(f"{args.requests} /chat requests, {args.concurrency} concurrent, {len(tool_output) // 1024} KB tool output")
+    with tempfile.TemporaryDirectory() as log_dir:
+        results = {mode: run(mode, args, tool_output, log_dir) for mode in ("none", "before", "after")}
+
+    baseline = results["none"]["mean_ms"]
+    labels = {"none": "no logging (baseline)", "before": "sync, full dumps (before)", "after": "log_pipeline (after)"}
+    for mode, result in results.items():
+        print(f"{labels[mode]:<27} mean {result['mean_ms']:7.3f}ms (+{result['mean_ms'] - baseline:6.3f}ms)  "
+              f"p50 {result['p50_ms']:7.3f}ms  p99 {result['p99_ms']:7.3f}ms  {result['throughput']:7.0f} req/s  "
+              f"log {result['log_mb']:7.2f} MB  drain {result['drain_ms']:6.1f}ms  dropped {result['dropped']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+"""
+Prometheus-style metrics for agent-server.py, rendered in the Prometheus text exposition format by GET /metrics.
+
+Recording is lock-free: every thread (the event loop, each agent worker, the Jira client's loop) writes its samples
+into its own shard, a plain dict only that thread mutates, and a scrape sums the shards. The only lock is taken once
+per thread, when it records its first sample. Values that already live elsewhere (agent pool occupancy, OTP store
+size, Jira counters) are not recorded at all; they are read by callbacks at scrape time.
+
+A scrape running concurrently with a recording thread may see a histogram whose count and sum are one observation
+apart, which is fine for monitoring.
+"""
+
+import threading
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+def format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter:
+    """A monotonically increasing value per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, registry, name: str, help: str, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self.registry.shard()
+        key = (self.name, labelvalues)
+        shard[key] = shard.get(key, 0) + amount
+
+    def samples(self, merged: dict) -> list:
+        return [(self.name, format_labels(self.labelnames, labels), value) for labels, value in sorted(merged.items())]
+
+    @staticmethod
+    def merge(total, value):
+        return value if total is None else total + value
+
+
+class Histogram:
+    """
+    Counts observations into buckets per combination of label values. Each shard keeps per-bucket (not cumulative)
+    counts, with one extra slot for observations above the last bucket and a final slot for the sum.
+    """
+
+    type = "histogram"
+
+    def __init__(self, registry, name: str, help: str, labelnames=(), buckets=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labelvalues):
+        shard = self.registry.shard()
+        key = (self.name, labelvalues)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @staticmethod
+    def merge(total, value):
+        return list(value) if total is None else [a + b for a, b in zip(total, value)]
+
+    def samples(self, merged: dict) -> list:
+        samples = []
+        for labels, counts in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket",
+                                format_labels(self.labelnames + ("le",), labels + (format_value(bound),)), cumulative))
+            label_text = format_labels(self.labelnames, labels)
+            samples.append((f"{self.name}_sum", label_text, counts[-1]))
+            samples.append((f"{self.name}_count", label_text, cumulative))
+        return samples
+
+
+class CallbackMetric:
+    """
+    A gauge or counter read at scrape time. fn returns a number, None for no sample, or, with labelnames,
+    a dict of {label values tuple: number}.
+    """
+
+    def __init__(self, name: str, help: str, type: str, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def samples(self, merged=None) -> list:
+        value = self.fn()
+        if value is None:
+            return []
+        if not self.labelnames:
+            return [(self.name, "", value)]
+        return [(self.name, format_labels(self.labelnames, labels), v) for labels, v in sorted(value.items())
+                if v is not None]
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self._metrics = {}  # {name: metric}, in registration order
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._local = threading.local()
+        self.scrape_errors = 0
+
+    def shard(self) -> dict:
+        """The calling thread's own {(metric name, label values): value} dict."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._shards_lock:
+                self._shards.append(shard)
+            return shard
+
+    def counter(self, name: str, help: str, labelnames=()) -> Counter:
+        self._metrics[name] = Counter(self, name, help, labelnames)
+        return self._metrics[name]
+
+    def histogram(self, name: str, help: str, labelnames=(), buckets=()) -> Histogram:
+        self._metrics[name] = Histogram(self, name, help, labelnames, buckets)
+        return self._metrics[name]
+
+    def gauge_callback(self, name: str, help: str, fn, labelnames=()):
+        """Register (or replace) a gauge whose value is read by fn at scrape time."""
+        self._metrics[name] = CallbackMetric(name, help, "gauge", fn, labelnames)
+
+    def counter_callback(self, name: str, help: str, fn, labelnames=()):
+        """Register (or replace) a counter whose value is read by fn at scrape time."""
+        self._metrics[name] = CallbackMetric(name, help, "counter", fn, labelnames)
+
+    def _merge_shards(self) -> dict:
+        """{metric name: {label values: merged value}} over all threads' shards."""
+        with self._shards_lock:
+            shards = list(self._shards)
+        merged = {}
+        for shard in shards:
+            for (name, labels), value in shard.copy().items():
+                metric = self._metrics.get(name)
+                if metric is not None:
+                    values = merged.setdefault(name, {})
+                    values[labels] = metric.merge(values.get(labels), value)
+        return merged
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        merged = self._merge_shards()
+        lines = []
+        for name, metric in list(self._metrics.items()):
+            try:
+                samples = metric.samples(merged.get(name, {}))
+            except Exception:
+                self.scrape_errors += 1
+                continue
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            lines.extend(f"{sample}{labels} {format_value(value)}" for sample, labels, value in samples)
+        return "\n".join(lines) + "\n"
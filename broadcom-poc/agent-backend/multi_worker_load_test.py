@@ -0,0 +1,175 @@
+"""
+Load test of agent-server.py's multi-worker mode: throughput through session_router.py's router as workers are added,
+and whether every session stays on one worker.
+
+Each worker is a stub agent server. Its /chat holds one of a fixed number of agents (AGENT_POOL_SIZE) for the
+simulated duration of an agent call, mostly waiting on the LLM, plus some CPU work under the GIL, like the real
+callback parsing and response assembly. The stub counts turns per session; a session moved to another worker would
+start over at turn 1 and is reported as an affinity violation. The router and the workers run as separate processes,
+started exactly as agent-server.py starts them; only the agent is stubbed.
+
+One process serves at most AGENT_POOL_SIZE / agent latency requests per second. More workers add agents and, on a
+multi-core host, CPU. Throughput should grow close to linearly with the worker count until the cores or the router
+saturate.
+
+Run via one of the following (all arguments are optional):
+    python3 multi_worker_load_test.py
+    python3 multi_worker_load_test.py --workers 1 2 4 8 --sessions 400 --turns 5 --agent-latency-ms 200 --cpu-ms 2
+"""
+
+import os
+import sys
+import time
+import asyncio
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+
+from session_router import WorkerProcesses, create_router_app, port_in_use
+
+API_KEY = "load-test-api-key"
+
+
+def create_stub_worker_app(agents: int, agent_latency: float, cpu_seconds: float) -> FastAPI:
+    app = FastAPI()
+    agent_calls = ThreadPoolExecutor(max_workers=agents, thread_name_prefix="agent-call")
+    turns = {}  # {session: turns served by this worker}
+    lock = threading.Lock()
+
+    def agent_chat(session: str) -> int:
+        with lock:
+            turns[session] = turns.get(session, 0) + 1
+            turn = turns[session]
+        time.sleep(agent_latency)
+        deadline = time.thread_time() + cpu_seconds
+        while time.thread_time() < deadline:
+            pass
+        return turn
+
+    @app.post("/chat")
+    async def chat(request: Request):
+        body = await request.json()
+        turn = await asyncio.get_running_loop().run_in_executor(agent_calls, agent_chat, request.headers["session"])
+        return {"response_text": f"Answer to {body['query']}", "pid": os.getpid(), "turn": turn}
+
+    return app
+
+
+async def drive(port: int, sessions: int, turns: int, concurrency: int) -> dict:
+    """Each session sends turns requests one after another; up to concurrency sessions are active at once."""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, pids, violations, errors = [], {}, 0, 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=120) as client:
+
+        async def session_loop(index: int):
+            nonlocal violations, errors
+            session = f"load-test-session-{index}"
+            async with semaphore:
+                for turn in range(1, turns + 1):
+                    start = time.perf_counter()
+                    resp = await client.post("/chat", json={"query": f"question {turn}"},
+                                             headers={"X-API-Key": API_KEY, "session": session, "email": "a@b.com"})
+                    latencies.append(time.perf_counter() - start)
+                    if resp.status_code != 200:
+                        errors += 1
+                        continue
+                    result = resp.json()
+                    pids.setdefault(session, set()).add(result["pid"])
+                    if result["turn"] != turn:
+                        violations += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(session_loop(index) for index in range(sessions)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))],
+        "workers_used": len(set().union(*pids.values())),
+        "affinity_violations": violations + sum(1 for session_pids in pids.values() if len(session_pids) > 1),
+        "errors": errors,
+    }
+
+
+def run_router(args):
+    worker_args = [sys.executable, os.path.abspath(__file__), "--role", "worker",
+                   "--agents", str(args.agents), "--agent-latency-ms", str(args.agent_latency_ms),
+                   "--cpu-ms", str(args.cpu_ms)]
+    workers = WorkerProcesses(worker_args, workers=args.router_workers, base_port=args.base_port)
+    app = create_router_app(workers, endpoint_api_key=API_KEY, start_timeout=60)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def run_worker(args):
+    app = create_stub_worker_app(args.agents, args.agent_latency_ms / 1000, args.cpu_ms / 1000)
+    uvicorn.run(app, host="127.0.0.1", port=int(os.environ["AGENT_SERVER_WORKER_PORT"]), log_level="warning",
+                access_log=False)
+
+
+def load_test(args, workers: int) -> dict:
+    if port_in_use(args.port):
+        raise RuntimeError(f"Port {args.port} is already in use")
+    router = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--role", "router", "--router-workers", str(workers),
+         "--port", str(args.port), "--base-port", str(args.base_port), "--agents", str(args.agents),
+         "--agent-latency-ms", str(args.agent_latency_ms), "--cpu-ms", str(args.cpu_ms)])
+    try:
+        deadline = time.monotonic() + 60
+        while not port_in_use(args.port):
+            if router.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("The router did not start")
+            time.sleep(0.2)
+        return asyncio.run(drive(args.port, args.sessions, args.turns, args.concurrency))
+    finally:
+        router.terminate()
+        router.wait()
+        while port_in_use(args.port):
+            time.sleep(0.1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput and session affinity of the multi-worker mode")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        help="Worker counts to test (default: %(default)s)")
+    parser.add_argument("--sessions", type=int, default=200, help="Sessions per run (default: %(default)s)")
+    parser.add_argument("--turns", type=int, default=5, help="Requests per session (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="Sessions sending at once (default: %(default)s)")
+    parser.add_argument("--agents", type=int, default=4, help="AGENT_POOL_SIZE of each worker (default: %(default)s)")
+    parser.add_argument("--agent-latency-ms", type=float, default=200,
+                        help="Simulated agent call time, mostly LLM wait (default: %(default)s)")
+    parser.add_argument("--cpu-ms", type=float, default=2, help="CPU time per agent call (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8101, help="Router port (default: %(default)s)")
+    parser.add_argument("--base-port", type=int, default=9101, help="First worker port (default: %(default)s)")
+    parser.add_argument("--role", choices=["load", "router", "worker"], default="load", help=argparse.SUPPRESS)
+    parser.add_argument("--router-workers", type=int, default=1, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.role == "router":
+        return run_router(args)
+    if args.role == "worker":
+        return run_worker(args)
+
+    print(f"{args.sessions} sessions x {args.turns} turns, {args.concurrency} concurrent; per worker {args.agents} "
+          f"agents, {args.agent_latency_ms:.0f}ms agent calls, {args.cpu_ms:.0f}ms CPU; {os.cpu_count()} CPU cores")
+    per_worker = None
+    for workers in args.workers:
+        result = load_test(args, workers)
+        per_worker = per_worker or result["throughput"] / workers
+        print(f"{workers} workers: {result['throughput']:7.1f} req/s (scaling efficiency "
+              f"{result['throughput'] / (per_worker * workers):4.0%})  p50 {result['p50_ms']:7.1f}ms  p99 {result['p99_ms']:7.1f}ms  "
+              f"workers used {result['workers_used']}  affinity violations {result['affinity_violations']}  "
+              f"errors {result['errors']}")
+
+
+if __name__ == "__main__":
+    main()
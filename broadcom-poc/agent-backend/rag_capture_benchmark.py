@@ -0,0 +1,113 @@
+"""
+Benchmarks the CPU time agent-server.py spends per RAG tool output to get its FCS score and citations: parsing the
+stringified TOOL_OUTPUT in agent_progress_callback with regexes and ast.literal_eval (before), against capturing them
+as objects from the tool's raw_output with install_rag_result_capture / extract_rag_result, after which the callback
+returns without parsing (after).
+
+Each tool output has 10 documents of realistic length, some of whose snippets contain '}' (shell variables, JSON
+settings), as Vectara results often do. The regex stops at the first "}'" and drops those documents, so the number
+of citations each path recovers is reported too. Both paths run through the real functions in agent-server.py, with
+its log records going to a NullHandler so the numbers measure parsing rather than log output. The CPU time is that of
+the calling thread, which is an agent worker thread in the server.
+
+agent-server.py is imported as a module, so this needs its dependencies installed (pip install -r requirements.txt).
+
+Run via one of the following (all arguments are optional):
+    python3 rag_capture_benchmark.py
+    python3 rag_capture_benchmark.py --iterations 5000 --documents 10 --snippet-chars 1500
+"""
+
+import os
+import time
+import logging
+import argparse
+import importlib.util
+from types import SimpleNamespace
+
+
+def load_agent_server():
+    os.environ.setdefault("VECTARA_API_KEY", "benchmark")
+    os.environ.setdefault("VECTARA_CORPUS_KEY", "benchmark")
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent-server.py")
+    spec = importlib.util.spec_from_file_location("agent_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def fake_documents(count: int, snippet_chars: int) -> list:
+    """Documents like query_echostor_content's; every other snippet ends in a shell variable, i.e. with '}'."""
+    documents = []
+    for index in range(count):
+        text = ("Upgrade the ESXi hosts one cluster at a time and verify vMotion between them. " * 40)[:snippet_chars]
+        if index % 2:
+            text += " Then run: export VSPHERE_HOME=${VSPHERE_HOME}"
+        documents.append({"id": f"doc-{index}", "title": f"VMware vSphere upgrade guide, part {index}",
+                          "url": f"https://docs.example.com/vsphere/{index}", "text": text})
+    return documents
+
+
+def fake_tool_output(documents: list, fcs: float) -> str:
+    """The stringified TOOL_OUTPUT agent_progress_callback receives."""
+    return (f"response: The upgrade path is documented in several guides.\nfcs_score: {fcs}\n"
+            + "\n".join(f"document='{document}'" for document in documents))
+
+
+def cpu_time_per_call(fn, iterations: int) -> float:
+    """Mean CPU time of fn() on this thread, in seconds."""
+    for _ in range(max(iterations // 10, 1)):
+        fn()
+    start = time.thread_time()
+    for _ in range(iterations):
+        fn()
+    return (time.thread_time() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Callback CPU time per RAG tool output: text parsing vs. capture")
+    parser.add_argument("--iterations", type=int, default=2000, help="Tool outputs per path (default: %(default)s)")
+    parser.add_argument("--documents", type=int, default=10, help="Documents per tool output (default: %(default)s)")
+    parser.add_argument("--snippet-chars", type=int, default=1500,
+                        help="Length of each document's snippet (default: %(default)s)")
+    args = parser.parse_args()
+
+    server = load_agent_server()
+    logger = logging.getLogger("uvicorn.error")
+    logger.handlers = [logging.NullHandler()]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+
+    documents = fake_documents(args.documents, args.snippet_chars)
+    fcs = 0.87
+    tool_output = fake_tool_output(documents, fcs)
+    raw_output = {"fcs_score": fcs, "documents": documents}
+    tool = SimpleNamespace(call=lambda: SimpleNamespace(raw_output=raw_output), acall=None)
+    server.install_rag_result_capture(tool)
+
+    def before():
+        rag_result = server.new_rag_result()
+        server.current_rag_result.set(rag_result)
+        server.agent_progress_callback(server.AgentStatusType.TOOL_OUTPUT, tool_output)
+        return rag_result
+
+    def after():
+        rag_result = server.new_rag_result()
+        server.current_rag_result.set(rag_result)
+        tool.call()
+        server.agent_progress_callback(server.AgentStatusType.TOOL_OUTPUT, tool_output)
+        return rag_result
+
+    print(f"{args.iterations} tool outputs of {args.documents} documents ({len(tool_output) // 1024} KB), "
+          f"{args.documents // 2} snippets containing '}}'")
+    results = {}
+    for label, fn in (("regex + literal_eval (before)", before), ("structured capture (after)", after)):
+        citations = len(fn()["citations"])
+        results[label] = cpu_time_per_call(fn, args.iterations)
+        print(f"{label:<30} {1e6 * results[label]:8.1f} us CPU per tool output  "
+              f"citations recovered {citations}/{args.documents}")
+    before_time, after_time = results.values()
+    print(f"speedup {before_time / after_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Stress test of per-request RAG results: many concurrent /chat requests through agent-server.py's create_app, checking
+that every response carries only the FCS score and citations of its own agent call.
+
+Each request is answered by a stub agent whose call is interleaved with the other requests' calls on the agent worker
+threads. It reports a TOOL_CALL, sleeps, delivers a tool output unique to its request (a distinct FCS score and
+citations titled after the request), sleeps again and answers. Every other request's tool output is also captured as
+objects through install_rag_result_capture, so both the structured path and the TOOL_OUTPUT text parsing fallback of
+agent_progress_callback are exercised. Everything else, from the agent pool and the bounded executor to response
+assembly, is the real server code, driven in-process through httpx's ASGITransport.
+
+agent-server.py is imported as a module, so this needs its dependencies installed (pip install -r requirements.txt).
+No Vectara or LLM calls are made.
+
+Run via one of the following (all arguments are optional):
+    python3 rag_isolation_stress_test.py
+    python3 rag_isolation_stress_test.py --requests 2000 --concurrency 200 --agents 16 --max-delay-ms 20
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import importlib.util
+from types import SimpleNamespace
+
+import httpx
+
+API_KEY = "stress-test-api-key"
+CITATIONS_PER_RESPONSE = 3
+
+
+def load_agent_server(args):
+    """Import agent-server.py, configured for the test through its env variables."""
+    os.environ.setdefault("VECTARA_API_KEY", "stress-test")
+    os.environ.setdefault("VECTARA_CORPUS_KEY", "stress-test")
+    os.environ["AGENT_POOL_SIZE"] = str(args.agents)
+    os.environ["AGENT_CLAIM_TIMEOUT_SECONDS"] = "300"
+    os.environ["AGENT_CHAT_TIMEOUT_SECONDS"] = "300"
+    os.environ["LOG_RAW_SAMPLE_RATE"] = "0"
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "agent-server.py")
+    spec = importlib.util.spec_from_file_location("agent_server", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def request_fcs(index: int) -> float:
+    return round(0.1 + index / 100000, 5)
+
+
+def request_documents(index: int) -> list:
+    return [{"title": f"request-{index}-doc-{k}", "url": f"https://docs.example.com/{index}/{k}",
+             "text": f"Snippet {k} for request {index}"} for k in range(CITATIONS_PER_RESPONSE)]
+
+
+def tool_output_text(index: int) -> str:
+    """The stringified TOOL_OUTPUT agent_progress_callback parses when nothing was captured as objects."""
+    documents = "\n".join(f"document='{document}'" for document in request_documents(index))
+    return f"response: Answer for request {index}\nfcs_score: {request_fcs(index)}\n{documents}"
+
+
+class StubMemory:
+
+    def set(self, messages):
+        pass
+
+
+class StubAgent:
+    """Delivers the tool output of the request named in the message, with random pauses around it."""
+
+    def __init__(self, server, max_delay: float):
+        self.server = server
+        self.max_delay = max_delay
+        self.memory = StubMemory()
+        self.rag_tool = SimpleNamespace(call=self._rag_tool_call, acall=None)
+        server.install_rag_result_capture(self.rag_tool)
+
+    @staticmethod
+    def _rag_tool_call(index: int):
+        return SimpleNamespace(raw_output={"fcs_score": request_fcs(index), "documents": request_documents(index)})
+
+    def clear_memory(self):
+        pass
+
+    def chat(self, message: str):
+        index = int(message.rsplit(" ", 1)[1])
+        self.server.agent_progress_callback(self.server.AgentStatusType.TOOL_CALL, f"query_echostor_content({index})")
+        time.sleep(random.uniform(0, self.max_delay))
+        if index % 2 == 0:
+            self.rag_tool.call(index)
+        self.server.agent_progress_callback(self.server.AgentStatusType.TOOL_OUTPUT, tool_output_text(index))
+        time.sleep(random.uniform(0, self.max_delay))
+        return SimpleNamespace(response=f"Answer to request {index}")
+
+
+def check_response(index: int, result: dict) -> list:
+    """Return what is wrong with request index's response, if anything."""
+    problems = []
+    if result.get("fcs_score") != request_fcs(index):
+        problems.append(f"fcs_score {result.get('fcs_score')} instead of {request_fcs(index)}")
+    titles = [citation.get("title") for citation in result.get("citations", [])]
+    expected = [document["title"] for document in request_documents(index)]
+    if titles != expected:
+        problems.append(f"citations {titles} instead of {expected}")
+    return problems
+
+
+async def drive(app, requests: int, concurrency: int) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    leaks, errors = [], 0
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://stress-test",
+                                 timeout=300) as client:
+
+        async def one(index: int):
+            nonlocal errors
+            async with semaphore:
+                resp = await client.post("/chat", json={"query": f"request {index}"},
+                                         headers={"X-API-Key": API_KEY, "session": f"stress-test-session-{index}",
+                                                  "email": "a@b.com"})
+            if resp.status_code != 200:
+                errors += 1
+                return
+            problems = check_response(index, resp.json())
+            if problems:
+                leaks.append((index, problems))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(index) for index in range(requests)))
+        elapsed = time.perf_counter() - start
+
+    return {"elapsed": elapsed, "leaks": leaks, "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent /chat requests must only see their own FCS and citations")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests to send (default: %(default)s)")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="Requests in flight at once (default: %(default)s)")
+    parser.add_argument("--agents", type=int, default=16,
+                        help="AGENT_POOL_SIZE, i.e. agent calls running at once (default: %(default)s)")
+    parser.add_argument("--max-delay-ms", type=float, default=10,
+                        help="Max random pause before and after each tool output (default: %(default)s)")
+    args = parser.parse_args()
+
+    server = load_agent_server(args)
+    app = server.create_app(lambda: StubAgent(server, args.max_delay_ms / 1000),
+                            SimpleNamespace(endpoint_api_key=API_KEY))
+    result = asyncio.run(drive(app, args.requests, args.concurrency))
+
+    print(f"{args.requests} /chat requests, {args.concurrency} concurrent, {args.agents} agents: "
+          f"{result['elapsed']:.1f}s, {len(result['leaks'])} responses with another request's RAG result, "
+          f"{result['errors']} errors")
+    for index, problems in result["leaks"][:10]:
+        print(f"  request {index}: {'; '.join(problems)}")
+    if result["leaks"] or result["errors"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+Multi-worker serving for agent-server.py.
+
+Each worker is a separate agent-server process with its own agent pool, listening on 127.0.0.1. WorkerProcesses
+starts them and restarts any that exit. The router app listens on the public port and forwards every request, streams
+included, to one worker. The worker is picked from the request's session header, so all of a session's requests
+reach the worker whose agent holds its conversation. Requests without a session, like /otp/send and /otp/verify, are
+picked by client IP. Any worker can serve those, because OTPs and accounts live in stores the workers share.
+
+Workers see the client's address through X-Forwarded-For, which uvicorn trusts from 127.0.0.1 by default. The router
+sets it to the address the client connected from, replacing any X-Forwarded-For the client sent.
+"""
+
+import os
+import sys
+import time
+import zlib
+import socket
+import asyncio
+import logging
+import subprocess
+
+import httpx
+from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.security.api_key import APIKeyHeader
+from starlette.background import BackgroundTask
+
+# Not forwarded: they describe one hop, and httpx/uvicorn set their own
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization", "te", "trailer",
+                      "transfer-encoding", "upgrade", "host", "content-length"}
+# Not forwarded to workers either: workers trust X-Forwarded-For from the router, so a client could spoof its address
+REQUEST_SKIP_HEADERS = HOP_BY_HOP_HEADERS | {"x-forwarded-for"}
+# Not copied from the worker's response: the router's uvicorn adds its own
+RESPONSE_SKIP_HEADERS = (HOP_BY_HOP_HEADERS - {"content-length"}) | {"date", "server"}
+PROXY_METHODS = ["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "HEAD"]
+
+api_key_header = APIKeyHeader(name="X-API-Key")
+
+
+def worker_index(key: str, workers: int) -> int:
+    """Stable across processes and restarts, unlike hash()."""
+    return zlib.crc32(key.encode("utf-8")) % workers
+
+
+def port_in_use(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(("127.0.0.1", port)) == 0
+
+
+class WorkerProcesses:
+    """
+    Runs command once per worker, with AGENT_SERVER_WORKER_INDEX and AGENT_SERVER_WORKER_PORT set in its environment,
+    and restarts workers that exit until stop() is called.
+    """
+
+    def __init__(self, command: list, workers: int, base_port: int, env: dict = None):
+        self.command = command
+        self.ports = [base_port + index for index in range(workers)]
+        self.env = env or {}
+        self._procs = [None] * workers
+        self._stopping = False
+        self.restarts = 0
+
+    @property
+    def urls(self) -> list:
+        return [f"http://127.0.0.1:{port}" for port in self.ports]
+
+    def _spawn(self, index: int):
+        env = {**os.environ, **self.env,
+               "AGENT_SERVER_WORKER_INDEX": str(index), "AGENT_SERVER_WORKER_PORT": str(self.ports[index])}
+        self._procs[index] = subprocess.Popen(self.command, env=env)
+
+    def start(self):
+        busy = [port for port in self.ports if port_in_use(port)]
+        if busy:
+            raise RuntimeError(f"Worker ports already in use: {busy}")
+        for index in range(len(self.ports)):
+            self._spawn(index)
+
+    async def wait_ready(self, timeout: float):
+        """Wait until every worker accepts connections; raises TimeoutError if one doesn't within timeout."""
+        deadline = time.monotonic() + timeout
+        for index, port in enumerate(self.ports):
+            while True:
+                try:
+                    _, writer = await asyncio.open_connection("127.0.0.1", port)
+                    writer.close()
+                    break
+                except OSError:
+                    if self._procs[index].poll() is not None:
+                        raise RuntimeError(f"Worker {index} exited with code {self._procs[index].returncode}")
+                    if time.monotonic() > deadline:
+                        raise TimeoutError(f"Worker {index} not listening on port {port} after {timeout}s")
+                    await asyncio.sleep(0.2)
+
+    async def monitor(self, interval: float = 1):
+        logger = logging.getLogger("uvicorn.error")
+        while not self._stopping:
+            await asyncio.sleep(interval)
+            for index, proc in enumerate(self._procs):
+                if proc is not None and proc.poll() is not None and not self._stopping:
+                    logger.error(f"Worker {index} (pid {proc.pid}) exited with code {proc.returncode}; restarting it. "
+                                 f"Its sessions lose any conversation not kept in a shared store.")
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def stop(self, timeout: float = 10):
+        self._stopping = True
+        for proc in self._procs:
+            if proc is not None and proc.poll() is None:
+                proc.terminate()
+        deadline = time.monotonic() + timeout
+        for proc in self._procs:
+            if proc is None:
+                continue
+            try:
+                proc.wait(max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    def stats(self) -> list:
+        return [{"index": index, "port": port, "pid": proc.pid if proc else None,
+                 "alive": proc is not None and proc.poll() is None}
+                for index, (port, proc) in enumerate(zip(self.ports, self._procs))]
+
+
+def create_router_app(workers: WorkerProcesses, endpoint_api_key: str, start_timeout: float = 300,
+                      read_timeout: float = 180) -> FastAPI:
+    """
+    FastAPI app forwarding every request to the worker owning its session. Starts the workers on startup and stops
+    them on shutdown. A worker that sends nothing for read_timeout seconds gets its request dropped with a 504; it
+    should be longer than the worker's own claim and agent call timeouts.
+    """
+    app = FastAPI()
+    logger = logging.getLogger("uvicorn.error")
+    worker_urls = workers.urls
+    forwarded = [0] * len(worker_urls)
+    errors = [0] * len(worker_urls)
+    client = httpx.AsyncClient(timeout=httpx.Timeout(10, read=read_timeout),
+                               limits=httpx.Limits(max_connections=None, max_keepalive_connections=256))
+
+    @app.on_event("startup")
+    async def start_workers():
+        workers.start()
+        await workers.wait_ready(start_timeout)
+        app.state.worker_monitor = asyncio.create_task(workers.monitor())
+        logger.info(f"Routing sessions to {len(worker_urls)} workers: {workers.stats()}")
+
+    @app.on_event("shutdown")
+    async def stop_workers():
+        await client.aclose()
+        workers.stop()
+
+    @app.get("/router/stats", summary="Requests forwarded to each worker, and the workers' processes")
+    async def router_stats(api_key: str = Depends(api_key_header)):
+        if api_key != endpoint_api_key:
+            logger.warning("Unauthorized access attempt")
+            raise HTTPException(status_code=403, detail="Unauthorized")
+
+        return {"restarts": workers.restarts,
+                "workers": [{**stats, "forwarded": forwarded[index], "errors": errors[index]}
+                            for index, stats in enumerate(workers.stats())]}
+
+    @app.api_route("/{path:path}", methods=PROXY_METHODS, include_in_schema=False)
+    async def forward(request: Request, path: str):
+        client_host = request.client.host if request.client else "unknown"
+        index = worker_index(request.headers.get("session") or client_host, len(worker_urls))
+
+        headers = [(name, value) for name, value in request.headers.items() if name not in REQUEST_SKIP_HEADERS]
+        headers.append(("x-forwarded-for", client_host))
+        upstream_request = client.build_request(request.method, f"{worker_urls[index]}/{path}",
+                                                params=request.query_params, headers=headers,
+                                                content=await request.body())
+        try:
+            upstream = await client.send(upstream_request, stream=True)
+        except httpx.ReadTimeout:
+            errors[index] += 1
+            logger.error(f"Worker {index} sent no response to {request.method} /{path} within {read_timeout}s")
+            return JSONResponse({"detail": "The server took too long to respond."}, status_code=504)
+        except httpx.TransportError as e:
+            errors[index] += 1
+            logger.error(f"Worker {index} unreachable for {request.method} /{path}: {e}")
+            return JSONResponse({"detail": "The server is restarting. Please try again shortly."}, status_code=503)
+
+        forwarded[index] += 1
+        response = StreamingResponse(upstream.aiter_raw(), status_code=upstream.status_code,
+                                     background=BackgroundTask(upstream.aclose))
+        # Appended one by one, so repeated headers like Set-Cookie aren't merged into one
+        for name, value in upstream.headers.multi_items():
+            if name not in RESPONSE_SKIP_HEADERS:
+                response.headers.append(name, value)
+        return response
+
+    return app
+
+
+def worker_command() -> list:
+    """Command line re-running the current script, as each worker process."""
+    return [sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:]
@@ -0,0 +1,281 @@
+"""
+Per-request latency tracing for agent-server.py.
+
+A request opens a trace (tracer.trace) carrying a correlation id, the client's session header, and timed spans are
+opened inside it with tracer.span. The current trace and span live in context vars, so spans opened by agent calls
+and tools on worker threads (which run in a copy of the request's context) join the request's trace with the right
+parent. Spans that are only known after the fact, like the LLM reasoning between two tool calls, are added with
+tracer.record.
+
+Finished spans go to an in-process ring buffer, which also keeps per-span-name latency percentiles for the admin
+endpoint, and are handed to the other exporters on a background thread so the request path never does file or
+network I/O:
+* JsonlSpanExporter writes one JSON span per line.
+* OtlpJsonSpanExporter writes OTLP/JSON (the OpenTelemetry protocol's JSON encoding) to a file, or posts it to an
+  OTLP/HTTP collector, e.g. http://localhost:4318/v1/traces.
+"""
+
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+
+EXPORT_BATCH_SIZE = 512
+EXPORT_QUEUE_MAX_SPANS = 100000
+PERCENTILES = [50, 95, 99]
+
+current_trace = contextvars.ContextVar("current_trace", default=None)
+current_span_id = contextvars.ContextVar("current_span_id", default=None)
+
+
+def new_id(num_bytes: int) -> str:
+    return os.urandom(num_bytes).hex()
+
+
+class RingBufferSpanExporter:
+    """
+    Keeps the most recent spans, and the most recent durations of each span name for latency percentiles.
+    Appending to a deque is atomic, so export can be called from any thread without a lock.
+    """
+
+    def __init__(self, max_spans: int, window: int = 1000):
+        self.window = window
+        self._spans = deque(maxlen=max_spans)
+        self._durations = {}  # {span name: deque of recent durations in ms}
+
+    def export(self, spans: list):
+        for span in spans:
+            self._spans.append(span)
+            durations = self._durations.get(span["name"])
+            if durations is None:
+                durations = self._durations.setdefault(span["name"], deque(maxlen=self.window))
+            durations.append(span["duration_ms"])
+
+    def recent(self, limit: int = 100, correlation_id: str = None) -> list:
+        spans = [span for span in list(self._spans) if correlation_id is None or span["correlation_id"] == correlation_id]
+        return spans[-limit:]
+
+    def latency_stats(self) -> dict:
+        """{span name: count, p50/p95/p99 and max duration in ms} over each name's recent spans."""
+        stats = {}
+        for name, durations in list(self._durations.items()):
+            values = sorted(durations)
+            if not values:
+                continue
+            stats[name] = {"count": len(values), "max_ms": round(values[-1], 3)}
+            for p in PERCENTILES:
+                stats[name][f"p{p}_ms"] = round(values[min(len(values) - 1, int(p / 100 * len(values)))], 3)
+        return dict(sorted(stats.items()))
+
+    def close(self):
+        pass
+
+
+class JsonlSpanExporter:
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, "a", encoding="utf-8")
+
+    def export(self, spans: list):
+        self._file.write("".join(json.dumps(span) + "\n" for span in spans))
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class OtlpJsonSpanExporter:
+    """Exports spans as OTLP/JSON ExportTraceServiceRequests: posted to an http(s) endpoint, or appended to a file."""
+
+    def __init__(self, target: str, service_name: str):
+        self.target = target
+        self.service_name = service_name
+        self._file = None if target.startswith(("http://", "https://")) else open(target, "a", encoding="utf-8")
+
+    @staticmethod
+    def attribute(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def to_otlp(self, spans: list) -> dict:
+        otlp_spans = []
+        for span in spans:
+            attributes = {"correlation_id": span["correlation_id"], **span["attributes"]}
+            otlp_span = {
+                "traceId": span["trace_id"],
+                "spanId": span["span_id"],
+                "name": span["name"],
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(span["start_ns"]),
+                "endTimeUnixNano": str(span["start_ns"] + int(span["duration_ms"] * 1e6)),
+                "attributes": [self.attribute(key, value) for key, value in attributes.items() if value is not None],
+                "status": {"code": 2, "message": span["error"]} if span["error"] else {"code": 1},
+            }
+            if span["parent_id"]:
+                otlp_span["parentSpanId"] = span["parent_id"]
+            otlp_spans.append(otlp_span)
+
+        return {"resourceSpans": [{
+            "resource": {"attributes": [self.attribute("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "agent-server"}, "spans": otlp_spans}],
+        }]}
+
+    def export(self, spans: list):
+        body = json.dumps(self.to_otlp(spans))
+        if self._file:
+            self._file.write(body + "\n")
+            self._file.flush()
+            return
+        request = urllib.request.Request(self.target, data=body.encode("utf-8"), method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            resp.read()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class Tracer:
+    """
+    Creates traces and spans. Finished spans go straight to the ring buffer and are queued for the background
+    exporters; if those fall behind by more than EXPORT_QUEUE_MAX_SPANS, further spans are dropped (and counted)
+    rather than slowing requests down.
+    """
+
+    def __init__(self, ring_buffer: RingBufferSpanExporter, exporters: list = (), enabled: bool = True):
+        self.enabled = enabled
+        self.ring_buffer = ring_buffer
+        self.exporters = list(exporters)
+        self._queue = queue.Queue(maxsize=EXPORT_QUEUE_MAX_SPANS)
+        self._thread = None
+        if self.exporters:
+            self._thread = threading.Thread(target=self._export_loop, name="span-exporter", daemon=True)
+            self._thread.start()
+
+        self.spans = 0
+        self.dropped = 0
+        self.export_errors = 0
+
+    @contextlib.contextmanager
+    def trace(self, name: str, correlation_id: str = None, **attributes):
+        """
+        Open a new trace for one request, with a root span covering the with block.
+        The root span is yielded, and can be renamed by setting its "name" before the block ends.
+        """
+        if not self.enabled:
+            yield None
+            return
+        trace = {"trace_id": new_id(16), "correlation_id": correlation_id, "mark": time.perf_counter()}
+        token = current_trace.set(trace)
+        try:
+            with self.span(name, **attributes) as root:
+                yield root
+        finally:
+            current_trace.reset(token)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """Time the with block as a child of the current span. Outside of a trace this does nothing."""
+        trace = current_trace.get()
+        if trace is None:
+            yield None
+            return
+
+        span = {"span_id": new_id(8), "parent_id": current_span_id.get(), "attributes": attributes, "error": None}
+        token = current_span_id.set(span["span_id"])
+        start_ns = time.time_ns()
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span["error"] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            current_span_id.reset(token)
+            self._finish(trace, name, span, start_ns, (time.perf_counter() - start) * 1000)
+
+    def record(self, name: str, start: float, end: float = None, **attributes):
+        """Add an already finished span of the current trace, timed by perf_counter values."""
+        trace = current_trace.get()
+        if trace is None:
+            return
+        end = time.perf_counter() if end is None else end
+        span = {"span_id": new_id(8), "parent_id": current_span_id.get(), "attributes": attributes, "error": None}
+        start_ns = time.time_ns() - int((time.perf_counter() - start) * 1e9)
+        self._finish(trace, name, span, start_ns, (end - start) * 1000)
+
+    def mark(self) -> float:
+        """Move the current trace's mark to now; returns the previous mark (a perf_counter value)."""
+        trace = current_trace.get()
+        now = time.perf_counter()
+        if trace is None:
+            return now
+        previous, trace["mark"] = trace["mark"], now
+        return previous
+
+    def _finish(self, trace: dict, name: str, span: dict, start_ns: int, duration_ms: float):
+        span.update({
+            "trace_id": trace["trace_id"],
+            "correlation_id": trace["correlation_id"],
+            "name": span.get("name") or name,
+            "start_ns": start_ns,
+            "duration_ms": round(duration_ms, 3),
+        })
+        self.spans += 1
+        self.ring_buffer.export([span])
+        if self._thread:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped += 1
+
+    def _export_loop(self):
+        logger = logging.getLogger("uvicorn.error")
+        while True:
+            spans = [self._queue.get()]
+            while len(spans) < EXPORT_BATCH_SIZE:
+                try:
+                    spans.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in spans:
+                spans.remove(None)
+                self._export(spans, logger)
+                return
+            self._export(spans, logger)
+
+    def _export(self, spans: list, logger):
+        for exporter in self.exporters:
+            if not spans:
+                break
+            try:
+                exporter.export(spans)
+            except Exception as e:
+                self.export_errors += 1
+                logger.warning(f"Error exporting {len(spans)} spans with {type(exporter).__name__}: {e}")
+
+    def stats(self) -> dict:
+        return {"enabled": self.enabled, "spans": self.spans, "dropped": self.dropped,
+                "export_errors": self.export_errors, "export_queue": self._queue.qsize()}
+
+    def close(self):
+        """Export the queued spans and close the exporters."""
+        if self._thread:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        for exporter in self.exporters:
+            exporter.close()
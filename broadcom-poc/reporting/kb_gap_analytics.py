@@ -0,0 +1,150 @@
+"""
+  Columnar score analytics for kb_gap_report.py.
+
+  The scores of every stored query in the report window are loaded into NumPy arrays once, and the distribution
+  analytics (percentiles, histograms, per-day trends, mean score by search result rank, and the correlation between
+  search relevance and FCS) are computed in bulk over those arrays rather than per query in Python.
+"""
+
+import html
+import json
+
+import numpy as np
+
+PERCENTILES = [10, 25, 50, 75, 90]
+HISTOGRAM_BINS = 10
+
+
+def load_score_arrays(store, since: str = None, until: str = None):
+  """Load the scores of the stored queries in the window as arrays; a missing FCS is NaN."""
+  started_at, relevance, fcs, search_scores = store.get_score_columns(since, until)
+
+  days = np.array([(value or "unknown")[:10] for value in started_at], dtype=str)
+  relevance = np.array(relevance, dtype=float)
+  fcs = np.array([np.nan if value is None else value for value in fcs], dtype=float)
+
+  # Decode every row's score vector in one JSON parse, then scatter it into a NaN-padded (queries x rank) matrix
+  score_vectors = json.loads("[" + ",".join(search_scores) + "]")
+  lengths = np.array([len(vector) for vector in score_vectors], dtype=int)
+  max_rank = int(lengths.max()) if len(lengths) else 0
+  search_score_matrix = np.full((len(score_vectors), max_rank), np.nan)
+  if max_rank:
+    flat_scores = np.fromiter((score for vector in score_vectors for score in vector), dtype=float, count=int(lengths.sum()))
+    search_score_matrix[np.arange(max_rank) < lengths[:, None]] = flat_scores
+
+  return { "days": days, "relevance": relevance, "fcs": fcs, "search_scores": search_score_matrix }
+
+
+def compute_analytics(arrays: dict, avg_search_result_relevance_threshold: float, fcs_threshold: float):
+  relevance = arrays["relevance"]
+  fcs = arrays["fcs"]
+  has_fcs = ~np.isnan(fcs)
+
+  analytics = {
+    "num_queries": len(relevance),
+    "relevance_percentiles": percentiles(relevance),
+    "fcs_percentiles": percentiles(fcs[has_fcs]),
+    "relevance_histogram": np.histogram(relevance, bins=HISTOGRAM_BINS, range=(0, 1))[0],
+    "fcs_histogram": np.histogram(fcs[has_fcs], bins=HISTOGRAM_BINS, range=(0, 1))[0],
+    "relevance_fcs_correlation": correlation(relevance[has_fcs], fcs[has_fcs]),
+    "mean_score_by_rank": [],
+    "daily_trends": [],
+  }
+
+  search_scores = arrays["search_scores"]
+  if search_scores.size:
+    analytics["mean_score_by_rank"] = np.nanmean(search_scores, axis=0)
+
+  if len(relevance):
+    days, day_index = np.unique(arrays["days"], return_inverse=True)
+    num_queries_per_day = np.bincount(day_index, minlength=len(days))
+    relevance_sum_per_day = np.bincount(day_index, weights=relevance, minlength=len(days))
+    low_relevance_per_day = np.bincount(day_index, weights=relevance < avg_search_result_relevance_threshold,
+                                        minlength=len(days))
+    num_fcs_per_day = np.bincount(day_index, weights=has_fcs, minlength=len(days))
+    fcs_sum_per_day = np.bincount(day_index, weights=np.where(has_fcs, fcs, 0), minlength=len(days))
+    low_fcs_per_day = np.bincount(day_index, weights=has_fcs & (np.nan_to_num(fcs, nan=1) < fcs_threshold),
+                                  minlength=len(days))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+      fcs_avg_per_day = fcs_sum_per_day / num_fcs_per_day
+    analytics["daily_trends"] = [
+      { "day": str(days[i]),
+        "num_queries": int(num_queries_per_day[i]),
+        "search_relevance_score_avg": relevance_sum_per_day[i] / num_queries_per_day[i],
+        "num_queries_with_low_search_relevance_score": int(low_relevance_per_day[i]),
+        "fcs_avg": fcs_avg_per_day[i],
+        "num_queries_with_low_fcs": int(low_fcs_per_day[i]) }
+      for i in range(len(days))
+    ]
+
+  return analytics
+
+
+def percentiles(values: np.ndarray):
+  if not len(values):
+    return {}
+  return dict(zip(PERCENTILES, np.percentile(values, PERCENTILES)))
+
+
+def correlation(x: np.ndarray, y: np.ndarray):
+  """Pearson correlation of x and y, or None if there are too few points or either is constant."""
+  if len(x) < 2 or np.std(x) == 0 or np.std(y) == 0:
+    return None
+  return float(np.corrcoef(x, y)[0, 1])
+
+
+def format_score(value):
+  if value is None or np.isnan(value):
+    return "n/a"
+  return f"{value:.2f}"
+
+
+def build_table_html(header: list, rows: list):
+  parts = ["<table style=\"border-collapse: collapse\"><tr>"]
+  parts.extend(f"<th style=\"text-align: left; padding-right: 1em\">{html.escape(str(cell))}</th>" for cell in header)
+  parts.append("</tr>")
+  for row in rows:
+    parts.append("<tr>")
+    parts.extend(f"<td style=\"padding-right: 1em\">{html.escape(str(cell))}</td>" for cell in row)
+    parts.append("</tr>")
+  parts.append("</table>")
+  return "".join(parts)
+
+
+def build_analytics_html(analytics: dict):
+  if not analytics["num_queries"]:
+    return ""
+
+  parts = ["<p>&nbsp;</p>", "<p><b>Score Distribution</b></p>"]
+
+  header = ["Score"] + [f"p{p}" for p in PERCENTILES]
+  rows = [["Search Result Relevance"] + [format_score(v) for v in analytics["relevance_percentiles"].values()]]
+  if analytics["fcs_percentiles"]:
+    rows.append(["Confidence (FCS)"] + [format_score(v) for v in analytics["fcs_percentiles"].values()])
+  parts.append(build_table_html(header, rows))
+
+  bin_edges = np.linspace(0, 1, HISTOGRAM_BINS + 1)
+  rows = [[f"{bin_edges[i]:.1f} - {bin_edges[i + 1]:.1f}", int(analytics["relevance_histogram"][i]),
+           int(analytics["fcs_histogram"][i])] for i in range(HISTOGRAM_BINS)]
+  parts.append("<p>&nbsp;</p>")
+  parts.append(build_table_html(["Score Range", "Queries by Relevance", "Queries by FCS"], rows))
+
+  parts.append("<p>&nbsp;</p>")
+  parts.append(f"<p><b>Correlation between Search Result Relevance and FCS:</b> "
+               f"{format_score(analytics['relevance_fcs_correlation'])}</p>")
+
+  if len(analytics["mean_score_by_rank"]):
+    parts.append("<p><b>Average Search Result Score by Rank:</b> " +
+                 ", ".join(f"#{rank + 1}: {format_score(score)}"
+                           for rank, score in enumerate(analytics["mean_score_by_rank"])) + "</p>")
+
+  if analytics["daily_trends"]:
+    rows = [[trend["day"], trend["num_queries"], format_score(trend["search_relevance_score_avg"]),
+             trend["num_queries_with_low_search_relevance_score"], format_score(trend["fcs_avg"]),
+             trend["num_queries_with_low_fcs"]] for trend in analytics["daily_trends"]]
+    parts.append("<p>&nbsp;</p>")
+    parts.append("<p><b>Daily Trends</b></p>")
+    parts.append(build_table_html(["Day", "Queries", "Avg Relevance", "Low Relevance", "Avg FCS", "Low FCS"], rows))
+
+  return "".join(parts)
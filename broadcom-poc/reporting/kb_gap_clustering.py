@@ -0,0 +1,265 @@
+"""
+  Topic clustering of low-scoring queries for kb_gap_report.py.
+
+  Queries are embedded fully offline as signed, feature-hashed TF-IDF vectors of their words and word pairs, and
+  grouped with mini-batch spherical k-means. Each iteration only touches a fixed-size batch, the number of iterations
+  grows with the number of queries (KMEANS_EPOCHS passes over them, within bounds) and stops early once the centers
+  settle, and the final assignment is one pass over the queries, so the cost is linear in the number of queries
+  rather than quadratic. Centers that stop attracting queries are reseeded on the queries they fit worst. Clusters are
+  ranked by size and summarized with their top terms, the most representative query and example responses.
+
+  Past MAX_CLUSTERED_QUERIES low-scoring queries, a uniform random sample of them is clustered (see ReservoirSample),
+  so memory stays bounded however many there are; cluster sizes are scaled back up to the full count.
+"""
+
+import re
+import math
+import zlib
+import random
+
+import numpy as np
+
+EMBEDDING_DIMS = 256
+MAX_CLUSTERS = 100
+MAX_CLUSTERED_QUERIES = 20000
+KMEANS_BATCH_SIZE = 1024
+KMEANS_EPOCHS = 3  # expected number of times each query is sampled
+KMEANS_MIN_ITERATIONS = 100
+KMEANS_MAX_ITERATIONS = 2000
+KMEANS_TOLERANCE = 1e-4  # stop once no center's cosine similarity to its previous position drops by more
+KMEANS_REASSIGN_INTERVAL = 10  # iterations between checks for centers to reseed
+KMEANS_REASSIGN_RATIO = 0.01  # reseed centers with fewer points than this fraction of the largest center's
+KMEANS_INIT_SAMPLE_PER_CLUSTER = 20  # k-means++ seeding runs on a sample of this many queries per cluster
+KMEANS_RESTARTS = 5  # k-means runs from different seeds; the one whose centers fit the queries best is kept
+ASSIGN_CHUNK_SIZE = 8192
+NUM_TOP_TERMS = 3
+NUM_EXAMPLE_QUERIES = 5
+NUM_EXAMPLE_RESPONSES = 3
+
+STOP_WORDS = {
+  "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "if", "in", "is",
+  "it", "me", "my", "of", "on", "or", "so", "that", "the", "this", "to", "we", "what", "when", "where", "which", "who",
+  "why", "will", "with", "you", "your",
+  # Conversational filler, which says nothing about the topic but would make rare word pairs with the words around it
+  "again", "hello", "help", "hey", "hi", "need", "please", "question", "quick", "thank", "thanks", "today", "urgent",
+}
+
+
+def tokenize(text: str):
+  """Lowercased words (minus stop words) and adjacent word pairs of `text`."""
+  words = [word for word in re.findall(r"[a-z0-9]+", (text or "").lower()) if word not in STOP_WORDS]
+  return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+def build_term_matrix(texts: list):
+  """Return (doc_ids, term_ids, tf-idf weights) of the non-zero doc/term pairs, plus the term vocabulary."""
+  vocabulary = {}
+  doc_ids = []
+  term_ids = []
+  counts = []
+  for doc_id, text in enumerate(texts):
+    term_counts = {}
+    for term in tokenize(text):
+      term_id = vocabulary.setdefault(term, len(vocabulary))
+      term_counts[term_id] = term_counts.get(term_id, 0) + 1
+    doc_ids.extend([doc_id] * len(term_counts))
+    term_ids.extend(term_counts.keys())
+    counts.extend(term_counts.values())
+
+  doc_ids = np.array(doc_ids, dtype=np.int64)
+  term_ids = np.array(term_ids, dtype=np.int64)
+  document_frequency = np.bincount(term_ids, minlength=len(vocabulary))
+  idf = np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+  weights = np.array(counts, dtype=np.float32) * idf[term_ids].astype(np.float32)
+
+  terms = [None] * len(vocabulary)
+  for term, term_id in vocabulary.items():
+    terms[term_id] = term
+  return doc_ids, term_ids, weights, terms
+
+
+def embed(num_docs: int, doc_ids: np.ndarray, term_ids: np.ndarray, weights: np.ndarray, terms: list):
+  """Hash every term into a signed bucket of an EMBEDDING_DIMS vector and L2-normalize each doc's vector."""
+  term_hashes = np.array([zlib.crc32(term.encode("utf-8")) for term in terms], dtype=np.int64)
+  buckets = term_hashes % EMBEDDING_DIMS
+  signs = np.where((term_hashes >> 16) & 1, 1, -1).astype(np.float32)
+
+  embeddings = np.zeros((num_docs, EMBEDDING_DIMS), dtype=np.float32)
+  np.add.at(embeddings, (doc_ids, buckets[term_ids]), signs[term_ids] * weights)
+  norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+  return embeddings / np.maximum(norms, 1e-12)
+
+
+def assign_clusters(embeddings: np.ndarray, centers: np.ndarray):
+  """Return each doc's nearest center and its cosine similarity, a chunk of docs at a time."""
+  assignments = np.empty(len(embeddings), dtype=np.int64)
+  similarities = np.empty(len(embeddings), dtype=np.float32)
+  for start in range(0, len(embeddings), ASSIGN_CHUNK_SIZE):
+    scores = embeddings[start:start + ASSIGN_CHUNK_SIZE] @ centers.T
+    assignments[start:start + ASSIGN_CHUNK_SIZE] = scores.argmax(axis=1)
+    similarities[start:start + ASSIGN_CHUNK_SIZE] = scores.max(axis=1)
+  return assignments, similarities
+
+
+def kmeans_iterations(num_docs: int):
+  batch_size = min(KMEANS_BATCH_SIZE, num_docs)
+  return min(KMEANS_MAX_ITERATIONS, max(KMEANS_MIN_ITERATIONS, math.ceil(KMEANS_EPOCHS * num_docs / batch_size)))
+
+
+def kmeans_plus_plus(embeddings: np.ndarray, num_clusters: int, rng: np.random.Generator):
+  """Pick initial centers spread across the data (k-means++ over cosine distance) from a sample of the docs."""
+  sample_size = min(len(embeddings), max(KMEANS_BATCH_SIZE, KMEANS_INIT_SAMPLE_PER_CLUSTER * num_clusters))
+  sample = embeddings[rng.choice(len(embeddings), sample_size, replace=False)]
+  centers = np.empty((num_clusters, embeddings.shape[1]), dtype=embeddings.dtype)
+  centers[0] = sample[rng.integers(sample_size)]
+  distances = np.maximum(1 - sample @ centers[0], 0)
+  for center in range(1, num_clusters):
+    total = distances.sum()
+    pick = rng.choice(sample_size, p=distances / total) if total > 0 else rng.integers(sample_size)
+    centers[center] = sample[pick]
+    distances = np.minimum(distances, np.maximum(1 - sample @ centers[center], 0))
+  return centers
+
+
+def fit_centers(embeddings: np.ndarray, num_clusters: int, restarts: int = KMEANS_RESTARTS):
+  """Run minibatch_kmeans from `restarts` seeds and keep the centers with the highest total cosine similarity."""
+  best_centers, best_fit = None, None
+  for seed in range(restarts):
+    centers = minibatch_kmeans(embeddings, num_clusters, seed)
+    fit = float(assign_clusters(embeddings, centers)[1].sum())
+    if best_fit is None or fit > best_fit:
+      best_centers, best_fit = centers, fit
+  return best_centers
+
+
+def minibatch_kmeans(embeddings: np.ndarray, num_clusters: int, seed: int = 0):
+  """Spherical mini-batch k-means (per-center learning rates) from k-means++ seeds, returning unit-length centers.
+
+  Every KMEANS_REASSIGN_INTERVAL iterations, centers that received no points, or far fewer than the largest one, since
+  the last check are moved onto the batch points least similar to their own centers.
+  """
+  rng = np.random.default_rng(seed)
+  centers = kmeans_plus_plus(embeddings, num_clusters, rng)
+  center_counts = np.zeros(num_clusters, dtype=np.float32)
+  recent_counts = np.zeros(num_clusters, dtype=np.float32)
+
+  for iteration in range(1, kmeans_iterations(len(embeddings)) + 1):
+    batch = embeddings[rng.integers(0, len(embeddings), min(KMEANS_BATCH_SIZE, len(embeddings)))]
+    batch_scores = batch @ centers.T
+    batch_assignments = batch_scores.argmax(axis=1)
+
+    batch_counts = np.bincount(batch_assignments, minlength=num_clusters).astype(np.float32)
+    batch_sums = np.zeros_like(centers)
+    np.add.at(batch_sums, batch_assignments, batch)
+
+    previous_centers = centers.copy()
+    updated = batch_counts > 0
+    center_counts += batch_counts
+    recent_counts += batch_counts
+    learning_rates = batch_counts[updated] / center_counts[updated]
+    batch_means = batch_sums[updated] / batch_counts[updated, None]
+    centers[updated] += learning_rates[:, None] * (batch_means - centers[updated])
+    centers /= np.maximum(np.linalg.norm(centers, axis=1, keepdims=True), 1e-12)
+
+    reseeded = False
+    if iteration % KMEANS_REASSIGN_INTERVAL == 0:
+      starved = np.flatnonzero(recent_counts <= KMEANS_REASSIGN_RATIO * recent_counts.max())
+      if len(starved):
+        worst_fit = np.argsort(batch_scores[np.arange(len(batch)), batch_assignments], kind="stable")[:len(starved)]
+        centers[starved[:len(worst_fit)]] = batch[worst_fit]
+        center_counts[starved] = 0
+        reseeded = True
+      recent_counts[:] = 0
+
+    if not reseeded and (1 - (centers * previous_centers).sum(axis=1)).max() < KMEANS_TOLERANCE:
+      break
+
+  return centers
+
+
+def top_terms_by_cluster(pair_clusters: np.ndarray, term_ids: np.ndarray, weights: np.ndarray, num_terms: int,
+                         num_clusters: int):
+  """Return the NUM_TOP_TERMS term ids with the highest summed tf-idf weight in each cluster.
+
+  Weights are summed per (cluster, term) pair by sorting the pairs, so memory stays proportional to the non-zero pairs.
+  """
+  keys = pair_clusters * num_terms + term_ids
+  order = np.argsort(keys, kind="stable")
+  unique_keys, starts = np.unique(keys[order], return_index=True)
+  summed_weights = np.add.reduceat(weights[order], starts)
+  key_clusters = unique_keys // num_terms
+  cluster_starts = np.searchsorted(key_clusters, np.arange(num_clusters + 1))
+
+  top_terms = []
+  for cluster in range(num_clusters):
+    start, end = cluster_starts[cluster], cluster_starts[cluster + 1]
+    best = start + np.argsort(-summed_weights[start:end], kind="stable")[:NUM_TOP_TERMS]
+    top_terms.append((unique_keys[best] % num_terms).tolist())
+  return top_terms
+
+
+class ReservoirSample:
+  """Uniform random sample of at most `size` items of a stream of unknown length (reservoir sampling)."""
+
+  def __init__(self, size: int = MAX_CLUSTERED_QUERIES, seed: int = 0):
+    self.size = size
+    self.items = []
+    self.seen = 0
+    self._rng = random.Random(seed)
+
+  def add(self, item):
+    self.seen += 1
+    if len(self.items) < self.size:
+      self.items.append(item)
+    else:
+      index = self._rng.randrange(self.seen)
+      if index < self.size:
+        self.items[index] = item
+
+
+def cluster_queries(queries: list, score_key: str, num_clusters: int = 0, get_responses=None, total: int = None):
+  """Group `queries` ({id, query, <score_key>}) into topic clusters, largest first.
+
+  `num_clusters` <= 0 picks about sqrt(n / 2) clusters, capped at MAX_CLUSTERS. `get_responses(ids)` returns the
+  responses of the queries with those ids, so they only have to be loaded for each cluster's examples; without it,
+  they are read from each query's 'response'. If `queries` is a sample of `total` queries, cluster sizes are scaled
+  up to estimates for all of them.
+  """
+  if not queries:
+    return []
+
+  texts = [query.get("query") or "" for query in queries]
+  total = total or len(queries)
+  if num_clusters <= 0:
+    num_clusters = min(MAX_CLUSTERS, max(1, int(math.sqrt(total / 2))))
+  num_clusters = min(num_clusters, len(queries))
+
+  doc_ids, term_ids, weights, terms = build_term_matrix(texts)
+  embeddings = embed(len(texts), doc_ids, term_ids, weights, terms)
+  centers = fit_centers(embeddings, num_clusters)
+  assignments, similarities = assign_clusters(embeddings, centers)
+
+  cluster_terms = top_terms_by_cluster(assignments[doc_ids], term_ids, weights, len(terms), num_clusters)
+  scores = np.array([query.get(score_key) or 0 for query in queries], dtype=float)
+  cluster_sizes = np.bincount(assignments, minlength=num_clusters)
+
+  clusters = []
+  for cluster in np.argsort(-cluster_sizes, kind="stable"):
+    if not cluster_sizes[cluster]:
+      continue
+    members = np.flatnonzero(assignments == cluster)
+    members = members[np.argsort(-similarities[members], kind="stable")]
+
+    clusters.append({
+      "rank": len(clusters) + 1,
+      "size": round(int(cluster_sizes[cluster]) * total / len(queries)),
+      "top_terms": [terms[term_id] for term_id in cluster_terms[cluster]],
+      f"avg_{score_key}": round(float(scores[members].mean()), 2),
+      "representative_query": queries[members[0]].get("query"),
+      "example_queries": [queries[member].get("query") for member in members[:NUM_EXAMPLE_QUERIES]],
+      "example_responses": (get_responses([queries[member].get("id") for member in members[:NUM_EXAMPLE_RESPONSES]])
+                            if get_responses else
+                            [queries[member].get("response") for member in members[:NUM_EXAMPLE_RESPONSES]]),
+    })
+
+  return clusters
@@ -0,0 +1,116 @@
+"""
+  Checks the topic clustering of kb_gap_clustering.py on synthetic low-scoring queries: near-duplicates of the same
+  question (with filler and stop words added, sometimes a product version, in different case and punctuation) must land
+  in the same cluster, and no cluster may come back empty.
+
+  Each topic is one support question about a product; topics share their products and actions with other topics, so
+  they are not trivially separable. Every query is a near-duplicate variant of its topic's question. The queries are
+  clustered into one cluster per topic by default (with more clusters than topics, some topic has to be split), and a
+  topic is kept together if all its variants but 5% stragglers are in one cluster. The check fails if fewer than
+  --min-together of the topics (85% by default) are. That bar is below 100% on purpose: even the best of the
+  KMEANS_RESTARTS runs can settle with two topics sharing a cluster and another split in two, which costs three
+  topics, and over seeds 0-9 of the generator 88-93% of the topics are kept together.
+
+  Run via one of the following (all arguments are optional):
+    python3 kb_gap_clustering_check.py
+    python3 kb_gap_clustering_check.py --variants 200 --seed 3 --min-together 0.9
+"""
+
+import sys
+import math
+import time
+import random
+import argparse
+from collections import Counter
+
+import kb_gap_clustering
+
+PRODUCTS = ["vSphere ESXi host", "vCenter Server appliance", "Carbon Black App Control agent",
+            "Mainframe Operational Intelligence", "Advanced Authentication Mainframe", "NSX edge gateway",
+            "vSAN datastore", "Tanzu Kubernetes cluster", "Aria Operations dashboard", "Horizon desktop pool"]
+ACTIONS = ["upgrade fails with compatibility error", "license key expired renewal", "install hangs at certificate step",
+           "backup restore procedure", "performance degraded after patch", "cannot login single sign on"]
+VERSIONS = ["7.0", "8.0", "8.0u2", "2023"]
+FILLERS = ["please", "urgent", "help", "thanks", "hi", "quick question", "again", "today"]
+
+
+def topic_questions():
+  return [f"{product} {action}" for product in PRODUCTS for action in ACTIONS]
+
+
+def near_duplicate(question: str, rng: random.Random):
+  """Reword `question` the way users re-ask the same thing."""
+  words = question.split()
+  words = [rng.choice(["how", "why", "the", "my", "is", "does"])] + words
+  words.insert(rng.randrange(len(words) + 1), rng.choice(FILLERS))
+  if rng.random() < 0.3:
+    words.append(rng.choice(VERSIONS))
+  text = " ".join(words)
+  text = text.lower() if rng.random() < 0.5 else text.upper() if rng.random() < 0.1 else text
+  return text + rng.choice(["?", "??", ".", "", "!"])
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Near-duplicate queries must land in the same topic cluster")
+
+  parser.add_argument("--variants",
+                      type=int,
+                      help="Near-duplicate variants per topic",
+                      default=50)
+  parser.add_argument("--min-together",
+                      type=float,
+                      help="Min fraction of topics whose variants (but 5%% stragglers) share one cluster",
+                      default=0.85)
+  parser.add_argument("--num-clusters",
+                      type=int,
+                      help="Number of clusters (default: one per topic; 0 to pick from the query count, like kb_gap_report.py)",
+                      default=None)
+  parser.add_argument("--seed",
+                      type=int,
+                      help="Seed of the synthetic query generator",
+                      default=0)
+
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  questions = topic_questions()
+  queries = []
+  for topic, question in enumerate(questions):
+    for variant in range(args.variants):
+      queries.append({"id": f"{topic}-{variant}", "query": near_duplicate(question, rng), "fcs": rng.random() * 0.2,
+                      "response": f"Answer {topic}-{variant}"})
+  rng.shuffle(queries)
+
+  start = time.perf_counter()
+  num_clusters = len(questions) if args.num_clusters is None else args.num_clusters
+  if num_clusters <= 0:
+    num_clusters = min(kb_gap_clustering.MAX_CLUSTERS, max(1, int(math.sqrt(len(queries) / 2))))
+  clusters = kb_gap_clustering.cluster_queries(queries, "fcs", num_clusters)
+  elapsed = time.perf_counter() - start
+
+  # The clusters only list example queries, so redo the (deterministic) assignment of every query
+  texts = [query["query"] for query in queries]
+  doc_ids, term_ids, weights, terms = kb_gap_clustering.build_term_matrix(texts)
+  embeddings = kb_gap_clustering.embed(len(texts), doc_ids, term_ids, weights, terms)
+  assignments, _ = kb_gap_clustering.assign_clusters(
+    embeddings, kb_gap_clustering.fit_centers(embeddings, num_clusters))
+  cluster_of = { query["id"]: int(cluster) for query, cluster in zip(queries, assignments) }
+
+  topics_together = 0
+  for topic in range(len(questions)):
+    counts = Counter(cluster_of[f"{topic}-{variant}"] for variant in range(args.variants))
+    if counts.most_common(1)[0][1] >= 0.95 * args.variants:
+      topics_together += 1
+  together = topics_together / len(questions)
+  empty_clusters = num_clusters - len(clusters)
+
+  print(f"{len(queries)} queries, {len(questions)} topics of {args.variants} near-duplicates: {len(clusters)} clusters "
+        f"in {elapsed:.2f}s (up to {kb_gap_clustering.kmeans_iterations(len(queries))} k-means iterations)")
+  print(f"topics kept in one cluster: {topics_together}/{len(questions)} ({together:.0%}), "
+        f"empty clusters: {empty_clusters}")
+  if together < args.min_together or empty_clusters:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -3,62 +3,209 @@
   have search result relevance and FCS scores below a defined threshold, and output a report and log files.
 
   The report summary file is written to whatever value is set for the REPORT_FILE variable.
-  It uses the file designated by REPORT_TEMPLATE_FILE as its template.
+  It includes score percentiles, histograms, per-day trends and the relevance/FCS correlation (see kb_gap_analytics.py).
+  It uses the file designated by REPORT_TEMPLATE_FILE as its template, which is compiled once into segments and
+  rendered in a single pass. Long lists of low-scoring queries are split across extra report pages
+  (broadcom-support-admin-2.html, ...) of at most --queries-per-page queries each.
 
   Any queries that have a low average search result relevance score are written to the file named by the
   LOW_SEARCH_RELEVANCE_QUERIES_LOG variable.
 
   Any queries that have a low average FCS are written to the file named by the LOW_FCS_QUERIES_LOG variable.
 
-  This requires the following env variables to be set:
+  Both sets of low-scoring queries are also grouped into ranked topic clusters (see kb_gap_clustering.py), written to
+  LOW_SEARCH_RELEVANCE_CLUSTERS_LOG and LOW_FCS_CLUSTERS_LOG and summarized at the top of each list in the report.
+  Each list is clustered from a random sample of at most --max-clustered-queries of its queries.
+
+  The query history is walked page by page following the API's page cursor, optionally bounded to a time window
+  (--since/--until). Query details are fetched concurrently (--parallelism) over one keep-alive connection per worker
+  thread, with retry/backoff on 429 and 5xx responses, and are scored in the same order as the query history.
+
+  Fetched queries and their scores are kept in a local SQLite store (TELEMETRY_STORE_FILE, see telemetry_store.py).
+  A run only fetches queries newer than the store's checkpoint that it has not stored yet, so a nightly run costs time
+  proportional to new traffic and a crashed run picks up where it left off. --num-queries caps how many query history
+  entries a run lists; a capped run records where it stopped and the next run carries on from there, so capped runs
+  together still fetch every query. The report aggregates and low-scoring query lists are then recomputed from all the
+  stored rows in the --since/--until window (not only the ones fetched this run), so memory stays flat no matter how
+  many queries are analyzed. To report on a recent period only, pass --since.
+
+  This requires NumPy (pip install -r requirements.txt) and the following env variables to be set:
   VECTARA_API_KEY
   VECTARA_CORPUS_KEY
 
+  The following env variable is optional (e.g. to point at a local stub server):
+  VECTARA_API_BASE_URL (defaults to https://api.vectara.io)
+
   Run via one of the following (all arguments are optional):
     python3 kb_gap_report
     python3 kb_gap_report --num-queries 100 --avg-search-result-relevance-threshold 0.75 --fcs-threshold 0.5
+    python3 kb_gap_report --num-queries 10000 --parallelism 16
+    python3 kb_gap_report --num-queries 0 --since 2025-01-01T00:00:00Z --until 2025-02-01T00:00:00Z
+    python3 kb_gap_report --num-queries 0 --telemetry-store nightly.db
 """
 
 import os
 import json
 import re
+import time
+import random
 import argparse
+import html
+import tempfile
+import itertools
+import threading
 import http.client
+from collections import deque
+from datetime import datetime, timedelta
+from urllib.parse import urlparse, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from telemetry_store import TelemetryStore
+from kb_gap_analytics import load_score_arrays, compute_analytics, build_analytics_html
+from kb_gap_clustering import MAX_CLUSTERED_QUERIES, ReservoirSample, cluster_queries
 
 VECTARA_API_KEY = os.getenv("VECTARA_API_KEY") #"zut_HNBRQvKNYGAFosBfnun2or80M6WMz020npkT2Q"
 VECTARA_CORPUS_KEY = os.getenv("VECTARA_CORPUS_KEY")
+VECTARA_API_BASE_URL = urlparse(os.getenv("VECTARA_API_BASE_URL", "https://api.vectara.io"))
 
-CONN = http.client.HTTPSConnection("api.vectara.io")
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECONDS = 0.5
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+QUERY_HISTORY_PAGE_SIZE = 100
+STORE_COMMIT_INTERVAL = 100
+COPY_CHUNK_SIZE = 64 * 1024
+
+# One keep-alive connection per worker thread
+_thread_local = threading.local()
 
 LOW_SEARCH_RELEVANCE_QUERIES_LOG = "low_search_relevance_queries.json"
 LOW_FCS_QUERIES_LOG = "low_fcs_queries.json"
+LOW_SEARCH_RELEVANCE_CLUSTERS_LOG = "low_search_relevance_clusters.json"
+LOW_FCS_CLUSTERS_LOG = "low_fcs_clusters.json"
+REPORT_MAX_CLUSTERS = 20
 REPORT_TEMPLATE_FILE = "broadcom-support-admin-template.html"
 REPORT_FILE = "broadcom-support-admin.html"
-
-def get_query_histories(num_queries: int):
-  payload = { }
+TELEMETRY_STORE_FILE = "kb_gap_telemetry.db"
+REPORT_QUERIES_PER_PAGE = 500
+
+def get_connection(reconnect: bool = False):
+  conn = getattr(_thread_local, "conn", None)
+  if conn is None or reconnect:
+    if conn is not None:
+      conn.close()
+    connection_class = http.client.HTTPConnection if VECTARA_API_BASE_URL.scheme == "http" else http.client.HTTPSConnection
+    conn = connection_class(VECTARA_API_BASE_URL.netloc, timeout=60)
+    _thread_local.conn = conn
+  return conn
+
+
+def retry_delay(attempt: int, retry_after):
+  if retry_after:
+    try:
+      return float(retry_after)
+    except ValueError:
+      pass
+  return RETRY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random())
+
+
+class VectaraApiError(Exception):
+  """Raised when the Vectara API answers with a non-2xx status, after any retries."""
+
+  def __init__(self, path: str, status: int, body: bytes):
+    super().__init__(f"HTTP {status} on {path}: {body[:200].decode('utf-8', 'replace')}")
+    self.status = status
+
+
+def api_get(path: str, payload: dict):
+  """
+  GET a Vectara API path on this thread's connection, retrying with backoff on 429/5xx and dropped connections.
+  Raises VectaraApiError on any other non-2xx status, or once the retries run out.
+  """
   headers = { 'Accept': 'application/json', 'x-api-key': VECTARA_API_KEY }
+  reconnect = False
+
+  for attempt in range(MAX_RETRIES + 1):
+    try:
+      conn = get_connection(reconnect)
+      conn.request("GET", path, json.dumps(payload), headers)
+      res = conn.getresponse()
+      data = res.read()
+    except (http.client.HTTPException, OSError) as e:
+      if attempt == MAX_RETRIES:
+        raise
+      print(f"Connection error on {path} ({e}), retrying")
+      reconnect = True
+      time.sleep(retry_delay(attempt, None))
+      continue
+
+    reconnect = False
+    if res.status in RETRYABLE_STATUSES and attempt < MAX_RETRIES:
+      delay = retry_delay(attempt, res.getheader("Retry-After"))
+      print(f"HTTP {res.status} on {path}, retrying in {delay:.1f}s")
+      time.sleep(delay)
+      continue
+
+    if not 200 <= res.status < 300:
+      raise VectaraApiError(path, res.status, data)
+    return json.loads(data.decode("utf-8"))
+
+
+def get_query_histories(num_queries: int, page_key: str = None, since: str = None, until: str = None):
+  payload = { }
+  params = { "corpus_key": VECTARA_CORPUS_KEY, "limit": num_queries }
+  if page_key:
+    params["page_key"] = page_key
+  if since:
+    params["started_after"] = since
+  if until:
+    params["started_before"] = until
+  return api_get(f"/v2/queries?{urlencode(params)}", payload)
+
+
+def iter_query_histories(num_queries: int, since: str = None, until: str = None):
+  """Yield the telemetry of up to `num_queries` past queries (all of them if <= 0), one page at a time."""
+  num_yielded = 0
+  page_key = None
 
-  CONN.request("GET", f"/v2/queries?corpus_key={VECTARA_CORPUS_KEY}&limit={num_queries}", json.dumps(payload), headers)
-  res = CONN.getresponse()
-  data = res.read()
+  while True:
+    page_size = QUERY_HISTORY_PAGE_SIZE
+    if num_queries > 0:
+      page_size = min(page_size, num_queries - num_yielded)
 
-  query_history_response = json.loads(data.decode("utf-8"))
+    query_history_response = get_query_histories(page_size, page_key, since, until)
+    for query_telemetry in query_history_response.get("queries") or []:
+      yield query_telemetry
+      num_yielded += 1
 
-  return query_history_response
+    page_key = (query_history_response.get("metadata") or {}).get("page_key")
+    if not page_key or (num_queries > 0 and num_yielded >= num_queries):
+      return
 
 
 def get_query_details(query_telemetry: dict):
   payload = { "corpus_key": VECTARA_CORPUS_KEY }
-  headers = { 'Accept': 'application/json', 'x-api-key': VECTARA_API_KEY }
+  return api_get(f"/v2/queries/{query_telemetry.get('id')}", payload)
+
 
-  CONN.request("GET", f"/v2/queries/{query_telemetry.get('id')}", json.dumps(payload), headers)
-  res = CONN.getresponse()
-  data = res.read()
+def iter_query_details(queries, parallelism: int):
+  """Yield the details of each query, fetched `parallelism` at a time, in the same order as `queries`.
 
-  query_history_response = json.loads(data.decode("utf-8"))
+  Only a small window of requests is in flight at once, so `queries` can be an arbitrarily long iterator.
+  """
+  if parallelism <= 1:
+    for query_telemetry in queries:
+      yield get_query_details(query_telemetry)
+    return
 
-  return query_history_response
+  with ThreadPoolExecutor(max_workers=parallelism) as executor:
+    pending = deque()
+    for query_telemetry in queries:
+      pending.append(executor.submit(get_query_details, query_telemetry))
+      if len(pending) >= parallelism * 2:
+        yield pending.popleft().result()
+    while pending:
+      yield pending.popleft().result()
 
 
 def get_span_of_type(spans: list, span_type: str):
@@ -72,57 +219,318 @@ def get_span_of_type(spans: list, span_type: str):
   return None
 
 
-def log_queries_to_file(filename: str, queries: list):
+def score_query(query_details: dict):
+  """Score one query's telemetry, or return None if it has no spans to score."""
+  query_container = query_details.get('query')
+
+  query = query_container.get('query')
+  max_used_search_results = query_container.get('generation').get('max_used_search_results')
+
+  spans = query_details.get('spans')
+
+  if not spans:
+    return None
+
+  search_span = get_span_of_type(spans, "search")
+  max_used_search_results_relevance_score_agg = 0
+  search_results = search_span.get("search_results")
+  search_scores = []
+  for r in range(min(max_used_search_results, len(search_results))):
+    search_scores.append(search_results[r].get("score"))
+    max_used_search_results_relevance_score_agg+= search_results[r].get("score")
+  max_used_search_results_relevance_score_avg = (max_used_search_results_relevance_score_agg / max_used_search_results)
+
+  generation_span = get_span_of_type(spans, "generation")
+  generation = generation_span.get('generation')
+
+  fcs_span = get_span_of_type(spans, "fcs")
+  fcs = fcs_span.get('score') if fcs_span else None
+
+  return {"query": query, "response": generation,
+          "avg_relevance_score": max_used_search_results_relevance_score_avg, "fcs": fcs,
+          "search_scores": search_scores}
+
+
+def fetch_query_window(store: TelemetryStore, num_queries: int, since: str, until: str, parallelism: int):
+  """Fetch, score and store the unstored queries among up to `num_queries` listed in the window, newest first.
+
+  Returns (queries fetched, queries listed, oldest and newest start time listed).
+  """
+  num_listed = 0
+  oldest_started_at = newest_started_at = None
+
+  def iter_unstored_queries():
+    nonlocal num_listed, oldest_started_at, newest_started_at
+    for query_telemetry in iter_query_histories(num_queries, since, until):
+      num_listed += 1
+      started_at = query_telemetry.get("started_at")
+      if started_at:
+        oldest_started_at = min(oldest_started_at or started_at, started_at)
+        newest_started_at = max(newest_started_at or started_at, started_at)
+      if not store.has_query(query_telemetry.get("id")):
+        yield query_telemetry
+
+  queries, queries_to_fetch = itertools.tee(iter_unstored_queries())
+  num_fetched = 0
+  for query_telemetry, query_details in zip(queries, iter_query_details(queries_to_fetch, parallelism)):
+    store.save_query(query_telemetry, query_details, score_query(query_details))
+    num_fetched += 1
+    if num_fetched % STORE_COMMIT_INTERVAL == 0:
+      store.commit()
+  store.commit()
+
+  return num_fetched, num_listed, oldest_started_at, newest_started_at
+
+
+def inclusive_until(started_at: str):
+  """Return the start time one tick after `started_at` at its own precision, so a `started_before` bound includes it."""
+  fraction = re.search(r"\.(\d+)", started_at)
+  digits = min(len(fraction.group(1)), 6) if fraction else 0
+  bumped = datetime.fromisoformat(started_at.replace("Z", "+00:00")) + timedelta(microseconds=10 ** (6 - digits))
+  text = bumped.strftime("%Y-%m-%dT%H:%M:%S")
+  if digits:
+    text += "." + f"{bumped.microsecond:06d}"[:digits]
+  return text + re.search(r"(Z|[+-][\d:]+)?$", started_at).group(0)
+
+
+def fetch_new_queries(store: TelemetryStore, num_queries: int, since: str, until: str, parallelism: int,
+                      use_checkpoint: bool = True):
+  """Fetch, score and store the queries in the window that `store` does not have yet, and return how many.
+
+  An open-ended window (no `until`) starts at the store's checkpoint. Query history is listed newest first, so a run
+  that lists `num_queries` entries before reaching the bottom of the window records a resume point, and the next run
+  first walks the rest of that window, down from the oldest query listed, before listing anything newer. The resume
+  window includes that oldest start time, so queries sharing it that were not listed yet are not skipped (`has_query`
+  filters out the ones already stored). If `num_queries` or more queries share that start time, the run steps below it
+  rather than list the same stored queries forever. The checkpoint is advanced to the newest query seen once the
+  window has been walked to its bottom.
+  """
+  if until:
+    return fetch_query_window(store, num_queries, since, until, parallelism)[0]
+
+  checkpoint = store.get_checkpoint() if use_checkpoint else None
+  if checkpoint and (since is None or checkpoint > since):
+    since = checkpoint
+  budget = num_queries
+  num_fetched = 0
+
+  resume_point = store.get_resume_point() if use_checkpoint else None
+  if resume_point:
+    resume_until, resume_newest = resume_point
+    fetched, listed, oldest, _ = fetch_query_window(store, budget, since, inclusive_until(resume_until),
+                                                    parallelism)
+    if budget > 0 and listed >= budget and not fetched and oldest == resume_until:
+      # At least `budget` queries share the resume point's start time and those listed are all stored, so the window
+      # would never move past it: step below it instead
+      print(f"At least {budget} queries started at {resume_until}, some of them may be skipped; "
+            "raise --num-queries to fetch them all")
+      fetched, listed, oldest, _ = fetch_query_window(store, budget, since, resume_until, parallelism)
+    num_fetched += fetched
+    if budget > 0 and listed >= budget:
+      store.set_resume_point(oldest or resume_until, resume_newest)
+      return num_fetched
+    store.clear_resume_point()
+    if resume_newest:
+      store.set_checkpoint(resume_newest)
+      since = max(since or resume_newest, resume_newest)
+    if budget > 0:
+      budget -= listed
+
+  fetched, listed, oldest, newest = fetch_query_window(store, budget, since, None, parallelism)
+  num_fetched += fetched
+  if budget > 0 and listed >= budget:
+    if oldest:
+      store.set_resume_point(oldest, newest)
+  elif newest:
+    store.set_checkpoint(newest)
+
+  return num_fetched
+
+
+def log_clusters_to_file(filename: str, clusters: list):
+  if not clusters:
+    return
   with open(filename, "w") as file:
-    file.write(json.dumps(queries, indent=4))
+    file.write(json.dumps(clusters, indent=4))
     file.close()
 
 
-def replace_template_var(target_substr: str, new_substr: str, orig_whole_str: str):
-  escaped_target_substr = re.escape(target_substr)
-  return re.sub(escaped_target_substr, new_substr, orig_whole_str)
+class QueryLogWriter:
+  """Streams low-scoring queries to a JSON log file and spools their report HTML, page by page, as they are found."""
+
+  def __init__(self, filename: str, queries_per_page: int = 0):
+    self.filename = filename
+    self.queries_per_page = queries_per_page
+    self.count = 0
+    self.log_file = None
+    self.html_spool = tempfile.TemporaryFile("w+b")
+    # Spool offset at which each report page's HTML starts
+    self.page_offsets = [0]
+
+  @property
+  def num_pages(self):
+    return len(self.page_offsets)
+
+  def write(self, query: dict):
+    if self.log_file is None:
+      self.log_file = open(self.filename, "w")
+      self.log_file.write("[\n")
+    else:
+      self.log_file.write(",\n")
+    self.log_file.write(json.dumps(query, indent=4))
+
+    if self.queries_per_page and self.count and self.count % self.queries_per_page == 0:
+      self.page_offsets.append(self.html_spool.tell())
+    self.html_spool.write(build_query_output_html([query]).encode("utf-8"))
+    self.count += 1
+
+  def copy_page_html(self, page: int, out_file):
+    """Copy the spooled HTML of report page `page` (1-based) to the binary `out_file`."""
+    if page > self.num_pages:
+      return
+    start = self.page_offsets[page - 1]
+    end = self.page_offsets[page] if page < self.num_pages else self.html_spool.seek(0, os.SEEK_END)
+    self.html_spool.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      chunk = self.html_spool.read(min(COPY_CHUNK_SIZE, remaining))
+      out_file.write(chunk)
+      remaining -= len(chunk)
+
+  def close(self):
+    if self.log_file is not None:
+      self.log_file.write("\n]")
+      self.log_file.close()
+    self.html_spool.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+
+def compile_template(template: str, template_vars):
+  """Split `template` once into alternating literal (encoded) segments and the names of the template vars between them."""
+  pattern = re.compile("|".join(re.escape(f"${name}") for name in sorted(template_vars, key=len, reverse=True)))
+  segments = []
+  pos = 0
+  for match in pattern.finditer(template):
+    segments.append(template[pos:match.start()].encode("utf-8"))
+    segments.append(match.group(0)[1:])
+    pos = match.end()
+  segments.append(template[pos:].encode("utf-8"))
+  return segments
+
+
+def render_template(segments: list, values: dict, out_file):
+  """Render compiled `segments` to the binary `out_file` in a single pass.
+
+  Each value is either text, or a function that writes its own output to `out_file`.
+  """
+  for i, segment in enumerate(segments):
+    if i % 2 == 0:
+      out_file.write(segment)
+      continue
+    value = values[segment]
+    if callable(value):
+      value(out_file)
+    else:
+      out_file.write(str(value).encode("utf-8"))
 
 
 def build_query_output_html(queries: list):
-  agg = ""
+  parts = []
   for query in queries:
-    agg += f"<p><b>Query: </b> {query.get('query')}</p>"
+    parts.append(f"<p><b>Query: </b> {html.escape(str(query.get('query')))}</p>")
     #if query.get('avg_relevance_score'):
-    #  agg += f"<p><b>Avg Search Relevance Score: </b> {query.get('avg_relevance_score')}</p>"
+    #  parts.append(f"<p><b>Avg Search Relevance Score: </b> {query.get('avg_relevance_score')}</p>")
     #elif query.get('fcs'):
-    #  agg += f"<p><b>FCS: </b> {query.get('fcs')}</p>"
-    agg += f"<p><b>Response: </b>{query.get('response')}</p>"
-    agg += f"<p>&nbsp;</p>"
+    #  parts.append(f"<p><b>FCS: </b> {query.get('fcs')}</p>")
+    parts.append(f"<p><b>Response: </b>{html.escape(str(query.get('response')))}</p>")
+    parts.append(f"<p>&nbsp;</p>")
+
+  return "".join(parts)
+
+
+def build_cluster_output_html(clusters: list, score_key: str, score_label: str):
+  if not clusters:
+    return ""
+
+  parts = [f"<p><b>Top Topics ({len(clusters)} found)</b></p>"]
+  for cluster in clusters[:REPORT_MAX_CLUSTERS]:
+    parts.append(f"<p><b>#{cluster['rank']}: {html.escape(', '.join(cluster['top_terms']))}</b> "
+                 f"({cluster['size']} queries, avg {score_label} {cluster[f'avg_{score_key}']})</p>")
+    parts.append(f"<p><b>Representative Query: </b> {html.escape(str(cluster['representative_query']))}</p>")
+    parts.append(f"<p><b>Example Response: </b>{html.escape(str(cluster['example_responses'][0]))}</p>")
+  parts.append("<p>&nbsp;</p>")
+  parts.append("<p><b>All Queries</b></p>")
+
+  return "".join(parts)
+
+
+def report_page_filename(page: int):
+  if page == 1:
+    return REPORT_FILE
+  base, ext = os.path.splitext(REPORT_FILE)
+  return f"{base}-{page}{ext}"
 
-  return agg
+
+def build_pager_html(page: int, num_pages: int):
+  if num_pages <= 1:
+    return ""
+  links = []
+  for other_page in range(1, num_pages + 1):
+    if other_page == page:
+      links.append(f"<b>{other_page}</b>")
+    else:
+      links.append(f"<a href=\"{html.escape(os.path.basename(report_page_filename(other_page)))}\">{other_page}</a>")
+  return f"<p>Page {page} of {num_pages}: {' '.join(links)}</p>"
 
 
 def write_report(num_queries_total: int, search_relevance_score_avg: float, num_queries_with_low_search_relevance_score: float,
                  num_queries_using_fcs: float, fcs_avg: float, num_queries_with_low_fcs: float,
-                 avg_search_result_relevance_threshold: float, low_search_relevance_score_queries: list,
-                 fcs_threshold: float, low_fcs_queries: list):
-  # Load REPORT_TEMPLATE_FILE
+                 avg_search_result_relevance_threshold: float, low_search_relevance_score_queries: QueryLogWriter,
+                 fcs_threshold: float, low_fcs_queries: QueryLogWriter, analytics_html: str = "",
+                 low_search_relevance_score_clusters: list = None, low_fcs_clusters: list = None):
+  values = {
+    "num_queries_total": num_queries_total,
+    "search_relevance_score_avg": search_relevance_score_avg,
+    "num_queries_with_low_search_relevance_score": num_queries_with_low_search_relevance_score,
+    "num_queries_using_fcs": num_queries_using_fcs,
+    "fcs_avg": fcs_avg,
+    "num_queries_with_low_fcs": num_queries_with_low_fcs,
+    "avg_search_result_relevance_threshold": round(avg_search_result_relevance_threshold, 2),
+    "fcs_threshold": round(fcs_threshold, 2),
+    "score_analytics": analytics_html,
+    "low_search_relevance_score_clusters": build_cluster_output_html(low_search_relevance_score_clusters,
+                                                                     "avg_relevance_score", "relevance"),
+    "low_fcs_clusters": build_cluster_output_html(low_fcs_clusters, "fcs", "FCS"),
+    "low_search_relevance_score_queries": None,
+    "low_fcs_queries": None,
+  }
+
+  # Load REPORT_TEMPLATE_FILE and compile it once for all the report pages
   with open(REPORT_TEMPLATE_FILE, "r") as template_file:
-    # Replace all template vars with actual vars
-    template = template_file.read()
-    template_file.close()
+    segments = compile_template(template_file.read(), values.keys())
+
+  num_pages = max(low_search_relevance_score_queries.num_pages, low_fcs_queries.num_pages)
+  for page in range(1, num_pages + 1):
+    pager_html = build_pager_html(page, num_pages).encode("utf-8")
 
-    template = replace_template_var("$num_queries_total", str(num_queries_total), template)
-    template = replace_template_var("$search_relevance_score_avg", str(search_relevance_score_avg), template)
-    template = replace_template_var("$num_queries_with_low_search_relevance_score", str(num_queries_with_low_search_relevance_score), template)
-    template = replace_template_var("$num_queries_using_fcs", str(num_queries_using_fcs), template)
-    template = replace_template_var("$fcs_avg", str(fcs_avg), template)
-    template = replace_template_var("$num_queries_with_low_fcs", str(num_queries_with_low_fcs), template)
+    def write_query_list(query_log: QueryLogWriter):
+      def write(out_file):
+        query_log.copy_page_html(page, out_file)
+        out_file.write(pager_html)
+      return write
 
-    template = replace_template_var("$avg_search_result_relevance_threshold", str(round(avg_search_result_relevance_threshold, 2)), template)
-    template = replace_template_var("$low_search_relevance_score_queries", build_query_output_html(low_search_relevance_score_queries), template)
-    template = replace_template_var("$fcs_threshold", str(round(fcs_threshold, 2)), template)
-    template = replace_template_var("$low_fcs_queries", build_query_output_html(low_fcs_queries), template)
+    values["low_search_relevance_score_queries"] = write_query_list(low_search_relevance_score_queries)
+    values["low_fcs_queries"] = write_query_list(low_fcs_queries)
 
-    with open(REPORT_FILE, "w") as report_file:
-      # Write updated file to REPORT_FILE
-      report_file.write(template)
-      report_file.close()
+    with open(report_page_filename(page), "wb") as report_file:
+      render_template(segments, values, report_file)
+
+  return num_pages
 
 
 def main():
@@ -131,7 +539,9 @@ def main():
 
     parser.add_argument("--num-queries",
                         type=int,
-                        help="Max number of queries to analyze",
+                        help="Max number of query history entries to list this run (0 for every query in the time window); "
+                             "the next run continues where a capped run stopped. This limits fetching, not the report, "
+                             "which covers every stored query in the --since/--until window",
                         default=100)
     parser.add_argument("--avg-search-result-relevance-threshold",
                         type=float,
@@ -141,102 +551,107 @@ def main():
                         type=float,
                         help="FCS threshold to qualify for 'low FCS'",
                         default=0.2)
+    parser.add_argument("--parallelism",
+                        type=int,
+                        help="Number of query details to fetch concurrently",
+                        default=8)
+    parser.add_argument("--since",
+                        help="Only analyze queries started after this ISO 8601 timestamp",
+                        default=None)
+    parser.add_argument("--until",
+                        help="Only analyze queries started before this ISO 8601 timestamp",
+                        default=None)
+    parser.add_argument("--telemetry-store",
+                        help="SQLite file that fetched queries and scores are kept in between runs",
+                        default=TELEMETRY_STORE_FILE)
+    parser.add_argument("--ignore-checkpoint",
+                        action="store_true",
+                        help="Walk the whole query history window instead of starting from the last checkpoint")
+    parser.add_argument("--queries-per-page",
+                        type=int,
+                        help="Max number of low-scoring queries listed per report page (0 for a single page)",
+                        default=REPORT_QUERIES_PER_PAGE)
+    parser.add_argument("--num-clusters",
+                        type=int,
+                        help="Number of topic clusters to group low-scoring queries into (0 to pick from the query count)",
+                        default=0)
+    parser.add_argument("--max-clustered-queries",
+                        type=int,
+                        help="Cluster a random sample of at most this many queries of each low-scoring list",
+                        default=MAX_CLUSTERED_QUERIES)
 
     args = parser.parse_args()
 
-    query_history_response = get_query_histories(args.num_queries)
-    print(f"Total queries being analyzed: {len(query_history_response.get('queries'))}")
-
-    num_queries = 0
-    num_queries_with_bad_telemetry = 0
-
-    search_relevance_score_agg = 0
-    num_queries_with_low_search_relevance_score = 0
-    low_search_relevance_score_queries = []
-
-    num_queries_using_fcs = 0
-    fcs_agg = 0
-    num_queries_with_low_fcs = 0
-    low_fcs_queries = []
-
-    for query_telemetry in query_history_response.get("queries"):
-      query_details = get_query_details(query_telemetry)
-
-      query_container = query_details.get('query')
-
-      query = query_container.get('query')
-      max_used_search_results = query_container.get('generation').get('max_used_search_results')
-
-      spans = query_details.get('spans')
-
-      if not spans:
-        num_queries_with_bad_telemetry += 1
-        continue
-
-      search_span = get_span_of_type(spans, "search")
-      max_used_search_results_relevance_score_agg = 0
-      search_results = search_span.get("search_results")
-      for r in range(min(max_used_search_results, len(search_results))):
-        max_used_search_results_relevance_score_agg+= search_results[r].get("score")
-      max_used_search_results_relevance_score_avg = (max_used_search_results_relevance_score_agg / max_used_search_results)
-      search_relevance_score_agg+= max_used_search_results_relevance_score_avg
-
-      generation_span = get_span_of_type(spans, "generation")
-      generation = generation_span.get('generation')
-
-      if max_used_search_results_relevance_score_avg < args.avg_search_result_relevance_threshold:
-        num_queries_with_low_search_relevance_score += 1
-        low_search_relevance_score_queries.append({"query": query, "response": generation,
-                                                   "avg_relevance_score": round(max_used_search_results_relevance_score_avg, 2)})
-
-      fcs_span = get_span_of_type(spans, "fcs")
-      fcs = None
-      if fcs_span:
-        fcs = fcs_span.get('score')
-        num_queries_using_fcs+= 1
-        fcs_agg+= fcs
-        if fcs < args.fcs_threshold:
-          num_queries_with_low_fcs += 1
-          low_fcs_queries.append({"query": query, "response": generation, "fcs": round(fcs, 2)})
-
-      #print(f"[{num_queries}] Query: {query} | max_used_search_results: {max_used_search_results} | "
-      #      f"Response: {generation} | FCS: {fcs} | avg_search_result_relevance_score {max_used_search_results_relevance_score_avg}")
-
-      num_queries+= 1
-
-    # Factor out any queries that had bad telemetry
-    if num_queries_with_bad_telemetry > 0:
-      num_queries-= num_queries_with_bad_telemetry
-      num_queries_using_fcs -= num_queries_with_bad_telemetry
-      num_queries_with_low_fcs-= num_queries_with_bad_telemetry
-
-    search_relevance_score_avg = round(search_relevance_score_agg/num_queries, 2)
-    fcs_avg = round(fcs_agg/num_queries_using_fcs, 2)
-    print("")
-    print(f"search_relevance_score_avg={search_relevance_score_avg}")
-    print(f"num_queries_with_low_search_relevance_score={num_queries_with_low_search_relevance_score}")
-    print(f"num_queries_using_fcs={num_queries_using_fcs}")
-    print(f"fcs_avg={fcs_avg}")
-    print(f"num_queries_with_low_fcs={num_queries_with_low_fcs}")
-    print(f"num_queries_with_bad_telemetry={num_queries_with_bad_telemetry}")
-    print("")
-
-    # Write stats to a clean report, and maybe output all the bad queries at the bottom?
-    write_report(num_queries, search_relevance_score_avg, num_queries_with_low_search_relevance_score,
-                 num_queries_using_fcs, fcs_avg, num_queries_with_low_fcs,
-                 args.avg_search_result_relevance_threshold, low_search_relevance_score_queries,
-                 args.fcs_threshold, low_fcs_queries)
-
-    # log the bad queries to files
-    if low_search_relevance_score_queries:
-      log_queries_to_file(LOW_SEARCH_RELEVANCE_QUERIES_LOG, low_search_relevance_score_queries)
-      print(f"Wrote {len(low_search_relevance_score_queries)} queries with low search relevance score "
+    with TelemetryStore(args.telemetry_store) as store:
+      num_new_queries = fetch_new_queries(store, args.num_queries, args.since, args.until, args.parallelism,
+                                          use_checkpoint=not args.ignore_checkpoint)
+      resume_point = store.get_resume_point()
+      print(f"Fetched {num_new_queries} new queries"
+            + (f"; the next run continues from {resume_point[0]}" if resume_point else ""))
+
+      stats = store.get_stats(args.avg_search_result_relevance_threshold, args.fcs_threshold, args.since, args.until)
+      print("")
+      print(f"Total queries analyzed: {stats['num_queries'] + stats['num_queries_with_bad_telemetry']}")
+      print(f"search_relevance_score_avg={stats['search_relevance_score_avg']}")
+      print(f"num_queries_with_low_search_relevance_score={stats['num_queries_with_low_search_relevance_score']}")
+      print(f"num_queries_using_fcs={stats['num_queries_using_fcs']}")
+      print(f"fcs_avg={stats['fcs_avg']}")
+      print(f"num_queries_with_low_fcs={stats['num_queries_with_low_fcs']}")
+      print(f"num_queries_with_bad_telemetry={stats['num_queries_with_bad_telemetry']}")
+
+      # Distribution analytics over the whole window, computed in bulk over column arrays
+      analytics = compute_analytics(load_score_arrays(store, args.since, args.until),
+                                    args.avg_search_result_relevance_threshold, args.fcs_threshold)
+      print(f"search_relevance_score_percentiles={ {p: round(float(v), 2) for p, v in analytics['relevance_percentiles'].items()} }")
+      print(f"fcs_percentiles={ {p: round(float(v), 2) for p, v in analytics['fcs_percentiles'].items()} }")
+      print(f"relevance_fcs_correlation={analytics['relevance_fcs_correlation']}")
+      print("")
+
+      with QueryLogWriter(LOW_SEARCH_RELEVANCE_QUERIES_LOG, args.queries_per_page) as low_search_relevance_score_queries, \
+           QueryLogWriter(LOW_FCS_QUERIES_LOG, args.queries_per_page) as low_fcs_queries:
+
+        # log the bad queries to files, keeping a bounded sample of what clustering needs (not the responses) in memory
+        low_search_relevance_score_texts = ReservoirSample(args.max_clustered_queries)
+        for query_id, query in store.iter_low_search_relevance_queries(args.avg_search_result_relevance_threshold,
+                                                                       args.since, args.until):
+          low_search_relevance_score_queries.write(query)
+          low_search_relevance_score_texts.add(
+            {"id": query_id, "query": query["query"], "avg_relevance_score": query["avg_relevance_score"]})
+        low_fcs_texts = ReservoirSample(args.max_clustered_queries)
+        for query_id, query in store.iter_low_fcs_queries(args.fcs_threshold, args.since, args.until):
+          low_fcs_queries.write(query)
+          low_fcs_texts.add({"id": query_id, "query": query["query"], "fcs": query["fcs"]})
+
+        # Group the bad queries into ranked topic clusters; example responses are only fetched for each cluster's
+        # most representative queries
+        low_search_relevance_score_clusters = cluster_queries(
+          low_search_relevance_score_texts.items, "avg_relevance_score", args.num_clusters, store.get_responses,
+          total=low_search_relevance_score_texts.seen)
+        low_fcs_clusters = cluster_queries(low_fcs_texts.items, "fcs", args.num_clusters, store.get_responses,
+                                           total=low_fcs_texts.seen)
+        log_clusters_to_file(LOW_SEARCH_RELEVANCE_CLUSTERS_LOG, low_search_relevance_score_clusters)
+        log_clusters_to_file(LOW_FCS_CLUSTERS_LOG, low_fcs_clusters)
+
+        # Write stats to a clean report, and maybe output all the bad queries at the bottom?
+        num_report_pages = write_report(stats['num_queries'], stats['search_relevance_score_avg'],
+                     stats['num_queries_with_low_search_relevance_score'],
+                     stats['num_queries_using_fcs'], stats['fcs_avg'], stats['num_queries_with_low_fcs'],
+                     args.avg_search_result_relevance_threshold, low_search_relevance_score_queries,
+                     args.fcs_threshold, low_fcs_queries, build_analytics_html(analytics),
+                     low_search_relevance_score_clusters, low_fcs_clusters)
+
+    print(f"Wrote the report to {REPORT_FILE}" + (f" and {num_report_pages - 1} more pages" if num_report_pages > 1 else ""))
+    if low_search_relevance_score_queries.count:
+      print(f"Wrote {low_search_relevance_score_queries.count} queries with low search relevance score "
             f"(<{args.avg_search_result_relevance_threshold}) {LOW_SEARCH_RELEVANCE_QUERIES_LOG}")
-    if low_fcs_queries:
-      log_queries_to_file(LOW_FCS_QUERIES_LOG, low_fcs_queries)
-      print(f"Wrote {len(low_fcs_queries)} queries with low FCS score "
+    if low_fcs_queries.count:
+      print(f"Wrote {low_fcs_queries.count} queries with low FCS score "
             f"(<{args.fcs_threshold})to {LOW_FCS_QUERIES_LOG}")
-
+    if low_search_relevance_score_clusters:
+      print(f"Wrote {len(low_search_relevance_score_clusters)} topic clusters of low search relevance score queries "
+            f"to {LOW_SEARCH_RELEVANCE_CLUSTERS_LOG}")
+    if low_fcs_clusters:
+      print(f"Wrote {len(low_fcs_clusters)} topic clusters of low FCS score queries to {LOW_FCS_CLUSTERS_LOG}")
 
 if __name__ == "__main__":
     main()
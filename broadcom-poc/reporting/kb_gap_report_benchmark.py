@@ -0,0 +1,156 @@
+"""
+  Benchmarks the query details fetch in kb_gap_report.py against a local stub of the Vectara Query History API.
+
+  The stub server answers /v2/queries (paged) and /v2/queries/{id} with canned telemetry after a fixed simulated latency,
+  and rejects a fraction of requests with HTTP 429 so the retry/backoff path is exercised too. The fetch is timed
+  once per parallelism level, and the results are checked to be in the same order as the query history.
+
+  No env variables are required; the stub server's address and keys are patched into kb_gap_report directly.
+
+  Run via one of the following (all arguments are optional):
+    python3 kb_gap_report_benchmark.py
+    python3 kb_gap_report_benchmark.py --num-queries 500 --latency-ms 50 --parallelism 1 4 16 --rate-limit-ratio 0.02
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import kb_gap_report
+
+
+class StubVectaraHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"  # keep-alive, so each worker thread reuses its connection
+
+  def do_GET(self):
+    length = int(self.headers.get("Content-Length") or 0)
+    if length:
+      self.rfile.read(length)
+
+    time.sleep(self.server.latency_seconds)
+
+    if random.random() < self.server.rate_limit_ratio:
+      self.send_json(429, {"message": "Too many requests"}, {"Retry-After": "0.05"})
+      return
+
+    url = urlparse(self.path)
+    path = url.path
+    if path == "/v2/queries":
+      params = parse_qs(url.query)
+      since = params.get("started_after", [""])[0]
+      until = params.get("started_before", ["~"])[0]
+      offset = int(params.get("page_key", ["0"])[0])
+      limit = int(params.get("limit", ["100"])[0])
+
+      # Newest first, like the real query history
+      queries = [{"id": f"qry_{i}", "started_at": started_at(i)} for i in reversed(range(self.server.num_queries))]
+      queries = [query for query in queries if since < query["started_at"] < until]
+      page = queries[offset:offset + limit]
+      metadata = {"page_key": str(offset + limit)} if offset + limit < len(queries) else {}
+      self.send_json(200, {"queries": page, "metadata": metadata})
+    elif path.startswith("/v2/queries/"):
+      self.send_json(200, build_query_details(path.rsplit("/", 1)[-1]))
+    else:
+      self.send_json(404, {"message": "Not found"})
+
+  def send_json(self, status: int, body: dict, extra_headers: dict = None):
+    data = json.dumps(body).encode("utf-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    for name, value in (extra_headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(data)
+
+  def log_message(self, format, *args):
+    pass
+
+
+def started_at(index: int):
+  return f"2025-01-{index // 100 + 1:02d}T{index // 3600 % 24:02d}:{index // 60 % 60:02d}:{index % 60:02d}Z"
+
+
+def build_query_details(query_id: str):
+  # Scores vary per query, but deterministically, so reports over the stub are reproducible
+  index = int(query_id.rsplit("_", 1)[-1])
+  rng = random.Random(index)
+  scores = rng.random()
+  fcs = 0.6 * scores + 0.4 * rng.random()
+  return {
+    "id": query_id,
+    "started_at": started_at(index),
+    "query": { "query": f"Question for {query_id}", "generation": { "max_used_search_results": 3 } },
+    "spans": [
+      { "type": "search", "search_results": [{ "score": scores }, { "score": scores * 0.8 }, { "score": scores * 0.5 }] },
+      { "type": "generation", "generation": f"Answer for {query_id}" },
+      { "type": "fcs", "score": fcs },
+    ],
+  }
+
+
+def start_stub_server(num_queries: int, latency_ms: float, rate_limit_ratio: float):
+  server = ThreadingHTTPServer(("127.0.0.1", 0), StubVectaraHandler)
+  server.daemon_threads = True
+  server.num_queries = num_queries
+  server.latency_seconds = latency_ms / 1000
+  server.rate_limit_ratio = rate_limit_ratio
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Knowledge Base Gap Analysis fetch benchmark")
+
+  parser.add_argument("--num-queries",
+                      type=int,
+                      help="Number of queries the stub query history returns",
+                      default=200)
+  parser.add_argument("--latency-ms",
+                      type=float,
+                      help="Simulated per-request API latency in milliseconds",
+                      default=50)
+  parser.add_argument("--parallelism",
+                      type=int,
+                      nargs="+",
+                      help="Parallelism levels to benchmark",
+                      default=[1, 4, 8, 16])
+  parser.add_argument("--rate-limit-ratio",
+                      type=float,
+                      help="Fraction of requests the stub rejects with HTTP 429",
+                      default=0.01)
+
+  args = parser.parse_args()
+
+  server = start_stub_server(args.num_queries, args.latency_ms, args.rate_limit_ratio)
+  kb_gap_report.VECTARA_API_BASE_URL = urlparse(f"http://127.0.0.1:{server.server_address[1]}")
+  kb_gap_report.VECTARA_API_KEY = "stub-api-key"
+  kb_gap_report.VECTARA_CORPUS_KEY = "stub-corpus"
+  kb_gap_report.RETRY_BACKOFF_SECONDS = 0.05
+
+  queries = list(kb_gap_report.iter_query_histories(args.num_queries))
+  expected_ids = [query.get("id") for query in queries]
+
+  baseline_seconds = None
+  for parallelism in args.parallelism:
+    start = time.perf_counter()
+    details = list(kb_gap_report.iter_query_details(queries, parallelism))
+    elapsed = time.perf_counter() - start
+
+    if [query_details.get("id") for query_details in details] != expected_ids:
+      raise RuntimeError(f"Query details out of order at parallelism={parallelism}")
+
+    if baseline_seconds is None:
+      baseline_seconds = elapsed
+    print(f"parallelism={parallelism:<3} {len(details)} queries in {elapsed:.2f}s "
+          f"({len(details) / elapsed:.1f} queries/s, {baseline_seconds / elapsed:.1f}x)")
+
+  server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+  Local SQLite store of query telemetry for kb_gap_report.py.
+
+  Each analyzed query is stored once, keyed by its query id, with its fetched spans and computed scores, so a run only
+  has to fetch queries it has not seen before. The checkpoint is the newest query start time of the last run that
+  walked its whole history window; it is only advanced once a run completes, so a crashed run resumes from the old
+  checkpoint and skips the queries it had already stored.
+
+  A run capped by --num-queries before it reached the bottom of the window leaves a resume point instead: the oldest
+  query start time it listed, below which the window still has to be walked, and the newest one, which becomes the
+  checkpoint once it has been.
+"""
+
+import json
+import sqlite3
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS queries (
+    id TEXT PRIMARY KEY,
+    started_at TEXT,
+    query TEXT,
+    response TEXT,
+    avg_relevance_score REAL,
+    fcs REAL,
+    bad_telemetry INTEGER NOT NULL DEFAULT 0,
+    spans TEXT,
+    search_scores TEXT
+  );
+  CREATE INDEX IF NOT EXISTS queries_started_at ON queries (started_at);
+  CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value TEXT
+  );
+"""
+
+# Columns added to the queries table since it was first created, added to older stores on open
+ADDED_COLUMNS = { "search_scores": "TEXT" }
+
+# Restricts a query to rows started inside an optional (since, until) window
+WINDOW_CLAUSE = "(:since IS NULL OR started_at > :since) AND (:until IS NULL OR started_at < :until)"
+
+
+class TelemetryStore:
+  """Persists fetched query telemetry and scores, and recomputes report aggregates from the stored rows."""
+
+  def __init__(self, filename: str):
+    self.conn = sqlite3.connect(filename)
+    self.conn.executescript(SCHEMA)
+    existing_columns = { row[1] for row in self.conn.execute("PRAGMA table_info(queries)") }
+    for column, column_type in ADDED_COLUMNS.items():
+      if column not in existing_columns:
+        self.conn.execute(f"ALTER TABLE queries ADD COLUMN {column} {column_type}")
+
+  def has_query(self, query_id: str):
+    return self.conn.execute("SELECT 1 FROM queries WHERE id = ?", (query_id,)).fetchone() is not None
+
+  def save_query(self, query_telemetry: dict, query_details: dict, scored_query: dict):
+    """Store one fetched query; `scored_query` is None when its telemetry had nothing to score."""
+    scored_query = scored_query or {}
+    self.conn.execute(
+      "INSERT OR REPLACE INTO queries "
+      "(id, started_at, query, response, avg_relevance_score, fcs, bad_telemetry, spans, search_scores) "
+      "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+      (query_telemetry.get("id"),
+       query_telemetry.get("started_at") or query_details.get("started_at"),
+       scored_query.get("query"),
+       scored_query.get("response"),
+       scored_query.get("avg_relevance_score"),
+       scored_query.get("fcs"),
+       0 if scored_query else 1,
+       json.dumps(query_details.get("spans")),
+       json.dumps(scored_query.get("search_scores") or [])))
+
+  def commit(self):
+    self.conn.commit()
+
+  def get_checkpoint(self):
+    row = self.conn.execute("SELECT value FROM checkpoints WHERE name = 'started_at'").fetchone()
+    return row[0] if row else None
+
+  def set_checkpoint(self, started_at: str):
+    self.conn.execute("INSERT OR REPLACE INTO checkpoints (name, value) VALUES ('started_at', ?)", (started_at,))
+    self.conn.commit()
+
+  def get_resume_point(self):
+    """Return (oldest, newest) start time listed by the last capped run, or None if the last run completed."""
+    rows = dict(self.conn.execute(
+      "SELECT name, value FROM checkpoints WHERE name IN ('resume_until', 'resume_newest')").fetchall())
+    if "resume_until" not in rows:
+      return None
+    return rows["resume_until"], rows.get("resume_newest")
+
+  def set_resume_point(self, until: str, newest: str):
+    self.conn.executemany("INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)",
+                          [("resume_until", until), ("resume_newest", newest)])
+    self.conn.commit()
+
+  def clear_resume_point(self):
+    self.conn.execute("DELETE FROM checkpoints WHERE name IN ('resume_until', 'resume_newest')")
+    self.conn.commit()
+
+  def get_stats(self, avg_search_result_relevance_threshold: float, fcs_threshold: float,
+                since: str = None, until: str = None):
+    row = self.conn.execute(
+      "SELECT "
+      "  COALESCE(SUM(bad_telemetry = 0), 0), "
+      "  AVG(avg_relevance_score), "
+      "  COALESCE(SUM(avg_relevance_score < :relevance_threshold), 0), "
+      "  COUNT(fcs), "
+      "  AVG(fcs), "
+      "  COALESCE(SUM(fcs < :fcs_threshold), 0), "
+      "  COALESCE(SUM(bad_telemetry), 0) "
+      f"FROM queries WHERE {WINDOW_CLAUSE}",
+      { "relevance_threshold": avg_search_result_relevance_threshold, "fcs_threshold": fcs_threshold,
+        "since": since, "until": until }).fetchone()
+
+    return {
+      "num_queries": row[0],
+      "search_relevance_score_avg": round(row[1], 2) if row[1] is not None else 0,
+      "num_queries_with_low_search_relevance_score": row[2],
+      "num_queries_using_fcs": row[3],
+      "fcs_avg": round(row[4], 2) if row[4] is not None else 0,
+      "num_queries_with_low_fcs": row[5],
+      "num_queries_with_bad_telemetry": row[6],
+    }
+
+  def get_score_columns(self, since: str = None, until: str = None):
+    """Return the started_at, avg_relevance_score, fcs and search_scores (JSON) columns of the scored rows."""
+    rows = self.conn.execute(
+      "SELECT started_at, avg_relevance_score, fcs, COALESCE(search_scores, '[]') FROM queries "
+      f"WHERE bad_telemetry = 0 AND {WINDOW_CLAUSE}",
+      { "since": since, "until": until }).fetchall()
+    if not rows:
+      return [], [], [], []
+    return tuple(list(column) for column in zip(*rows))
+
+  def iter_low_search_relevance_queries(self, threshold: float, since: str = None, until: str = None):
+    """Yield (query id, {query, response, avg_relevance_score}) of each query scoring below `threshold`."""
+    cursor = self.conn.execute(
+      "SELECT id, query, response, avg_relevance_score FROM queries "
+      f"WHERE avg_relevance_score < :threshold AND {WINDOW_CLAUSE} ORDER BY started_at DESC, id",
+      { "threshold": threshold, "since": since, "until": until })
+    for query_id, query, response, avg_relevance_score in cursor:
+      yield query_id, {"query": query, "response": response, "avg_relevance_score": round(avg_relevance_score, 2)}
+
+  def iter_low_fcs_queries(self, threshold: float, since: str = None, until: str = None):
+    """Yield (query id, {query, response, fcs}) of each query whose FCS is below `threshold`."""
+    cursor = self.conn.execute(
+      "SELECT id, query, response, fcs FROM queries "
+      f"WHERE fcs < :threshold AND {WINDOW_CLAUSE} ORDER BY started_at DESC, id",
+      { "threshold": threshold, "since": since, "until": until })
+    for query_id, query, response, fcs in cursor:
+      yield query_id, {"query": query, "response": response, "fcs": round(fcs, 2)}
+
+  def get_responses(self, query_ids: list):
+    """Return the stored responses of `query_ids`, in the same order."""
+    placeholders = ", ".join("?" * len(query_ids))
+    responses = dict(self.conn.execute(f"SELECT id, response FROM queries WHERE id IN ({placeholders})", query_ids))
+    return [responses.get(query_id) for query_id in query_ids]
+
+  def close(self):
+    self.conn.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()